@@ -0,0 +1,135 @@
+"""住所入力の候補を返す前方一致索引
+
+町丁目レベルの住所データ（国土交通省「位置参照情報」の大字・町丁目レベル）と
+ジオコーディングに成功した住所の履歴から、正規化した住所を辞書順に並べた配列を作り、
+二分探索で入力中の文字列に前方一致する候補を返す。候補には座標を持たせるので、
+候補を選んだときはジオコーディングAPIを呼ばずに済む。
+
+町丁目データは https://nlftp.mlit.go.jp/isj/ から都道府県ごとのCSVをダウンロードし、
+結合して ADDRESS_INDEX_PATH（既定は data/towns.csv）に置く。
+"""
+import bisect
+import csv
+import os
+import threading
+
+from address_normalizer import normalize_address
+from geocoding import LOW_CONFIDENCE_THRESHOLD, get_geocode_cache, rank_candidates
+
+ADDRESS_INDEX_PATH = os.getenv("ADDRESS_INDEX_PATH", os.path.join("data", "towns.csv"))
+SUGGESTION_LIMIT = int(os.getenv("SUGGESTION_LIMIT", "8"))
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def suggest_key(text):
+    """索引のキー（「〇丁目」で終わる町名は番地の前までと同じキーにする）"""
+    key = normalize_address(text)
+    return key[:-2] if key.endswith("丁目") else key
+
+
+class AddressIndex:
+    """正規化した住所の昇順の配列と、同じ順に並べた候補の配列"""
+
+    def __init__(self, entries=()):
+        # キーが重複したときは後のもの（履歴）を優先する
+        merged = {}
+        for entry in entries:
+            merged[entry["key"]] = entry
+        self._keys = sorted(merged)
+        self._entries = [merged[key] for key in self._keys]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, label, lat, lon):
+        """候補を追加（同じキーがあれば置き換える）"""
+        entry = {"key": suggest_key(label), "label": label, "lat": lat, "lon": lon}
+        with self._lock:
+            i = bisect.bisect_left(self._keys, entry["key"])
+            if i < len(self._keys) and self._keys[i] == entry["key"]:
+                self._entries[i] = entry
+            else:
+                self._keys.insert(i, entry["key"])
+                self._entries.insert(i, entry)
+
+    def search(self, text, limit=SUGGESTION_LIMIT):
+        """入力に前方一致する候補を返す
+
+        前方一致する候補がなければ（番地まで入力したときなど）、
+        入力の先頭部分に一致する最も長い候補（町丁目）を返す。
+        """
+        key = suggest_key(text)
+        if not key:
+            return []
+        with self._lock:
+            i = bisect.bisect_left(self._keys, key)
+            results = []
+            while i < len(self._keys) and len(results) < limit and self._keys[i].startswith(key):
+                results.append(self._entries[i])
+                i += 1
+            if results:
+                return results
+
+            for end in range(len(key) - 1, 0, -1):
+                i = bisect.bisect_left(self._keys, key[:end])
+                if i < len(self._keys) and self._keys[i] == key[:end]:
+                    return [self._entries[i]]
+        return []
+
+
+def _read_towns(path):
+    for encoding in ("utf-8-sig", "cp932"):
+        try:
+            with open(path, encoding=encoding, newline="") as f:
+                rows = list(csv.DictReader(f))
+            break
+        except UnicodeDecodeError:
+            continue
+    else:
+        raise ValueError(f"文字コードを判別できません: {path}")
+
+    for row in rows:
+        try:
+            label = row["都道府県名"] + row["市区町村名"] + row["大字町丁目名"]
+            yield {"key": suggest_key(label), "label": label, "lat": float(row["緯度"]), "lon": float(row["経度"])}
+        except (KeyError, TypeError, ValueError):
+            continue
+
+
+def _read_history():
+    # core.geocode_address と同じく一致度の最も高い候補を使い、一致度の低い住所は候補に出さない
+    for address, data in get_geocode_cache().entries():
+        try:
+            candidates = rank_candidates(address, data or [])
+        except (KeyError, IndexError, TypeError):
+            continue
+        if not candidates or candidates[0]["score"] < LOW_CONFIDENCE_THRESHOLD:
+            continue
+        best = candidates[0]
+        yield {"key": suggest_key(address), "label": address, "lat": best["lat"], "lon": best["lon"]}
+
+
+def get_address_index():
+    """町丁目データとジオコーディング履歴から作った索引を取得"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            towns = _read_towns(ADDRESS_INDEX_PATH) if os.path.exists(ADDRESS_INDEX_PATH) else ()
+            _index = AddressIndex([*towns, *_read_history()])
+    return _index
+
+
+def record_geocode(address, lat, lon):
+    """ジオコーディングに成功した住所を索引に加える（索引を作る前なら次に作るときに履歴から読む）"""
+    with _index_lock:
+        index = _index
+    if index is not None:
+        index.add(address, lat, lon)
+
+
+def suggest(text, limit=SUGGESTION_LIMIT):
+    """入力中の住所の候補を返す"""
+    return get_address_index().search(text, limit)
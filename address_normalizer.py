@@ -0,0 +1,136 @@
+"""日本の住所表記の正規化と、文章からの住所の抽出
+
+全角数字・漢数字・ハイフンの揺れや「丁目・番地・号」の書き方の違いを
+1つの表記にそろえる。正規化した文字列はジオコーディングやハザード判定の
+キャッシュキーにも使うので、表記が違うだけの住所は同じ結果を共有できる。
+"""
+import re
+import unicodedata
+
+PREFECTURES = (
+    "北海道", "青森県", "岩手県", "宮城県", "秋田県", "山形県", "福島県",
+    "茨城県", "栃木県", "群馬県", "埼玉県", "千葉県", "東京都", "神奈川県",
+    "新潟県", "富山県", "石川県", "福井県", "山梨県", "長野県", "岐阜県",
+    "静岡県", "愛知県", "三重県", "滋賀県", "京都府", "大阪府", "兵庫県",
+    "奈良県", "和歌山県", "鳥取県", "島根県", "岡山県", "広島県", "山口県",
+    "徳島県", "香川県", "愛媛県", "高知県", "福岡県", "佐賀県", "長崎県",
+    "熊本県", "大分県", "宮崎県", "鹿児島県", "沖縄県",
+)
+
+_KANJI_DIGITS = {"〇": 0, "一": 1, "二": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+_KANJI_UNITS = {"十": 10, "百": 100, "千": 1000}
+_KANJI_NUMERAL = "[〇一二三四五六七八九十百千]+"
+
+_WHITESPACE_RE = re.compile(r"\s+")
+# 数字に挟まれたハイフン類・長音記号
+_HYPHEN_RE = re.compile(r"(?<=\d)[‐‑‒–—―−－ー─━-]+(?=\d)")
+# 「三丁目」「十二番地」のように住所の区切りの前にある漢数字
+_KANJI_BEFORE_UNIT_RE = re.compile(_KANJI_NUMERAL + r"(?=丁目|番地|番(?!町)|号|地割)")
+# 「番地三」「1-五」のように区切りの後ろにある漢数字
+_KANJI_AFTER_UNIT_RE = re.compile(r"(?:(?<=番地)|(?<=番)|(?<=丁目)|(?<=-))" + _KANJI_NUMERAL + r"(?=号|-|$)")
+# 「大字」と、大字や町・村の名前の後ろに来る小字の「字」（「十文字」のような名前の中の字は残す）
+_OAZA_SECTION_RE = re.compile(r"大字(\D+)字(?=\D)")
+_OAZA_RE = re.compile(r"大字|(?<=[町村])字(?=\D)")
+_NO_BETWEEN_DIGITS_RE = re.compile(r"(?<=\d)(?:番地|番)?の(?=\d)")
+_UNIT_BEFORE_DIGIT_RE = re.compile(r"(\d+)(?:丁目|番地|番)-?(?=\d)")
+_TRAILING_UNIT_RE = re.compile(r"(?<=\d)(?:番地|番|号)$")
+_REPEATED_HYPHEN_RE = re.compile(r"-{2,}")
+
+# 名前の途中に「市・区・町・村」を含み、最短一致では手前で切れてしまう市町村
+MUNICIPALITIES_WITH_SUFFIX_CHAR = (
+    "四日市市", "廿日市市", "野々市市", "十日町市", "大町市", "大村市", "田村市",
+    "東村山市", "武蔵村山市", "羽村市", "上市町", "余市町", "玉村町", "大町町",
+)
+# 市区町村（郡の町村、政令指定都市の区を含む）。上の市町村は名前全体を優先して一致させる
+_MUNICIPALITY_RE = re.compile(
+    r"(?:.+?郡)?(?:" + "|".join(MUNICIPALITIES_WITH_SUFFIX_CHAR) + r"|.+?(?:市[^\d-]+?区|[市区町村]))"
+)
+
+# 住所の途中に現れない区切り文字
+_ADDRESS_STOP = r"\s、。,，\"'「」()（）:：\[\]{}"
+_ADDRESS_HYPHENS = "‐‑‒–—―−－ー─━-"
+_ADDRESS_UNIT = r"(?:丁目|番地|番|号|地割)"
+# 町名までの部分。「北1条」のように後ろに漢字が続く数字と、「さいたま」「ひばりが丘」のような
+# ひらがなを含むが、「に」「です」など助詞から始まるひらがなや「5号が」の「が」は住所の外とみなす
+_ADDRESS_NAME = (
+    rf"(?:[^{_ADDRESS_STOP}\dぁ-ゖ]"
+    rf"|\d+(?=[^{_ADDRESS_STOP}\dぁ-ゖ{_ADDRESS_HYPHENS}])(?!{_ADDRESS_UNIT}の\d)"
+    r"|(?:(?<=[都道府県])|(?<![ぁ-ゖ号番])(?<!番地)(?![にでをへはともや]))[ぁ-ゖ]+)*"
+)
+# 番地の部分（「3-3-3」「三丁目3番地3号」「1番の2」など）
+_ADDRESS_LOT = rf"\d+(?:{_ADDRESS_UNIT}?(?:[{_ADDRESS_HYPHENS}]|の)?\d+)*{_ADDRESS_UNIT}?"
+# 都道府県名から始まり、番地の後ろの「です」などや区切り文字の手前までを住所とみなす
+_ADDRESS_RE = re.compile(
+    "(?:" + "|".join(PREFECTURES) + rf"){_ADDRESS_NAME}"
+    rf"(?:{_ADDRESS_LOT}|(?<=[^{_ADDRESS_STOP}\dぁ-ゖ]))(?<![都道府県])"
+)
+
+
+def kanji_to_int(text):
+    """漢数字を整数に変換（「二十三」「百五」「二〇」のどの書き方にも対応）"""
+    total = 0
+    current = 0
+    for ch in text:
+        if ch in _KANJI_DIGITS:
+            current = current * 10 + _KANJI_DIGITS[ch]
+        else:
+            total += (current or 1) * _KANJI_UNITS[ch]
+            current = 0
+    return total + current
+
+
+def _replace_kanji(match):
+    return str(kanji_to_int(match.group(0)))
+
+
+def normalize_address(address):
+    """住所を正規化した表記を返す
+
+    例: 「東京都江東区豊洲三丁目３番地３号」→「東京都江東区豊洲3-3-3」
+    """
+    text = unicodedata.normalize("NFKC", address or "")
+    text = _WHITESPACE_RE.sub("", text)
+    text = _KANJI_BEFORE_UNIT_RE.sub(_replace_kanji, text)
+    text = _KANJI_AFTER_UNIT_RE.sub(_replace_kanji, text)
+    text = _HYPHEN_RE.sub("-", text)
+    text = _OAZA_SECTION_RE.sub(r"\1", text)
+    text = _OAZA_RE.sub("", text)
+    text = _NO_BETWEEN_DIGITS_RE.sub("-", text)
+    text = _UNIT_BEFORE_DIGIT_RE.sub(r"\1-", text)
+    text = _TRAILING_UNIT_RE.sub("", text)
+    return _REPEATED_HYPHEN_RE.sub("-", text)
+
+
+def split_address(normalized):
+    """正規化済みの住所を (都道府県, 市区町村, 残り) に分ける（見つからない部分は空文字）"""
+    prefecture = next((name for name in PREFECTURES if normalized.startswith(name)), "")
+    rest = normalized[len(prefecture):]
+    match = _MUNICIPALITY_RE.match(rest)
+    municipality = match.group(0) if match else ""
+    return prefecture, municipality, rest[len(municipality):]
+
+
+def join_location_lot(location, lot_number):
+    """登記簿の所在と地番をつなげた住所を正規化して返す"""
+    location = normalize_address(location)
+    lot_number = normalize_address(lot_number)
+    if location and location[-1].isdigit() and lot_number[:1].isdigit():
+        return f"{location}-{lot_number}"
+    return normalize_address(location + lot_number)
+
+
+def unique_addresses(addresses):
+    """正規化した表記が同じ住所を除いて、出現順に返す"""
+    result = []
+    seen = set()
+    for address in addresses:
+        key = normalize_address(address)
+        if key not in seen:
+            seen.add(key)
+            result.append(address)
+    return result
+
+
+def extract_addresses(text):
+    """文章中の住所を出現順に重複なく返す（1回の正規表現の走査で抽出）"""
+    return unique_addresses(match.group(0) for match in _ADDRESS_RE.finditer(text or ""))
@@ -0,0 +1,282 @@
+"""ジオコーディングとハザード判定のHTTP API
+
+Streamlitを経由せずに他のサービスから core のパイプラインを呼び出すためのサーバー。
+
+    python api_server.py --port 8800 --workers 32
+
+    GET /geocode?address=東京都江東区豊洲3-3-3
+    GET /hazard?lat=35.65&lon=139.79
+    GET /assess?address=東京都江東区豊洲3-3-3
+    GET /shelters?lat=35.65&lon=139.79&hazard=tsunami&k=3
+    GET /tiles/{flood|tsunami|landslide}/{z}/{x}/{y}.png
+    GET /composite/{flood+tsunami+landslide}/{z}/{x}/{y}.{png|webp}
+    GET /metrics  （段階ごとの所要時間。Prometheusのテキスト形式）
+    GET /cache    （キャッシュごとの件数・使用量・ヒット率）
+"""
+import argparse
+import json
+import math
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+import cache_manager
+import core
+import hazard
+import hazard_tiles
+import metrics
+import shelters
+import tile_compositor
+import tile_proxy
+
+API_HOST = os.getenv("API_HOST", "127.0.0.1")
+API_PORT = int(os.getenv("API_PORT", "8800"))
+API_WORKERS = int(os.getenv("API_WORKERS", "32"))
+# 同時に開いておく接続数の上限（keep-aliveで待機中の接続を含む。超えた接続には503を返して閉じる）
+API_MAX_CONNECTIONS = int(os.getenv("API_MAX_CONNECTIONS", "256"))
+# Webメルカトルで表せる緯度の範囲
+MAX_LATITUDE = 85.05
+
+TILE_PATH_RE = re.compile(r"^/tiles/(?P<layer>\w+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.png$")
+COMPOSITE_PATH_RE = re.compile(
+    r"^/composite/(?P<layers>[\w+]+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.(?P<fmt>png|webp)$"
+)
+
+
+class BadRequest(Exception):
+    pass
+
+
+class BoundedHTTPServer(ThreadingHTTPServer):
+    """接続ごとのスレッドで処理し、同時接続数と同時に処理するリクエスト数に上限を設けたHTTPサーバー
+
+    keep-aliveで待機しているだけの接続はリクエストの処理枠（workers）を使わないので、
+    無通信のクライアントが多くても他のリクエストは待たされない。
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, workers=API_WORKERS, max_connections=API_MAX_CONNECTIONS):
+        super().__init__(server_address, handler_class)
+        self.request_slots = threading.BoundedSemaphore(workers)
+        self._connection_slots = threading.BoundedSemaphore(max_connections)
+
+    def process_request(self, request, client_address):
+        if not self._connection_slots.acquire(blocking=False):
+            try:
+                request.sendall(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        try:
+            super().process_request(request, client_address)
+        except BaseException:
+            self._connection_slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._connection_slots.release()
+
+
+def _param(params, name):
+    values = params.get(name)
+    if not values or not values[0].strip():
+        raise BadRequest(f"{name} を指定してください")
+    return values[0].strip()
+
+
+def _float_param(params, name):
+    try:
+        return float(_param(params, name))
+    except ValueError:
+        raise BadRequest(f"{name} は数値で指定してください")
+
+
+def _latlon_params(params):
+    """lat・lon を取得（有限の値で、地図で表せる範囲にあること）"""
+    lat, lon = _float_param(params, "lat"), _float_param(params, "lon")
+    if not (math.isfinite(lat) and abs(lat) <= MAX_LATITUDE):
+        raise BadRequest(f"lat は -{MAX_LATITUDE}〜{MAX_LATITUDE} の範囲で指定してください")
+    if not (math.isfinite(lon) and abs(lon) <= 180):
+        raise BadRequest("lon は -180〜180 の範囲で指定してください")
+    return lat, lon
+
+
+def handle_geocode(params):
+    location = core.geocode_address(_param(params, "address"))
+    if location is None:
+        return 404, {"error": "住所が見つかりませんでした"}
+    return 200, location
+
+
+def handle_hazard(params):
+    return 200, core.get_hazard_info(*_latlon_params(params))
+
+
+def handle_assess(params):
+    result = core.assess_address(_param(params, "address"))
+    if result is None:
+        return 404, {"error": "住所が見つかりませんでした"}
+    return 200, result
+
+
+def handle_shelters(params):
+    hazard = params.get("hazard", [None])[0] or None
+    if hazard is not None and hazard not in shelters.HAZARD_COLUMNS:
+        raise BadRequest(f"hazard は {', '.join(shelters.HAZARD_COLUMNS)} のいずれかで指定してください")
+    lat, lon = _latlon_params(params)
+    k = _float_param(params, "k") if params.get("k") else shelters.SHELTER_COUNT
+    if not math.isfinite(k):
+        raise BadRequest("k は数値で指定してください")
+    k = int(k)
+    if shelters.get_shelter_index() is None:
+        return 503, {"error": "避難場所データがありません"}
+    return 200, {
+        "shelters": shelters.nearest_shelters(
+            lat, lon, hazard, max(1, min(k, 50))
+        )
+    }
+
+
+def handle_cache(params):
+    return 200, {"caches": cache_manager.cache_stats(), "spatial": hazard.cache_stats()}
+
+
+# パス → 処理関数。エンドポイントを増やすときはここに追加する
+ROUTES = {
+    "/geocode": handle_geocode,
+    "/hazard": handle_hazard,
+    "/assess": handle_assess,
+    "/shelters": handle_shelters,
+    "/cache": handle_cache,
+}
+
+
+class APIRequestHandler(BaseHTTPRequestHandler):
+    # クライアントとの接続もkeep-aliveで使い回す（無通信の接続は接続数の枠を空けるため切る）
+    protocol_version = "HTTP/1.1"
+    timeout = 5
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/metrics":
+            self._send_text(200, metrics.render_prometheus(), "text/plain; version=0.0.4; charset=utf-8")
+            return
+        if url.path.startswith("/tiles/"):
+            route = "/tiles"
+        elif url.path.startswith("/composite/"):
+            route = "/composite"
+        else:
+            route = url.path if url.path in ROUTES else "other"
+        with self.server.request_slots, metrics.span("api", route=route):
+            self._dispatch(url)
+
+    def _dispatch(self, url):
+        if url.path.startswith("/tiles/"):
+            self._serve_tile(url.path)
+            return
+        if url.path.startswith("/composite/"):
+            self._serve_composite_tile(url.path)
+            return
+        handler = ROUTES.get(url.path)
+        if handler is None:
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            status, body = handler(parse_qs(url.query))
+        except BadRequest as e:
+            status, body = 400, {"error": str(e)}
+        except requests.RequestException as e:
+            status, body = 502, {"error": f"外部APIの呼び出しに失敗しました: {e}"}
+        except Exception as e:
+            status, body = 500, {"error": f"エラーが発生しました: {e}"}
+        self._send_json(status, body)
+
+    def _serve_tile(self, path):
+        """/tiles/{layer}/{z}/{x}/{y}.png をタイルキャッシュから返す"""
+        match = TILE_PATH_RE.match(path)
+        if match is None or match["layer"] not in hazard_tiles.LAYERS:
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            status, body = tile_proxy.get_tile(
+                match["layer"], int(match["z"]), int(match["x"]), int(match["y"])
+            )
+        except requests.RequestException as e:
+            self._send_json(502, {"error": f"タイルの取得に失敗しました: {e}"})
+            return
+        self._send_tile(status, body, "image/png")
+
+    def _serve_composite_tile(self, path):
+        """/composite/{layer+layer...}/{z}/{x}/{y}.{png|webp} を合成して返す"""
+        match = COMPOSITE_PATH_RE.match(path)
+        if match is None:
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            layers = tile_compositor.parse_layers(match["layers"])
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        try:
+            status, body = tile_compositor.get_composite_tile(
+                layers, int(match["z"]), int(match["x"]), int(match["y"]), match["fmt"]
+            )
+        except requests.RequestException as e:
+            self._send_json(502, {"error": f"タイルの取得に失敗しました: {e}"})
+            return
+        self._send_tile(status, body, tile_compositor.FORMATS[match["fmt"]][1])
+
+    def _send_tile(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", f"public, max-age={tile_proxy.TILE_CACHE_MAX_AGE}")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, body):
+        self._send_text(status, json.dumps(body, ensure_ascii=False), "application/json; charset=utf-8")
+
+    def _send_text(self, status, text, content_type):
+        payload = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        # アクセスログは大量になるので出さない
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ジオコーディング・ハザード判定のHTTP API")
+    parser.add_argument("--host", default=API_HOST)
+    parser.add_argument("--port", type=int, default=API_PORT)
+    parser.add_argument("--workers", type=int, default=API_WORKERS)
+    args = parser.parse_args()
+
+    server = BoundedHTTPServer((args.host, args.port), APIRequestHandler, workers=args.workers)
+    print(f"http://{args.host}:{args.port} で待ち受けています")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,245 +1,321 @@
 import streamlit as st
-import requests
+import streamlit.components.v1 as components
 import folium
-from streamlit_folium import st_folium
 from typing import Literal
 import openai
-import base64
+import hashlib
 import os
 from dotenv import load_dotenv
 
+from address_normalizer import join_location_lot
+from batch import BATCH_CONCURRENCY, run_batch
+from bundle_extraction import EXTRACTION_CONCURRENCY, extract_documents, geocode_table, merge_addresses
+import cache_manager
+from address_index import suggest
+from core import geocode_address, get_hazard_info, location_from_suggestion
+import hazard_tiles
+from llm_extraction import extract_data_from_response, extract_registry
+import metrics
+import risk_surface
+from shelters import HAZARD_COLUMNS, get_shelter_index, nearest_shelters
+from tile_compositor import LAYER_ORDER, composite_url_template
+from tile_proxy import TILE_PROXY_URL, prefetch_around, tile_url_template
+
 st.set_page_config(page_title="ハザードマップ表示", layout="wide", page_icon="🗾")
 st.title("🗾 ハザードマップ表示アプリ")
 st.markdown("住所を入力すると、その地域の災害リスク情報を確認できます")
 
-@st.cache_data(ttl=3600)
-def get_hazard_info(lat, lon):
-    """指定座標のハザード情報を取得"""
-    hazard_info = {
-        "flood": {"level": "不明", "detail": "データなし"},
-        "landslide": {"level": "不明", "detail": "データなし"},
-        "tsunami": {"level": "不明", "detail": "データなし"}
-    }
-    
-    # 標高データを取得（津波リスク判定用）
-    try:
-        elevation_url = f"https://cyberjapandata2.gsi.go.jp/general/dem/scripts/getelevation.php?lon={lon}&lat={lat}&outtype=JSON"
-        elev_response = requests.get(elevation_url)
-        elev_data = elev_response.json()
-        
-        if "elevation" in elev_data:
-            elevation = float(elev_data["elevation"])
-            
-            # 簡易的な津波リスク判定
-            if elevation < 5:
-                hazard_info["tsunami"]["level"] = "高い"
-                hazard_info["tsunami"]["detail"] = f"標高 {elevation:.1f}m（沿岸低地）"
-            elif elevation < 10:
-                hazard_info["tsunami"]["level"] = "中程度"
-                hazard_info["tsunami"]["detail"] = f"標高 {elevation:.1f}m"
-            else:
-                hazard_info["tsunami"]["level"] = "低い"
-                hazard_info["tsunami"]["detail"] = f"標高 {elevation:.1f}m"
-    except:
-        pass
-    
-    # 洪水リスクの簡易判定（河川からの距離等で判定する実装が必要）
-    # プロトタイプでは地域によって仮の値を設定
-    if lat > 35.6 and lat < 35.7 and lon > 139.7 and lon < 139.8:  # 東京都心部
-        hazard_info["flood"]["level"] = "中程度"
-        hazard_info["flood"]["detail"] = "河川氾濫想定区域"
-    
-    return hazard_info
+BATCH_WORK_DIR = os.path.join(".cache", "batch")
+MAP_ZOOM = 15
+# キャッシュの状況を画面の最後に表示する（運用者向け）
+CACHE_ADMIN = os.getenv("CACHE_ADMIN", "0") == "1"
+
+# 地図の作成・LLM抽出などこのプロセスで計測した段階を METRICS_PORT の /metrics で出す
+metrics.start_metrics_server()
 
-def call_llm_api_with_image(image_file, api_key):
-    """画像ファイルを直接LLM APIに送信して結果を取得"""
+def call_llm_api_with_image(image_file, api_key, on_address=None):
+    """画像ファイルをLLM APIに送信して結果を取得（住所項目は届き次第on_addressに通知）"""
     load_dotenv()
     api_key = os.getenv("OPENAI_API_KEY")
     try:
         openai.api_key = api_key
         
-        # 画像ファイルをBase64エンコード
         image_file.seek(0)  # ファイルポインタを先頭に戻す
-        image_base64 = base64.b64encode(image_file.read()).decode('utf-8')
+        result = extract_registry(image_file.read(), on_address=on_address)
         
-        # ファイルタイプを取得
-        file_type = image_file.type if hasattr(image_file, 'type') else 'image/png'
-        
-        full_prompt = """
-{
- 'request': 'Extract the following information from the provided PDF document into a JSON format:',
- 'fields': {
-  'document_type': 'The type of the document',
-  'sample_document': "Boolean indicating if it's a sample document ()",
-  'date_of_issue': 'The issue date of the document',
-  'issuing_office': 'The office that issued the document',
-  'registrar': 'The name of the registrar',
-  'management_number': 'The management number',
-  'disclaimer_underline': 'The disclaimer regarding underlined items',
-  'land_information': {
-   'real_estate_number': '不動産番号',
-   'location': '所在',
-   'lot_number': '地番',
-   'land_category': '地目',
-   'land_area_sqm': '地積 (m²)',
-   'cause_and_date': {
-    'cause': '原因',
-    'registration_date': '登記の日付'
-   },
-   'owner': {
-    'address': '所有者住所',
-    'name': '所有者名'
-   }
-  },
-  'rights_section_A_ownership': [
-   {
-    'sequence_number': '順位番号',
-    'purpose_of_registration': '登記の目的',
-    'reception_date_and_number': '受付年月日・受付番号',
-    'rights_holder_and_other_matters': {
-     'owner_address': '所有者住所',
-     'owner_name': '所有者名',
-     'cause': '原因',
-     'is_erased': '抹消事項であるか (boolean, 下線があればtrue)'
-    }
-   }
-  ],
-  'rights_section_B_other_rights': [
-   {
-    'sequence_number': '順位番号',
-    'purpose_of_registration': '登記の目的',
-    'reception_date_and_number': '受付年月日・受付番号',
-    'rights_holder_and_other_matters': {
-     'cause': '原因',
-     'debt_amount_yen': '債権額 (円)',
-     'interest_rate_annual_percent': '利息 (年率%)',
-     'damages_rate_annual_percent': '損害金 (年率%)',
-     'debtor': {
-      'address': '債務者住所',
-      'name': '債務者名'
-     },
-     'mortgage_holder': {
-      'address': '抵当権者住所',
-      'name': '抵当権者名',
-      'branch_name': '取扱店'
-     },
-     'joint_collateral_catalog_number': '共同担保目録番号',
-     'is_erased': '抹消事項であるか (boolean, 下線があればtrue)'
-    }
-   }
-  ],
-  'joint_collateral_catalog': {
-   'catalog_number': '共同担保目録の番号',
-   'prepared_date': '調製日',
-   'items': [
-    {
-     'number': '番号',
-     'description_of_right': '担保の目的である権利の表示',
-     'sequence_number': '順位番号',
-     'is_erased': '抹消事項であるか (boolean, 下線があればtrue)'
-    }
-   ]
-  }
- }
-}
-"""
-        
-        response = openai.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "あなたは日本の住所情報の抽出と分析を得意とするAIアシスタントです。画像ファイルの内容を読み取り、分析することができます。"},
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": full_prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:{file_type};base64,{image_base64}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            max_tokens=1500,
-            temperature=0.3
-        )
-        
-        return response.choices[0].message.content
+        preprocessed = result["preprocess"]
+        if preprocessed:
+            st.caption(
+                f"画像を最適化しました: {preprocessed['original_bytes'] / 1024:.0f}KB → "
+                f"{preprocessed['processed_bytes'] / 1024:.0f}KB、"
+                f"推定画像トークン {preprocessed['original_tokens']} → {preprocessed['processed_tokens']}"
+            )
+        if not result["complete"]:
+            st.warning("AIの応答が途中で打ち切られたため、一部の項目を読み取れていない可能性があります（結果は保存しません）")
+        return result["response"]
     except Exception as e:
         st.error(f"API呼び出しエラー: {str(e)}")
         return None
 
-def extract_data_from_response(response_text):
-    """LLMレスポンスから住所と土地情報を抽出"""
-    addresses = []
-    land_info = None
+# リスクレベルに応じた色とアイコンを設定
+def get_risk_color(level) -> Literal["normal", "inverse", "off"]:
+    if level == "高い":
+        return "inverse"
+    elif level == "中程度":
+        return "normal"
+    else:
+        return "off"
+
+def get_risk_icon(level) -> str:
+    if level == "高い":
+        return "🔴"
+    elif level == "中程度":
+        return "🟡"
+    else:
+        return "🟢"
+
+# 地図と判定結果の部分だけを再実行できるようにする（1.33〜1.36は experimental_fragment、1.37以降は fragment）
+_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda func: func)
+
+@cache_manager.memoize("risk_surface")
+def get_risk_surface(lat, lon):
+    """周辺の危険度分布を計算（同じ地点なら前回の結果を再利用）"""
+    return risk_surface.compute_risk_surface(lat, lon)
+
+def get_nearby_shelters(lat, lon):
+    """災害の種類ごとの最寄りの避難場所（同じ場所は1つにまとめる）"""
+    shelters = {}
+    for hazard in HAZARD_COLUMNS:
+        for shelter in nearest_shelters(lat, lon, hazard):
+            shelters[(shelter["lat"], shelter["lon"], shelter["name"])] = shelter
+    return shelters
+
+def create_map(canonical_address, lat, lon, layers, use_composite, surface_dimension=None):
+    """住所のマーカーとハザードマップのレイヤーを重ねた地図を作成"""
+    m = folium.Map(location=[lat, lon], zoom_start=MAP_ZOOM)
+
+    # 入力した住所の位置にマーカーを配置
+    folium.Marker(
+        [lat, lon],
+        popup=canonical_address,
+        tooltip=canonical_address,
+        icon=folium.Icon(color='red', icon='home')
+    ).add_to(m)
+
+    # ハザードマップタイルレイヤーを追加
+    if use_composite and layers:
+        # 有効なレイヤーを合成済みの1枚のタイルとして取得（透過度は合成時に適用済み）
+        folium.TileLayer(
+            tiles=composite_url_template(layers),
+            attr='国土地理院',
+            name='ハザードマップ（合成）',
+            overlay=True,
+            control=True
+        ).add_to(m)
+    else:
+        # 洪水浸水想定区域（想定最大規模）・津波浸水想定・土砂災害警戒区域
+        for layer in layers:
+            folium.TileLayer(
+                tiles=tile_url_template(layer),
+                attr='国土地理院',
+                name=hazard_tiles.LAYERS[layer]["name"],
+                overlay=True,
+                control=True,
+                opacity=0.6
+            ).add_to(m)
+
+    # 最寄りの避難場所（災害の種類ごと）にマーカーを配置
+    shelter_group = folium.FeatureGroup(name='指定緊急避難場所')
+    for shelter in get_nearby_shelters(lat, lon).values():
+        folium.Marker(
+            [shelter["lat"], shelter["lon"]],
+            popup=f'{shelter["name"]}（{shelter["distance"]:.0f}m）',
+            tooltip=shelter["name"],
+            icon=folium.Icon(color='green', icon='flag')
+        ).add_to(shelter_group)
+    shelter_group.add_to(m)
+
+    # 周辺の危険度分布を画像として重ねる
+    if surface_dimension:
+        surface = get_risk_surface(lat, lon)
+        folium.raster_layers.ImageOverlay(
+            image=risk_surface.to_rgba(surface["levels"][surface_dimension]),
+            bounds=surface["bounds"],
+            name=f'周辺の危険度分布（{risk_surface.DIMENSIONS[surface_dimension]}）',
+            overlay=True,
+            control=True
+        ).add_to(m)
+
+    # レイヤーコントロールを追加
+    folium.LayerControl().add_to(m)
+    return m
+
+@cache_manager.memoize("map_html")
+def build_map_html(canonical_address, lat, lon, layers, use_composite, surface_dimension=None):
+    """地図のHTMLを作成（住所・座標・レイヤーが同じなら前回のHTMLを再利用）"""
+    with metrics.span("map_build") as span:
+        m = create_map(canonical_address, lat, lon, layers, use_composite, surface_dimension)
+        html = m.get_root().render()
+        span.add_bytes(len(html))
+    return html
+
+@_fragment
+def render_hazard_section(canonical_address, lat, lon):
+    """地図と危険度判定を表示（入力が変わらなければキャッシュ済みの結果を使う）"""
+    # 地図を表示する前に周辺のハザードタイルを裏で先読みしておく
+    prefetch_around(lat, lon, MAP_ZOOM)
+
+    # 地図とハザードマップ説明を横並びに
+    st.markdown("---")
+    st.subheader("🗺️ ハザードマップ")
     
-    try:
-        # JSONとして解析を試みる
-        import json
-        data = json.loads(response_text)
+    layer_col, composite_col = st.columns([3, 1])
+    with layer_col:
+        enabled_layers = st.multiselect(
+            "表示するレイヤー",
+            options=list(LAYER_ORDER),
+            default=list(LAYER_ORDER),
+            format_func=lambda layer: hazard_tiles.LAYERS[layer]["name"]
+        )
+    with composite_col:
+        use_composite = st.checkbox(
+            "サーバー側で合成",
+            value=bool(TILE_PROXY_URL),
+            disabled=not TILE_PROXY_URL,
+            help="選んだレイヤーを1枚のタイルに合成して通信量を減らします（TILE_PROXY_URL の設定が必要）"
+        )
+    
+    surface_dimension = st.selectbox(
+        f"周辺の危険度分布（半径{risk_surface.RISK_SURFACE_RADIUS:.0f}m）",
+        options=[None, *risk_surface.DIMENSIONS],
+        format_func=lambda name: "表示しない" if name is None else risk_surface.DIMENSIONS[name]
+    )
+    
+    # レイヤーは表示順にそろえてキャッシュのキーにする
+    layers = tuple(layer for layer in LAYER_ORDER if layer in enabled_layers)
+    map_html = build_map_html(canonical_address, lat, lon, layers, use_composite, surface_dimension)
+    
+    map_col, info_col = st.columns([3, 1])
+    
+    with map_col:
+        # 地図を表示
+        with metrics.span("map_render") as span:
+            span.add_bytes(len(map_html))
+            components.html(map_html, height=500)
+    
+    with info_col:
+        st.markdown("### 凡例")
+        st.markdown("""
+        🔵 **洪水浸水想定区域**  
+        河川氾濫時の浸水深
         
-        # land_information全体を保存
-        if 'land_information' in data:
-            land_info = data['land_information']
-            
-            # 土地の所在地を抽出
-            if 'location' in land_info:
-                location = land_info['location']
-                if location and location not in addresses:
-                    addresses.append(location)
-            
-            # 所有者住所を抽出
-            if 'owner' in land_info and 'address' in land_info['owner']:
-                owner_address = land_info['owner']['address']
-                if owner_address and owner_address not in addresses:
-                    addresses.append(owner_address)
+        🌊 **津波浸水想定**  
+        津波による浸水深
+        
+        🟡 **土砂災害警戒区域**  
+        土砂災害の危険性
         
-        # 権利部A（所有権）から住所を抽出
-        if 'rights_section_A_ownership' in data:
-            for item in data['rights_section_A_ownership']:
-                if 'rights_holder_and_other_matters' in item and 'owner_address' in item['rights_holder_and_other_matters']:
-                    addr = item['rights_holder_and_other_matters']['owner_address']
-                    if addr and addr not in addresses:
-                        addresses.append(addr)
+        ---
         
-        # 権利部B（その他の権利）から住所を抽出
-        if 'rights_section_B_other_rights' in data:
-            for item in data['rights_section_B_other_rights']:
-                if 'rights_holder_and_other_matters' in item:
-                    matters = item['rights_holder_and_other_matters']
-                    # 債務者住所
-                    if 'debtor' in matters and 'address' in matters['debtor']:
-                        addr = matters['debtor']['address']
-                        if addr and addr not in addresses:
-                            addresses.append(addr)
-                    # 抵当権者住所
-                    if 'mortgage_holder' in matters and 'address' in matters['mortgage_holder']:
-                        addr = matters['mortgage_holder']['address']
-                        if addr and addr not in addresses:
-                            addresses.append(addr)
+        💡 **操作方法**
+        - 右上のボタンでレイヤー切替
+        - マウスで地図の移動・拡大縮小
+        """)
+        
+        st.warning("地域によってはデータが存在しない場合があります", icon="⚠️")
+
+    # 危険度判定
+    st.markdown("---")
+    st.subheader("📊 危険度判定")
+
+    # 実際のハザード情報を取得（座標ごとにキャッシュ済み）
+    hazard_info = get_hazard_info(lat, lon)
+    
+    if hazard_info["degraded"]:
+        st.warning("一部のデータ取得が間に合わなかったため、判定できていない項目があります", icon="⚠️")
     
-    except json.JSONDecodeError:
-        # JSON解析に失敗した場合は、従来の方法で抽出を試みる
-        lines = response_text.split('\n')
-        for line in lines:
-            line = line.strip()
-            # 日本の住所パターンを探す（都道府県から始まる）
-            if any(pref in line for pref in ['東京都', '大阪府', '京都府', '北海道'] + [f'{p}県' for p in ['青森', '岩手', '宮城', '秋田', '山形', '福島', '茨城', '栃木', '群馬', '埼玉', '千葉', '神奈川', '新潟', '富山', '石川', '福井', '山梨', '長野', '岐阜', '静岡', '愛知', '三重', '滋賀', '兵庫', '奈良', '和歌山', '鳥取', '島根', '岡山', '広島', '山口', '徳島', '香川', '愛媛', '高知', '福岡', '佐賀', '長崎', '熊本', '大分', '宮崎', '鹿児島', '沖縄']]):
-                # 住所として抽出
-                if line not in addresses and len(line) > 5:  # 最低限の長さチェック
-                    addresses.append(line)
+    # リスク評価を3列で表示
+    risk_cols = st.columns(3)
+    
+    with risk_cols[0]:
+        icon = get_risk_icon(hazard_info["flood"]["level"])
+        color = get_risk_color(hazard_info["flood"]["level"])
+        st.metric(
+            label=f"{icon} 洪水リスク",
+            value=hazard_info["flood"]["level"],
+            delta=hazard_info["flood"]["detail"],
+            delta_color=color
+        )
     
-    return addresses, land_info
+    with risk_cols[1]:
+        icon = get_risk_icon(hazard_info["landslide"]["level"])
+        color = get_risk_color(hazard_info["landslide"]["level"])
+        st.metric(
+            label=f"{icon} 土砂災害リスク",
+            value=hazard_info["landslide"]["level"],
+            delta=hazard_info["landslide"]["detail"],
+            delta_color=color
+        )
+    
+    with risk_cols[2]:
+        icon = get_risk_icon(hazard_info["tsunami"]["level"])
+        color = get_risk_color(hazard_info["tsunami"]["level"])
+        st.metric(
+            label=f"{icon} 津波リスク",
+            value=hazard_info["tsunami"]["level"],
+            delta=hazard_info["tsunami"]["detail"],
+            delta_color=color
+        )
+    
+    # 周辺の危険度の割合
+    if surface_dimension:
+        surface = get_risk_surface(lat, lon)
+        st.markdown(f"#### 周辺の危険度の割合（{surface['cells']:,} 地点）")
+        st.table({
+            label: {level: f"{share:.1%}" for level, share in surface["shares"][name].items()}
+            for name, label in risk_surface.DIMENSIONS.items()
+        })
+    
+    # 最寄りの避難場所
+    st.markdown("---")
+    st.subheader("🏃 最寄りの指定緊急避難場所")
+    if get_shelter_index() is None:
+        st.info("避難場所データ（国土地理院 指定緊急避難場所データ）が見つかりません。SHELTER_DATA_PATH に配置すると表示されます。")
+    else:
+        shelter_cols = st.columns(len(HAZARD_COLUMNS))
+        for shelter_col, (hazard, column) in zip(shelter_cols, HAZARD_COLUMNS.items()):
+            with shelter_col:
+                st.markdown(f"**{column}**")
+                for shelter in nearest_shelters(lat, lon, hazard):
+                    st.markdown(f"- {shelter['name']}（{shelter['distance']:.0f}m）  \n  {shelter['address']}")
+    
+    # 注意事項
+    with st.expander("⚠️ 重要な注意事項", expanded=False):
+        st.warning("""
+        - この評価は標高データ等を基にした簡易的な判定です
+        - 正確な情報は各自治体の公式ハザードマップをご確認ください
+        - 実際の災害リスクは地形、建物、季節、気象条件により変動します
+        - 避難場所や避難経路も併せて確認することをお勧めします
+        - 最新の防災情報は自治体の防災ページでご確認ください
+        """)
+
+# 分析結果は全セッションで共有するキャッシュに置き、セッションにはキーだけを持つ
+documents_cache = cache_manager.get_cache("documents")
+
+def load_shared_result(kind, key_name):
+    """セッションが指している分析結果を共有キャッシュから取り出す（上限で捨てられていればキーも消す）"""
+    key = st.session_state[key_name]
+    if key is None:
+        return None
+    result = documents_cache.get((kind, key))
+    if result is None:
+        st.session_state[key_name] = None
+        st.info("前回の分析結果は保存期間を過ぎたため破棄されました。もう一度分析してください")
+    return result
 
 # セッション状態の初期化
-if 'llm_response' not in st.session_state:
-    st.session_state.llm_response = None
-if 'extracted_addresses' not in st.session_state:
-    st.session_state.extracted_addresses = []
-if 'land_information' not in st.session_state:
-    st.session_state.land_information = None
+if 'document_key' not in st.session_state:
+    st.session_state.document_key = None
 
 # サンプル住所
 sample_addresses = {
@@ -253,6 +329,10 @@ sample_addresses = {
 # セッション状態の初期化
 if 'search_address' not in st.session_state:
     st.session_state.search_address = None
+if 'selected_location' not in st.session_state:
+    st.session_state.selected_location = None
+if 'bundle_key' not in st.session_state:
+    st.session_state.bundle_key = None
 
 # 画像アップロードセクション
 st.markdown("---")
@@ -262,14 +342,44 @@ st.markdown("画像ファイルをアップロードして、AI分析により
 
 # 画像アップロード
 with st.container():
-    uploaded_file = st.file_uploader(
+    uploaded_files = st.file_uploader(
         "画像ファイルをアップロード",
         type=["png", "jpg", "jpeg"],
-        help="分析したい画像ファイルを選択してください"
+        accept_multiple_files=True,
+        help="分析したい画像ファイルを選択してください（複数の書類をまとめて選択できます）"
     )
 
 # 分析実行ボタン
-if uploaded_file:
+if len(uploaded_files) > 1:
+    # 環境変数からAPIキーを取得
+    load_dotenv()
+    api_key = os.getenv("OPENAI_API_KEY")
+    
+    if api_key:
+        if st.button(f"🤖 {len(uploaded_files)}件をまとめてAI分析", type="primary", use_container_width=True):
+            openai.api_key = api_key
+            progress_bar = st.progress(0.0, text="書類を分析中...")
+            
+            def show_extraction_progress(done, total):
+                progress_bar.progress(done / total, text=f"書類を分析中... {done}/{total}")
+            
+            documents = [(f.name, f.getvalue()) for f in uploaded_files]
+            results = extract_documents(documents, EXTRACTION_CONCURRENCY, on_progress=show_extraction_progress)
+            progress_bar.progress(1.0, text="住所の位置を確認中...")
+            bundle_key = hashlib.sha256(
+                "".join(hashlib.sha256(image_bytes).hexdigest() for _, image_bytes in documents).encode("ascii")
+            ).hexdigest()
+            documents_cache.put(("bundle", bundle_key), {
+                "results": results,
+                "addresses": geocode_table(merge_addresses(results)),
+            })
+            st.session_state.bundle_key = bundle_key
+            progress_bar.empty()
+    else:
+        st.error("⚠️ OPENAI_API_KEY環境変数が設定されていません")
+
+elif uploaded_files:
+    uploaded_file = uploaded_files[0]
     # 環境変数からAPIキーを取得
     load_dotenv()
     api_key = os.getenv("OPENAI_API_KEY")
@@ -277,31 +387,99 @@ if uploaded_file:
     if api_key:
         if st.button("🤖 AI分析を実行", type="primary", use_container_width=True):
             with st.spinner("画像を分析中..."):
+                # 住所項目はレスポンス全体を待たずに届いた順に表示する
+                streaming_placeholder = st.empty()
+                streamed_addresses = []
+                
+                def show_streamed_address(address):
+                    if address not in streamed_addresses:
+                        streamed_addresses.append(address)
+                    streaming_placeholder.markdown(
+                        "**読み取った住所**\n" + "\n".join(f"- 📍 {a}" for a in streamed_addresses)
+                    )
+                
                 # 画像ファイルを直接LLM APIに送信
-                llm_response = call_llm_api_with_image(uploaded_file, api_key)
+                llm_response = call_llm_api_with_image(uploaded_file, api_key, on_address=show_streamed_address)
+                streaming_placeholder.empty()
                 
                 if llm_response:
-                    st.session_state.llm_response = llm_response
                     addresses, land_info = extract_data_from_response(llm_response)
-                    st.session_state.extracted_addresses = addresses
-                    st.session_state.land_information = land_info
+                    document_key = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+                    documents_cache.put(("document", document_key), {
+                        "response": llm_response,
+                        "addresses": addresses,
+                        "land_info": land_info,
+                    })
+                    st.session_state.document_key = document_key
     else:
         st.error("⚠️ OPENAI_API_KEY環境変数が設定されていません")
 
+# まとめて分析した結果の表示
+bundle = load_shared_result("bundle", "bundle_key")
+if bundle:
+    st.markdown("---")
+    st.subheader("📚 まとめて分析した結果")
+    
+    failed = [result for result in bundle["results"] if result["error"]]
+    st.caption(
+        f"{len(bundle['results'])} 件の書類から "
+        f"{len(bundle['addresses'])} 件の住所を抽出しました"
+        + (f"（失敗 {len(failed)} 件）" if failed else "")
+    )
+    for result in failed:
+        st.error(f"{result['name']}: {result['error']}")
+    
+    # 書類をまたいで重複を除いた住所表
+    st.dataframe(
+        [
+            {
+                "住所": row["address"],
+                "検索結果": row.get("title", ""),
+                "緯度": row.get("lat"),
+                "経度": row.get("lon"),
+                "一致度": row.get("confidence"),
+                "書類": "、".join(row["documents"]),
+                "エラー": row["error"] or "",
+            }
+            for row in bundle["addresses"]
+        ],
+        use_container_width=True,
+        hide_index=True
+    )
+    
+    located = [row for row in bundle["addresses"] if not row["error"]]
+    if located:
+        bundle_col1, bundle_col2 = st.columns([4, 1])
+        with bundle_col1:
+            bundle_address = st.selectbox(
+                "地図で確認する住所",
+                options=[row["address"] for row in located],
+                label_visibility="collapsed"
+            )
+        with bundle_col2:
+            if st.button("📍 表示", use_container_width=True):
+                st.session_state.search_address = bundle_address
+                st.session_state.selected_extracted = bundle_address
+    
+    if st.button("🗑️ まとめて分析した結果をクリア", type="secondary"):
+        st.session_state.bundle_key = None
+        st.rerun()
+
 # LLM分析結果の表示
-if st.session_state.llm_response:
+document = load_shared_result("document", "document_key")
+if document:
     st.markdown("---")
     st.subheader("🤖 AI分析結果")
     
     # 分析結果を表示
     with st.expander("📋 完全な分析結果", expanded=False):
-        st.markdown(st.session_state.llm_response)
+        st.markdown(document['response'])
     
     # 土地情報を表示
-    if st.session_state.land_information:
+    if document['land_info']:
         st.markdown("### 📄 土地情報")
         
-        land_info = st.session_state.land_information
+        land_info = document['land_info']
         col1, col2 = st.columns(2)
         
         with col1:
@@ -331,7 +509,7 @@ if st.session_state.llm_response:
             
             # 所在地と地番を組み合わせた完全な住所を提供
             if 'location' in land_info and land_info['location'] and 'lot_number' in land_info and land_info['lot_number']:
-                full_address = f"{land_info['location']}{land_info['lot_number']}"
+                full_address = join_location_lot(land_info['location'], land_info['lot_number'])
                 if st.button(
                     f"📍 {full_address} (所在+地番)", 
                     key="full_address_btn",
@@ -378,12 +556,12 @@ if st.session_state.llm_response:
                     st.write(f"• 登記日付: {land_info['cause_and_date']['registration_date']}")
     
     # 抽出された住所を表示
-    if st.session_state.extracted_addresses:
+    if document['addresses']:
         st.markdown("### 📍 抽出された住所")
         
         # 住所をボタンで表示（クリックでカスタム住所欄に入力）
-        address_cols = st.columns(min(3, len(st.session_state.extracted_addresses)))
-        for idx, address in enumerate(st.session_state.extracted_addresses):
+        address_cols = st.columns(min(3, len(document['addresses'])))
+        for idx, address in enumerate(document['addresses']):
             col_idx = idx % len(address_cols)
             with address_cols[col_idx]:
                 if st.button(
@@ -399,9 +577,7 @@ if st.session_state.llm_response:
     
     # 結果をクリアするボタン
     if st.button("🗑️ 分析結果をクリア", type="secondary"):
-        st.session_state.llm_response = None
-        st.session_state.extracted_addresses = []
-        st.session_state.land_information = None
+        st.session_state.document_key = None
         st.rerun()
 
 # UIコンテナ
@@ -428,6 +604,24 @@ with st.container():
         with col2:
             search_button = st.form_submit_button("🔍 検索", type="primary", use_container_width=True)
     
+    # 入力候補（町丁目データと過去に検索できた住所から）
+    address_prefix = st.text_input(
+        "住所の候補を探す",
+        placeholder="例: 東京都江東区豊洲",
+        help="住所の先頭を入力すると候補を表示します。候補を選ぶと保存済みの座標ですぐに表示します"
+    )
+    if address_prefix:
+        suggestions = suggest(address_prefix)
+        if suggestions:
+            suggestion_cols = st.columns(2)
+            for idx, suggestion in enumerate(suggestions):
+                with suggestion_cols[idx % 2]:
+                    if st.button(suggestion["label"], key=f"suggestion_{idx}", use_container_width=True):
+                        st.session_state.search_address = suggestion["label"]
+                        st.session_state.selected_location = location_from_suggestion(suggestion)
+        else:
+            st.caption("候補が見つかりませんでした")
+    
     # サンプル住所選択
     with st.expander("💡 サンプル住所から選択", expanded=False):
         sample_cols = st.columns(2)
@@ -455,171 +649,123 @@ if address and address in sample_addresses:
     st.info(f"📍 {address} - {sample_addresses[address]}")
 
 if address:
-    # 住所から緯度経度を取得（国土地理院ジオコーディングAPI）
-    geocoding_url = f"https://msearch.gsi.go.jp/address-search/AddressSearch?q={address}"
-
     try:
-        response = requests.get(geocoding_url)
-        data = response.json()
-
-        if data:
-            # 最初の検索結果を使用
-            first_result = data[0]
-            lat = first_result["geometry"]["coordinates"][1]
-            lon = first_result["geometry"]["coordinates"][0]
+        # 入力候補から選んだ住所は候補の座標をそのまま使う
+        selected_location = st.session_state.selected_location
+        if selected_location and selected_location["address"] == address:
+            location = selected_location
+        else:
+            # 住所から緯度経度を取得（国土地理院ジオコーディングAPI、キャッシュ経由）
+            location = geocode_address(address)
+
+        if location:
+            # 検索結果が複数あるときは別の候補を選べるようにする
+            candidates = location["candidates"]
+            if len(candidates) > 1:
+                with st.expander(f"🔀 別の候補を選ぶ（{len(candidates)}件）", expanded=location["low_confidence"]):
+                    candidate_index = st.radio(
+                        "候補",
+                        options=range(len(candidates)),
+                        format_func=lambda i: f'{candidates[i]["title"]}（一致度 {candidates[i]["score"]:.0%}）',
+                        key=f"candidate_{location['normalized']}",
+                        label_visibility="collapsed"
+                    )
+                if candidate_index:
+                    location = geocode_address(address, candidate_index)
+            
+            if location["low_confidence"]:
+                st.warning(
+                    f"入力した住所との一致度が低い結果です（{location['confidence']:.0%}）。位置が正しいか確認してください",
+                    icon="⚠️"
+                )
+            
+            lat = location["lat"]
+            lon = location["lon"]
 
             with st.container():
                 col1, col2 = st.columns([3, 1])
                 with col1:
-                    st.success(f"📍 {first_result['properties']['title']}")
+                    st.success(f"📍 {location['title']}")
                 with col2:
                     st.metric("座標", f"{lat:.4f}, {lon:.4f}", label_visibility="collapsed")
 
-            # 地図を作成
-            m = folium.Map(location=[lat, lon], zoom_start=15)
-
-            # 入力した住所の位置にマーカーを配置
-            folium.Marker(
-                [lat, lon],
-                popup=address,
-                tooltip=address,
-                icon=folium.Icon(color='red', icon='home')
-            ).add_to(m)
-
-            # ハザードマップタイルレイヤーを追加
-            # 洪水浸水想定区域（想定最大規模）
-            folium.TileLayer(
-                tiles='https://disaportaldata.gsi.go.jp/raster/01_flood_l2_shinsuishin_data/{z}/{x}/{y}.png',
-                attr='国土地理院',
-                name='洪水浸水想定区域',
-                overlay=True,
-                control=True,
-                opacity=0.6
-            ).add_to(m)
-
-            # 津波浸水想定
-            folium.TileLayer(
-                tiles='https://disaportaldata.gsi.go.jp/raster/04_tsunami_newlegend_data/{z}/{x}/{y}.png',
-                attr='国土地理院',
-                name='津波浸水想定',
-                overlay=True,
-                control=True,
-                opacity=0.6
-            ).add_to(m)
-
-            # 土砂災害警戒区域
-            folium.TileLayer(
-                tiles='https://disaportaldata.gsi.go.jp/raster/05_dosekiryukeikaikuiki/{z}/{x}/{y}.png',
-                attr='国土地理院',
-                name='土砂災害警戒区域',
-                overlay=True,
-                control=True,
-                opacity=0.6
-            ).add_to(m)
-
-            # レイヤーコントロールを追加
-            folium.LayerControl().add_to(m)
-
-            # 地図とハザードマップ説明を横並びに
-            st.markdown("---")
-            st.subheader("🗺️ ハザードマップ")
-            
-            map_col, info_col = st.columns([3, 1])
-            
-            with map_col:
-                # 地図を表示
-                st_folium(m, width=700, height=500, returned_objects=[])
-            
-            with info_col:
-                st.markdown("### 凡例")
-                st.markdown("""
-                🔵 **洪水浸水想定区域**  
-                河川氾濫時の浸水深
-                
-                🌊 **津波浸水想定**  
-                津波による浸水深
-                
-                🟡 **土砂災害警戒区域**  
-                土砂災害の危険性
-                
-                ---
-                
-                💡 **操作方法**
-                - 右上のボタンでレイヤー切替
-                - マウスで地図の移動・拡大縮小
-                """)
-                
-                st.warning("地域によってはデータが存在しない場合があります", icon="⚠️")
-
-            # 危険度判定
-            st.markdown("---")
-            st.subheader("📊 危険度判定")
-
-            # 実際のハザード情報を取得
-            hazard_info = get_hazard_info(lat, lon)
-            
-            # リスク評価を3列で表示
-            risk_cols = st.columns(3)
-            
-            # リスクレベルに応じた色とアイコンを設定
-            def get_risk_color(level) -> Literal["normal", "inverse", "off"]:
-                if level == "高い":
-                    return "inverse"
-                elif level == "中程度":
-                    return "normal"
-                else:
-                    return "off"
-            
-            def get_risk_icon(level) -> str:
-                if level == "高い":
-                    return "🔴"
-                elif level == "中程度":
-                    return "🟡"
-                else:
-                    return "🟢"
-            
-            with risk_cols[0]:
-                icon = get_risk_icon(hazard_info["flood"]["level"])
-                color = get_risk_color(hazard_info["flood"]["level"])
-                st.metric(
-                    label=f"{icon} 洪水リスク",
-                    value=hazard_info["flood"]["level"],
-                    delta=hazard_info["flood"]["detail"],
-                    delta_color=color
-                )
-            
-            with risk_cols[1]:
-                icon = get_risk_icon(hazard_info["landslide"]["level"])
-                color = get_risk_color(hazard_info["landslide"]["level"])
-                st.metric(
-                    label=f"{icon} 土砂災害リスク",
-                    value=hazard_info["landslide"]["level"],
-                    delta=hazard_info["landslide"]["detail"],
-                    delta_color=color
-                )
-            
-            with risk_cols[2]:
-                icon = get_risk_icon(hazard_info["tsunami"]["level"])
-                color = get_risk_color(hazard_info["tsunami"]["level"])
-                st.metric(
-                    label=f"{icon} 津波リスク",
-                    value=hazard_info["tsunami"]["level"],
-                    delta=hazard_info["tsunami"]["detail"],
-                    delta_color=color
-                )
-            
-            # 注意事項
-            with st.expander("⚠️ 重要な注意事項", expanded=False):
-                st.warning("""
-                - この評価は標高データ等を基にした簡易的な判定です
-                - 正確な情報は各自治体の公式ハザードマップをご確認ください
-                - 実際の災害リスクは地形、建物、季節、気象条件により変動します
-                - 避難場所や避難経路も併せて確認することをお勧めします
-                - 最新の防災情報は自治体の防災ページでご確認ください
-                """)
+            render_hazard_section(location["normalized"], lat, lon)
 
         else:
             st.error("住所が見つかりませんでした。別の住所を入力してください。")
 
     except Exception as e:
-        st.error(f"エラーが発生しました: {str(e)}")
\ No newline at end of file
+        st.error(f"エラーが発生しました: {str(e)}")
+
+# 一括判定セクション
+st.markdown("---")
+st.subheader("📑 一括判定")
+st.markdown("住所リスト（CSV / JSONL）をアップロードして、まとめてハザード判定を行います")
+
+with st.expander("📤 住所リストをアップロード", expanded=False):
+    batch_file = st.file_uploader(
+        "住所リストファイル",
+        type=["csv", "jsonl"],
+        help="CSVは address または 住所 列（なければ1列目）、JSONLは \"address\" キーを住所として読み込みます",
+        key="batch_file"
+    )
+    batch_concurrency = st.slider("同時実行数", min_value=1, max_value=32, value=BATCH_CONCURRENCY)
+    
+    if batch_file and st.button("📑 一括判定を実行", use_container_width=True):
+        # 同じファイルを再度アップロードした場合は、前回の続きから再開する
+        batch_bytes = batch_file.getvalue()
+        batch_id = hashlib.sha256(batch_bytes).hexdigest()[:16]
+        batch_ext = ".jsonl" if batch_file.name.endswith(".jsonl") else ".csv"
+        os.makedirs(BATCH_WORK_DIR, exist_ok=True)
+        batch_input = os.path.join(BATCH_WORK_DIR, f"{batch_id}_input{batch_ext}")
+        batch_output = os.path.join(BATCH_WORK_DIR, f"{batch_id}_result.csv")
+        with open(batch_input, "wb") as f:
+            f.write(batch_bytes)
+        
+        progress_text = st.empty()
+        
+        def show_batch_progress(processed, skipped):
+            progress_text.text(f"{processed} 件処理しました（処理済みのためスキップ: {skipped} 件）")
+        
+        with st.spinner("一括判定を実行中..."):
+            run_batch(batch_input, batch_output, batch_concurrency, on_progress=show_batch_progress)
+        
+        with open(batch_output, "rb") as f:
+            st.download_button(
+                "📥 判定結果をダウンロード (CSV)",
+                data=f.read(),
+                file_name=f"{os.path.splitext(batch_file.name)[0]}_hazard.csv",
+                mime="text/csv",
+                use_container_width=True
+            )
+
+# キャッシュの状況（運用者向け）
+if CACHE_ADMIN:
+    st.markdown("---")
+    with st.expander("🧮 キャッシュの状況", expanded=False):
+        stats = cache_manager.cache_stats()
+        st.dataframe(
+            [
+                {
+                    "キャッシュ": name,
+                    "件数": cache["entries"],
+                    "使用量 (MB)": round(cache["bytes"] / 1024 ** 2, 2),
+                    "上限 (MB)": round(cache["max_bytes"] / 1024 ** 2, 2),
+                    "ヒット率": f"{cache['hit_rate']:.0%}",
+                    "ヒット": cache["hits"],
+                    "ミス": cache["misses"],
+                    "追い出し": cache["evictions"],
+                }
+                for name, cache in stats.items()
+            ],
+            use_container_width=True,
+            hide_index=True
+        )
+        st.caption(
+            f"合計 {sum(cache['bytes'] for cache in stats.values()) / 1024 ** 2:.1f}MB / "
+            f"上限 {sum(cache['max_bytes'] for cache in stats.values()) / 1024 ** 2:.1f}MB"
+            "（すべてのセッションで共有）"
+        )
+        if st.button("🗑️ すべてのキャッシュを空にする", type="secondary"):
+            cache_manager.clear_caches()
+            st.rerun()
@@ -0,0 +1,223 @@
+"""住所リストの一括ハザード判定
+
+CSV（address または 住所 列、なければ1列目。1行目が住所ならヘッダーなしとみなす）か
+JSONL（"address" キー）の住所を正規化 → ジオコーディング → ハザード判定の順に並行処理し、
+終わった行から CSV / JSONL に書き出す。読めない行もエラーの行として書き出す。
+処理済みの行はチェックポイントファイルに記録するので、中断しても同じコマンドで続きから再開できる。
+
+    python batch.py addresses.csv results.csv --concurrency 16 --rate msearch.gsi.go.jp=10
+"""
+import argparse
+import csv
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import core
+from address_normalizer import PREFECTURES, normalize_address
+from http_client import parse_rate_limit, set_rate_limit
+from shelters import nearest_shelters
+
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+
+HAZARD_KEYS = ("flood", "landslide", "tsunami")
+OUTPUT_FIELDS = [
+    "id", "address", "normalized", "title", "lat", "lon", "confidence",
+    *(f"{key}_{field}" for key in HAZARD_KEYS for field in ("level", "detail")),
+    *(f"{key}_{field}" for key in HAZARD_KEYS for field in ("shelter", "shelter_distance")),
+    "degraded", "error",
+]
+
+
+def _read_jsonl(f):
+    for line_number, line in enumerate(f, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield str(line_number), "", f"JSONとして読めません: {e}"
+            continue
+        if not isinstance(record, dict):
+            yield str(line_number), "", "JSONのオブジェクトではありません"
+            continue
+        yield str(record.get("id", line_number)), record.get("address"), None
+
+
+def _read_csv(f):
+    reader = csv.reader(f)
+    header = next(reader, None)
+    if header is None:
+        # 空のファイル
+        return
+    address_column = next((header.index(name) for name in ("address", "住所") if name in header), None)
+    if address_column is None and header and header[0].startswith(PREFECTURES):
+        # 1行目から住所が始まる（ヘッダーなし）
+        id_column, address_column, rows = None, 0, [header, *reader]
+    else:
+        id_column = header.index("id") if "id" in header else None
+        address_column, rows = address_column or 0, reader
+    # 空の行は読み飛ばす（csv.DictReader と同じ）
+    for row_number, row in enumerate(filter(None, rows), start=1):
+        row_id = row[id_column] if id_column is not None and id_column < len(row) else ""
+        address = row[address_column] if address_column < len(row) else None
+        yield row_id or str(row_number), address, None
+
+
+def read_rows(path):
+    """入力ファイルから (行ID, 住所, エラー) を順に返す
+
+    読めない行・住所のない行は、住所を空にしてエラーの内容を返す（1行のために全体を止めない）。
+    """
+    with open(path, encoding="utf-8" if path.endswith(".jsonl") else "utf-8-sig", newline="") as f:
+        rows = _read_jsonl(f) if path.endswith(".jsonl") else _read_csv(f)
+        for row_id, address, error in rows:
+            if error is None and (not isinstance(address, str) or not address.strip()):
+                address, error = "", "住所がありません"
+            yield row_id, address, error
+
+
+def assess_row(row_id, address):
+    """1行分の判定結果を出力用の辞書にする（エラーも結果として返す）"""
+    result = {"id": row_id, "address": address, "normalized": normalize_address(address)}
+    try:
+        assessment = core.assess_address(address)
+    except Exception as e:
+        result["error"] = str(e)
+        return result
+
+    if assessment is None:
+        result["error"] = "住所が見つかりませんでした"
+        return result
+
+    location = assessment["location"]
+    hazard_info = assessment["hazard"]
+    result.update(
+        title=location["title"], lat=location["lat"], lon=location["lon"], confidence=location["confidence"]
+    )
+    for key in HAZARD_KEYS:
+        result[f"{key}_level"] = hazard_info[key]["level"]
+        result[f"{key}_detail"] = hazard_info[key]["detail"]
+        # その災害に対応する最寄りの避難場所（データがなければ空欄）
+        for shelter in nearest_shelters(location["lat"], location["lon"], key, k=1):
+            result[f"{key}_shelter"] = shelter["name"]
+            result[f"{key}_shelter_distance"] = round(shelter["distance"])
+    result["degraded"] = hazard_info["degraded"]
+    return result
+
+
+class ResultWriter:
+    """結果を1行ずつ書き出し、書き終えた行IDをチェックポイントに記録する"""
+
+    def __init__(self, output_path, checkpoint_path):
+        self._jsonl = output_path.endswith(".jsonl")
+        resuming = os.path.exists(output_path) and os.path.getsize(output_path) > 0
+        self._output = open(output_path, "a", encoding="utf-8", newline="")
+        self._checkpoint = open(checkpoint_path, "a", encoding="utf-8")
+        if not self._jsonl:
+            self._csv = csv.DictWriter(self._output, fieldnames=OUTPUT_FIELDS)
+            if not resuming:
+                self._csv.writeheader()
+
+    def write(self, result):
+        if self._jsonl:
+            self._output.write(json.dumps(result, ensure_ascii=False) + "\n")
+        else:
+            self._csv.writerow(result)
+        self._output.flush()
+        # 結果を書いてから記録するので、中断しても結果の欠落はない
+        self._checkpoint.write(result["id"] + "\n")
+        self._checkpoint.flush()
+
+    def close(self):
+        self._output.close()
+        self._checkpoint.close()
+
+
+def load_checkpoint(checkpoint_path):
+    """処理済みの行IDの集合を読み込む"""
+    if not os.path.exists(checkpoint_path):
+        return set()
+    with open(checkpoint_path, encoding="utf-8") as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def run_batch(input_path, output_path, concurrency=BATCH_CONCURRENCY, checkpoint_path=None, on_progress=None):
+    """一括判定を実行し、今回処理した件数を返す
+
+    on_progress(processed, skipped) は1行書き出すごとに呼ばれる。
+    """
+    checkpoint_path = checkpoint_path or f"{output_path}.checkpoint"
+    done = load_checkpoint(checkpoint_path)
+    writer = ResultWriter(output_path, checkpoint_path)
+    # 入力を全部読み込まないよう、実行中の件数をワーカー数の2倍までに抑える
+    max_in_flight = concurrency * 2
+    processed = 0
+    skipped = 0
+
+    def drain(futures, return_when):
+        nonlocal processed
+        finished, pending = wait(futures, return_when=return_when)
+        for future in finished:
+            writer.write(future.result())
+            processed += 1
+            if on_progress:
+                on_progress(processed, skipped)
+        return pending
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch") as executor:
+            in_flight = set()
+            for row_id, address, error in read_rows(input_path):
+                if row_id in done:
+                    skipped += 1
+                    continue
+                if error is not None:
+                    writer.write({"id": row_id, "address": address, "error": error})
+                    processed += 1
+                    if on_progress:
+                        on_progress(processed, skipped)
+                    continue
+                if len(in_flight) >= max_in_flight:
+                    in_flight = drain(in_flight, FIRST_COMPLETED)
+                in_flight.add(executor.submit(assess_row, row_id, address))
+            while in_flight:
+                in_flight = drain(in_flight, FIRST_COMPLETED)
+    finally:
+        writer.close()
+    return processed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="住所リストの一括ハザード判定")
+    parser.add_argument("input", help="入力ファイル（.csv または .jsonl）")
+    parser.add_argument("output", help="出力ファイル（.csv または .jsonl）")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY)
+    parser.add_argument("--checkpoint", help="チェックポイントファイル（省略時は 出力ファイル名.checkpoint）")
+    parser.add_argument(
+        "--rate", action="append", default=[], metavar="HOST=RPS",
+        help="ホストごとの毎秒リクエスト数の上限（複数指定可）",
+    )
+    args = parser.parse_args()
+
+    for item in args.rate:
+        try:
+            host, rate = parse_rate_limit(item)
+        except ValueError as e:
+            parser.error(str(e))
+        set_rate_limit(host, rate)
+
+    started = time.monotonic()
+
+    def report(processed, skipped):
+        if processed % 100 == 0:
+            elapsed = time.monotonic() - started
+            print(f"{processed} 件処理（スキップ {skipped} 件、{processed / elapsed:.1f} 件/秒）")
+
+    processed = run_batch(args.input, args.output, args.concurrency, args.checkpoint, report)
+    print(f"完了: {processed} 件を {time.monotonic() - started:.1f} 秒で処理しました")
+
+
+if __name__ == "__main__":
+    main()
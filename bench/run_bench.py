@@ -0,0 +1,352 @@
+"""ベンチマークの実行
+
+代役サーバー（stub_server.py）を起動し、アプリの各モジュールをそちらへ向けてから
+シナリオごとに所要時間の p50/p95/p99 とスループットを計測する。
+キャッシュは実行ごとに一時ディレクトリに作るので、cold のシナリオは毎回キャッシュなしから始まる。
+
+    python bench/run_bench.py                       # すべてのシナリオ
+    python bench/run_bench.py hazard sessions       # シナリオを選ぶ
+    python bench/run_bench.py --save-baseline       # 結果を基準値として保存
+    python bench/run_bench.py --latency 0.05 --route-latency openai=0.8 --chunk-delay 0.01
+
+基準値（既定は bench/baseline.json）があれば比較し、p95 が許容幅を超えて遅くなるか
+スループットが許容幅を超えて下がったシナリオがあれば終了コード1で終わる。
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+# リポジトリ直下のモジュール（core など）を読み込めるようにする
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from stub_server import load_registry_response, parse_latencies, start_stub_server, stub_environment  # noqa: E402
+
+BASELINE_PATH = os.path.join(BENCH_DIR, "baseline.json")
+TOLERANCE = 0.2
+
+WARDS = ["千代田区", "中央区", "港区", "江東区", "品川区", "目黒区", "大田区", "世田谷区", "渋谷区", "新宿区"]
+TOWNS = ["本町", "中町", "東", "西", "南", "北", "緑", "若葉", "旭町", "栄町"]
+
+
+def percentile(sorted_values, q):
+    """昇順の値の q パーセンタイル（最近順位法）"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(-(-q * len(sorted_values) // 100)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(durations, elapsed, errors=0):
+    values = sorted(durations)
+    return {
+        "count": len(values),
+        "errors": errors,
+        "p50_ms": round(percentile(values, 50) * 1000, 3),
+        "p95_ms": round(percentile(values, 95) * 1000, 3),
+        "p99_ms": round(percentile(values, 99) * 1000, 3),
+        "mean_ms": round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+        "throughput": round(len(values) / elapsed, 2) if elapsed > 0 else 0.0,
+    }
+
+
+def measure(fn, items, concurrency=1):
+    """items の各要素で fn を呼び、1回ごとの所要時間とスループットをまとめる"""
+    durations = []
+    errors = 0
+    lock = threading.Lock()
+
+    def run(item):
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            fn(item)
+        except Exception:
+            with lock:
+                errors += 1
+            return
+        duration = time.perf_counter() - started
+        with lock:
+            durations.append(duration)
+
+    started = time.perf_counter()
+    if concurrency <= 1:
+        for item in items:
+            run(item)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(run, items))
+    return summarize(durations, time.perf_counter() - started, errors)
+
+
+def make_points(count, seed):
+    rng = random.Random(seed)
+    return [(35.55 + rng.random() * 0.25, 139.60 + rng.random() * 0.30) for _ in range(count)]
+
+
+def make_addresses(count, seed):
+    rng = random.Random(seed)
+    return [
+        f"東京都{rng.choice(WARDS)}{rng.choice(TOWNS)}{rng.randint(1, 5)}丁目{rng.randint(1, 30)}-{rng.randint(1, 20)}"
+        for _ in range(count)
+    ]
+
+
+def make_large_response(copies):
+    """権利部の行を増やした大きなLLM応答"""
+    data = json.loads(load_registry_response())
+    rights_a = data["rights_section_A_ownership"]
+    rights_b = data["rights_section_B_other_rights"]
+    data["rights_section_A_ownership"] = [
+        {**item, "sequence_number": str(i + 1)} for i, item in enumerate(rights_a * copies)
+    ]
+    data["rights_section_B_other_rights"] = [
+        {**item, "sequence_number": str(i + 1)} for i, item in enumerate(rights_b * copies)
+    ]
+    return json.dumps(data, ensure_ascii=False, indent=1)
+
+
+def make_malformed_responses():
+    """JSONとして壊れた応答（途中で切れたもの・コードブロック・説明文つき・末尾カンマ）"""
+    text = load_registry_response()
+    return [
+        text[: len(text) // 2],
+        f"```json\n{text}\n```",
+        f"以下が抽出結果です。\n{text}\n所在は東京都江東区豊洲三丁目、所有者住所は東京都江東区豊洲三丁目3番3号です。",
+        text.rstrip().rstrip("}") + ',\n "extra": [1, 2, 3,],\n}',
+    ]
+
+
+def make_images(count, seed):
+    """登記簿のスキャンに似た合成画像（白地に文字の代わりの黒い帯）"""
+    import io
+
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    images = []
+    for _ in range(count):
+        image = Image.new("L", (1240, 1754), 255)
+        draw = ImageDraw.Draw(image)
+        for row in range(60):
+            top = 120 + row * 25
+            for _ in range(rng.randint(2, 6)):
+                left = rng.randint(80, 1000)
+                draw.rectangle([left, top, left + rng.randint(40, 200), top + 12], fill=rng.randint(0, 80))
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        images.append(buffer.getvalue())
+    return images
+
+
+def scenario_hazard(args):
+    import core
+
+    points = make_points(args.count, seed=1)
+    return {
+        "hazard_cold": measure(lambda p: core.get_hazard_info(*p), points, args.concurrency),
+        "hazard_warm": measure(lambda p: core.get_hazard_info(*p), points, args.concurrency),
+    }
+
+
+def scenario_geocode(args):
+    import core
+
+    addresses = make_addresses(args.count, seed=2)
+    return {
+        "geocode_cold": measure(core.geocode_address, addresses, args.concurrency),
+        "geocode_warm": measure(core.geocode_address, addresses, args.concurrency),
+    }
+
+
+def scenario_extract(args):
+    from llm_extraction import extract_data_from_response
+
+    large = make_large_response(copies=200)
+    malformed = make_malformed_responses()
+    return {
+        "extract_large": measure(extract_data_from_response, [large] * max(1, args.count // 10)),
+        "extract_malformed": measure(
+            extract_data_from_response, [malformed[i % len(malformed)] for i in range(args.count)]
+        ),
+    }
+
+
+def scenario_llm(args):
+    from llm_extraction import extract_registry
+
+    images = make_images(args.documents, seed=3)
+    return {"llm_stream": measure(extract_registry, images, args.concurrency)}
+
+
+def scenario_sessions(args):
+    """複数のセッションが重なりのある住所を順に調べる（住所 → 座標 → ハザード判定）"""
+    import core
+
+    # 住所の半分はセッション間で共有される人気の住所
+    pool = make_addresses(args.count, seed=4)
+    popular = pool[: max(1, len(pool) // 10)]
+
+    def session_items(session):
+        rng = random.Random(1000 + session)
+        return [rng.choice(popular) if rng.random() < 0.5 else rng.choice(pool) for _ in range(args.steps)]
+
+    def step(address):
+        location = core.geocode_address(address)
+        if location is not None:
+            core.get_hazard_info(location["lat"], location["lon"])
+
+    items = [address for session in range(args.sessions) for address in session_items(session)]
+    return {"sessions": measure(step, items, args.sessions)}
+
+
+# シナリオ名 → 実行関数（結果の名前 → 集計 の辞書を返す）
+SCENARIOS = {
+    "hazard": scenario_hazard,
+    "geocode": scenario_geocode,
+    "extract": scenario_extract,
+    "llm": scenario_llm,
+    "sessions": scenario_sessions,
+}
+
+
+def configure_environment(stub_url, cache_dir):
+    """アプリのモジュールを読み込む前に、外部APIの向き先とキャッシュの置き場所を切り替える"""
+    os.environ.update(stub_environment(stub_url))
+    os.environ.update({
+        "OPENAI_API_KEY": "bench",
+        "GEOCODE_CACHE_PATH": os.path.join(cache_dir, "geocode.sqlite3"),
+        "HAZARD_TILE_CACHE_DIR": os.path.join(cache_dir, "hazard_tiles"),
+        "HAZARD_STORE_DIR": os.path.join(cache_dir, "hazard_store"),
+        "TILE_CACHE_DIR": os.path.join(cache_dir, "tiles"),
+        "COMPOSITE_CACHE_DIR": os.path.join(cache_dir, "composites"),
+        "DEM_STORE_DIR": os.path.join(cache_dir, "dem"),
+        "LLM_CACHE_DIR": os.path.join(cache_dir, "llm"),
+        "ADDRESS_INDEX_PATH": os.path.join(cache_dir, "towns.csv"),
+        "SHELTER_DATA_PATH": os.path.join(cache_dir, "shelters.csv"),
+    })
+    # 1分あたりの上限で待たされると代役サーバーの遅延ではなく上限を計ることになる
+    os.environ.setdefault("LLM_TPM", "100000000")
+    os.environ.setdefault("LLM_RPM", "1000000")
+    # 代役サーバーの遅延で遅延ログが埋まらないようにする
+    os.environ.setdefault("METRICS_SLOW_THRESHOLD", "60")
+
+
+def compare(results, baseline, tolerance):
+    """基準値と比べた行を出力し、悪化したシナリオの名前を返す"""
+    regressions = []
+    print(f"\n{'scenario':<18}{'p95 (ms)':>22}{'throughput (/s)':>26}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        p95_ratio = result["p95_ms"] / base["p95_ms"] if base["p95_ms"] else 1.0
+        throughput_ratio = result["throughput"] / base["throughput"] if base["throughput"] else 1.0
+        regressed = p95_ratio > 1 + tolerance or throughput_ratio < 1 - tolerance
+        if regressed:
+            regressions.append(name)
+        print(
+            f"{name:<18}{base['p95_ms']:>9.1f} → {result['p95_ms']:>7.1f} ({p95_ratio - 1:+6.0%})"
+            f"{base['throughput']:>9.1f} → {result['throughput']:>7.1f} ({throughput_ratio - 1:+6.0%})"
+            f"{'  ← 悪化' if regressed else ''}"
+        )
+    return regressions
+
+
+def print_results(results):
+    print(f"{'scenario':<18}{'count':>7}{'errors':>7}{'p50':>10}{'p95':>10}{'p99':>10}{'throughput':>12}")
+    for name, result in results.items():
+        print(
+            f"{name:<18}{result['count']:>7}{result['errors']:>7}{result['p50_ms']:>10.1f}"
+            f"{result['p95_ms']:>10.1f}{result['p99_ms']:>10.1f}{result['throughput']:>12.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="代役サーバーを相手にしたベンチマーク")
+    parser.add_argument("scenarios", nargs="*", help=f"実行するシナリオ（{', '.join(SCENARIOS)}。省略時はすべて）")
+    parser.add_argument("--count", type=int, default=200, help="1シナリオあたりの入力数")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--documents", type=int, default=16, help="llm シナリオの画像数")
+    parser.add_argument("--sessions", type=int, default=16, help="sessions シナリオの同時セッション数")
+    parser.add_argument("--steps", type=int, default=20, help="1セッションあたりの住所数")
+    parser.add_argument("--latency", type=float, default=0.02, help="代役サーバーの応答までの遅延（秒）")
+    parser.add_argument("--route-latency", default="openai=0.3", help="route ごとの遅延（例: openai=0.8,hazard_tile=0.05）")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--chunk-delay", type=float, default=0.002, help="ストリーミングのチャンク間隔（秒）")
+    parser.add_argument("--stub-url", help="起動済みの代役サーバーを使う（省略時はこのプロセス内で起動）")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="結果を基準値として保存する")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="悪化とみなす変化の割合")
+    parser.add_argument("--output", help="結果をJSONで保存する")
+    args = parser.parse_args()
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"不明なシナリオです: {', '.join(unknown)}")
+
+    stub_url = args.stub_url
+    if stub_url is None:
+        stub_url = start_stub_server(
+            latency=args.latency,
+            route_latencies=parse_latencies(args.route_latency),
+            jitter=args.jitter,
+            chunk_delay=args.chunk_delay,
+        ).url
+
+    cache_dir = tempfile.mkdtemp(prefix="hazard-bench-")
+    configure_environment(stub_url, cache_dir)
+
+    results = {}
+    for name in args.scenarios or SCENARIOS:
+        results.update(SCENARIOS[name](args))
+    print_results(results)
+
+    config = {
+        "count": args.count,
+        "concurrency": args.concurrency,
+        "documents": args.documents,
+        "sessions": args.sessions,
+        "steps": args.steps,
+        "latency": args.latency,
+        "route_latency": args.route_latency,
+        "jitter": args.jitter,
+        "chunk_delay": args.chunk_delay,
+    }
+    report = {"config": config, "results": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.save_baseline:
+        # 選んだシナリオだけ置き換え、ほかのシナリオの基準値は残す
+        baseline = {"config": config, "results": {}}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding="utf-8") as f:
+                baseline = json.load(f)
+        baseline["config"] = config
+        baseline["results"].update(results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, ensure_ascii=False, indent=2)
+        print(f"\n基準値を保存しました: {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        return
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline.get("config") != config:
+        print("\n注意: 基準値と条件（件数・遅延など）が異なります")
+    regressions = compare(results, baseline["results"], args.tolerance)
+    if regressions:
+        print(f"\n悪化したシナリオ: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,366 @@
+"""ベンチマーク用の国土地理院API・OpenAI APIの代役サーバー
+
+外部APIの代わりにローカルで応答を返し、応答時間を指定した遅延で再現する。
+
+    GET  /address-search/AddressSearch?q=...        住所検索
+    GET  /getelevation.php?lat=..&lon=..            標高API
+    GET  /raster/{レイヤーのパス}/{z}/{x}/{y}.png     ハザードマップタイル
+    GET  /dem_png/{z}/{x}/{y}.png                   標高タイル
+    POST /v1/chat/completions                       Chat Completions（stream=true はSSE）
+
+fixtures/gsi/ に記録済みの応答があればそれを返し（--record で本物のAPIから記録する）、
+なければ座標やクエリから決まる合成データを返すので、同じ入力には常に同じ応答になる。
+
+    python bench/stub_server.py --port 8900 --latency 0.05 --route-latency openai=0.8
+"""
+import argparse
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlparse
+from urllib.request import urlopen
+
+import numpy as np
+from PIL import Image
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+RECORDED_DIR = os.path.join(FIXTURES_DIR, "gsi")
+REGISTRY_RESPONSE_PATH = os.path.join(FIXTURES_DIR, "registry_response.json")
+
+# 記録するときの問い合わせ先（route → 本物のURLの先頭）
+UPSTREAMS = {
+    "address_search": "https://msearch.gsi.go.jp/address-search/AddressSearch",
+    "elevation": "https://cyberjapandata2.gsi.go.jp/general/dem/scripts/getelevation.php",
+    "hazard_tile": "https://disaportaldata.gsi.go.jp/raster",
+    "dem_tile": "https://cyberjapandata.gsi.go.jp/xyz/dem_png",
+}
+
+TILE_SIZE = 256
+# 合成するハザードタイルの凡例色（hazard_tiles.LAYERS の配色の一部）
+HAZARD_COLORS = [(247, 245, 169), (255, 216, 192), (255, 183, 183), (255, 145, 145), (255, 235, 0), (165, 0, 33)]
+
+_HAZARD_TILE_RE = re.compile(r"^/raster/(?P<path>[\w-]+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.png$")
+_DEM_TILE_RE = re.compile(r"^/dem_png/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.png$")
+_CHOME_RE = re.compile(r"^(.*?[都道府県].+?[市区町村].*?(?:\d+丁目|[^\d-]+))")
+
+
+def parse_latencies(spec):
+    """ "openai=0.8,hazard_tile=0.05" を route → 秒 の辞書にする"""
+    latencies = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        route, _, seconds = item.partition("=")
+        latencies[route.strip()] = float(seconds)
+    return latencies
+
+
+def _seed(*parts):
+    return int.from_bytes(hashlib.sha256(repr(parts).encode("utf-8")).digest()[:8], "big")
+
+
+def _png(array, mode):
+    buffer = io.BytesIO()
+    Image.fromarray(array, mode).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def synthetic_geocode(query):
+    """住所検索の合成応答（丁目までの候補と、入力どおりの候補を返す）"""
+    rng = random.Random(_seed("geocode", query))
+    lat = 35.55 + rng.random() * 0.25
+    lon = 139.60 + rng.random() * 0.30
+    match = _CHOME_RE.match(query)
+    titles = [match.group(1), query] if match and match.group(1) != query else [query]
+    return [
+        {
+            "geometry": {"coordinates": [round(lon + i * 1e-4, 6), round(lat + i * 1e-4, 6)], "type": "Point"},
+            "type": "Feature",
+            "properties": {"addressCode": "", "title": title},
+        }
+        for i, title in enumerate(titles)
+    ]
+
+
+def synthetic_elevation(lat, lon):
+    """標高APIの合成応答（湾岸ほど低い緩やかな起伏）"""
+    height = max(0.0, (lat - 35.55) * 400 + 8 * math.sin(lon * 300) + 4 * math.cos(lat * 500))
+    return {"elevation": round(height, 1), "hsrc": "5m（レーザ）"}
+
+
+@lru_cache(maxsize=4096)
+def synthetic_hazard_tile(path, z, x, y):
+    """ハザードタイルの合成画像（タイルの3割は区域を含まず404）"""
+    rng = np.random.default_rng(_seed("hazard", path, z, x, y))
+    if rng.random() < 0.3:
+        return None
+    rgba = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+    for _ in range(int(rng.integers(1, 6))):
+        top, left = rng.integers(0, TILE_SIZE, size=2)
+        height, width = rng.integers(16, 160, size=2)
+        rgba[top:top + height, left:left + width, :3] = HAZARD_COLORS[int(rng.integers(len(HAZARD_COLORS)))]
+        rgba[top:top + height, left:left + width, 3] = 255
+    return _png(rgba, "RGBA")
+
+
+@lru_cache(maxsize=1024)
+def synthetic_dem_tile(z, x, y):
+    """標高タイルの合成画像（PNG標高タイルの符号化で 0.01m 単位）"""
+    n = 2 ** z
+    rows, cols = np.mgrid[0:TILE_SIZE, 0:TILE_SIZE]
+    lon = (x + cols / TILE_SIZE) / n * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + rows / TILE_SIZE) / n))))
+    heights = np.maximum(0.0, (lat - 35.55) * 400 + 8 * np.sin(lon * 300) + 4 * np.cos(lat * 500))
+    value = np.round(heights * 100).astype(np.int64)
+    rgb = np.stack([(value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF], axis=-1).astype(np.uint8)
+    return _png(rgb, "RGB")
+
+
+def load_registry_response():
+    with open(REGISTRY_RESPONSE_PATH, encoding="utf-8") as f:
+        return f.read()
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, latency=0.0, route_latencies=None, jitter=0.0,
+                 chunk_delay=0.0, chunk_size=24, record=False):
+        super().__init__(server_address, StubRequestHandler)
+        self.latency = latency
+        self.route_latencies = route_latencies or {}
+        self.jitter = jitter
+        self.chunk_delay = chunk_delay
+        self.chunk_size = chunk_size
+        self.record = record
+        self.llm_response = load_registry_response()
+        self.request_counts = {}
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def wait(self, route):
+        """route ごとの遅延（+ 一様なゆらぎ）だけ待つ"""
+        with self._lock:
+            self.request_counts[route] = self.request_counts.get(route, 0) + 1
+        delay = self.route_latencies.get(route, self.latency)
+        if self.jitter:
+            delay += random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _recorded(route, name, fetch_url, server):
+    """記録済みの応答を返す（--record のときはなければ本物のAPIから取得して保存）"""
+    path = os.path.join(RECORDED_DIR, route, name)
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return f.read()
+    if not server.record:
+        return None
+    try:
+        with urlopen(fetch_url, timeout=10) as response:
+            body = response.read()
+    except OSError:
+        return None
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(body)
+    return body
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    # 接続を使い回すクライアント（requests.Session・httpx）と同じ条件で計測する
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+
+        if url.path == "/address-search/AddressSearch":
+            self.server.wait("address_search")
+            query = params.get("q", "")
+            body = _recorded(
+                "address_search", f"{quote(query, safe='')}.json",
+                f"{UPSTREAMS['address_search']}?q={quote(query)}", self.server,
+            )
+            if body is None:
+                body = json.dumps(synthetic_geocode(query), ensure_ascii=False).encode("utf-8")
+            self._send(200, body, "application/json")
+            return
+
+        if url.path == "/getelevation.php":
+            self.server.wait("elevation")
+            lat, lon = float(params.get("lat", 0)), float(params.get("lon", 0))
+            body = _recorded(
+                "elevation", f"{lat:.6f}_{lon:.6f}.json",
+                f"{UPSTREAMS['elevation']}?lon={lon}&lat={lat}&outtype=JSON", self.server,
+            )
+            if body is None:
+                body = json.dumps(synthetic_elevation(lat, lon)).encode("utf-8")
+            self._send(200, body, "application/json")
+            return
+
+        match = _HAZARD_TILE_RE.match(url.path)
+        if match:
+            self.server.wait("hazard_tile")
+            z, x, y = int(match["z"]), int(match["x"]), int(match["y"])
+            body = _recorded(
+                "hazard_tile", os.path.join(match["path"], str(z), str(x), f"{y}.png"),
+                f"{UPSTREAMS['hazard_tile']}/{match['path']}/{z}/{x}/{y}.png", self.server,
+            )
+            if body is None:
+                body = synthetic_hazard_tile(match["path"], z, x, y)
+            if body is None:
+                self._send(404, b"", "text/plain")
+            else:
+                self._send(200, body, "image/png", etag=hashlib.md5(body).hexdigest())
+            return
+
+        match = _DEM_TILE_RE.match(url.path)
+        if match:
+            self.server.wait("dem_tile")
+            z, x, y = int(match["z"]), int(match["x"]), int(match["y"])
+            body = _recorded(
+                "dem_tile", os.path.join(str(z), str(x), f"{y}.png"),
+                f"{UPSTREAMS['dem_tile']}/{z}/{x}/{y}.png", self.server,
+            ) or synthetic_dem_tile(z, x, y)
+            self._send(200, body, "image/png")
+            return
+
+        self._send(404, b"not found", "text/plain")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not url.path.endswith("/chat/completions"):
+            self._send(404, b"not found", "text/plain")
+            return
+
+        # 最初のトークンまでの待ち時間
+        self.server.wait("openai")
+        content = self.server.llm_response
+        model = request.get("model", "gpt-4o")
+        if not request.get("stream"):
+            body = {
+                "id": "chatcmpl-bench",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(content), "total_tokens": len(content)},
+            }
+            self._send(200, json.dumps(body, ensure_ascii=False).encode("utf-8"), "application/json")
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        size = self.server.chunk_size
+        deltas = [{"role": "assistant", "content": ""}]
+        deltas += [{"content": content[i:i + size]} for i in range(0, len(content), size)]
+        for i, delta in enumerate(deltas):
+            self._write_event(self._chunk(model, delta, None))
+            if i and self.server.chunk_delay:
+                time.sleep(self.server.chunk_delay)
+        self._write_event(self._chunk(model, {}, "stop"))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    @staticmethod
+    def _chunk(model, delta, finish_reason):
+        return {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    def _write_event(self, data):
+        self._write_chunk(f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send(self, status, body, content_type, etag=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if etag:
+            self.send_header("ETag", f'"{etag}"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(host="127.0.0.1", port=0, **options):
+    """別スレッドで代役サーバーを起動して返す（port=0 なら空いているポート）"""
+    server = StubServer((host, port), **options)
+    threading.Thread(target=server.serve_forever, name="stub-server", daemon=True).start()
+    return server
+
+
+def stub_environment(base_url):
+    """アプリの各モジュールが代役サーバーを向くための環境変数"""
+    return {
+        "GSI_ADDRESS_SEARCH_URL": f"{base_url}/address-search/AddressSearch",
+        "GSI_ELEVATION_URL": f"{base_url}/getelevation.php",
+        "HAZARD_TILE_BASE_URL": f"{base_url}/raster",
+        "DEM_TILE_URL": f"{base_url}/dem_png/{{z}}/{{x}}/{{y}}.png",
+        "OPENAI_BASE_URL": f"{base_url}/v1",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="国土地理院API・OpenAI APIの代役サーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.0, help="応答までの遅延（秒）")
+    parser.add_argument("--route-latency", default="", help="route ごとの遅延（例: openai=0.8,hazard_tile=0.05）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="遅延に加える一様なゆらぎの幅（秒）")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="ストリーミングのチャンク間隔（秒）")
+    parser.add_argument("--chunk-size", type=int, default=24, help="ストリーミングの1チャンクの文字数")
+    parser.add_argument("--record", action="store_true", help="記録済みでない応答を本物のAPIから取得して保存する")
+    args = parser.parse_args()
+
+    server = StubServer(
+        (args.host, args.port),
+        latency=args.latency,
+        route_latencies=parse_latencies(args.route_latency),
+        jitter=args.jitter,
+        chunk_delay=args.chunk_delay,
+        chunk_size=args.chunk_size,
+        record=args.record,
+    )
+    print(f"{server.url} で待ち受けています")
+    for name, value in stub_environment(server.url).items():
+        print(f"export {name}={value}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""複数の登記簿画像のまとめての抽出
+
+書類一式（数十枚の登記簿画像）を並行にLLMへ送り、各書類から取り出した住所を
+正規化した表記で1つの重複のない住所表にまとめ、ジオコーディングまで行う。
+LLMへの送信は llm_extraction の1分あたりのトークン数・リクエスト数の上限に収まるよう待ち合わせる。
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import core
+import metrics
+from address_normalizer import normalize_address
+from llm_extraction import extract_data_from_response, extract_registry
+
+EXTRACTION_CONCURRENCY = int(os.getenv("EXTRACTION_CONCURRENCY", "8"))
+
+
+def extract_document(name, image_bytes):
+    """1つの書類から住所と土地情報を抽出（エラーも結果として返す）"""
+    try:
+        result = extract_registry(image_bytes)
+    except Exception as e:
+        return {"name": name, "addresses": [], "land_info": None, "cached": False, "error": str(e)}
+    addresses, land_info = extract_data_from_response(result["response"])
+    # 打ち切られた応答から読み取れた住所は残し、失敗として知らせる
+    error = None if result["complete"] else "AIの応答が途中で打ち切られました"
+    return {"name": name, "addresses": addresses, "land_info": land_info, "cached": result["cached"], "error": error}
+
+
+def extract_documents(documents, concurrency=EXTRACTION_CONCURRENCY, on_progress=None):
+    """(ファイル名, 画像バイト列) のリストを並行に抽出し、入力と同じ順の結果を返す
+
+    on_progress(done, total) は1件終わるごとに呼び出し元のスレッドで呼ばれる。
+    """
+    results = [None] * len(documents)
+    with metrics.span("bundle_extraction") as span:
+        span.add_bytes(sum(len(image_bytes) for _, image_bytes in documents))
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="extract") as executor:
+            futures = {
+                executor.submit(extract_document, name, image_bytes): i
+                for i, (name, image_bytes) in enumerate(documents)
+            }
+            for done, future in enumerate(as_completed(futures), start=1):
+                results[futures[future]] = future.result()
+                if on_progress:
+                    on_progress(done, len(documents))
+    return results
+
+
+def merge_addresses(results):
+    """書類ごとの住所を正規化した表記で重複なくまとめる（どの書類に出てきたかも残す）"""
+    table = {}
+    for result in results:
+        for address in result["addresses"]:
+            key = normalize_address(address)
+            row = table.setdefault(key, {"address": key, "documents": []})
+            if result["name"] not in row["documents"]:
+                row["documents"].append(result["name"])
+    return list(table.values())
+
+
+def _locate(row):
+    try:
+        location = core.geocode_address(row["address"])
+    except Exception as e:
+        return {**row, "error": str(e)}
+    if location is None:
+        return {**row, "error": "住所が見つかりませんでした"}
+    return {
+        **row,
+        "title": location["title"],
+        "lat": location["lat"],
+        "lon": location["lon"],
+        "confidence": location["confidence"],
+        "error": None,
+    }
+
+
+def geocode_table(rows, concurrency=EXTRACTION_CONCURRENCY):
+    """住所表の各行に緯度経度を加える"""
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="extract-geocode") as executor:
+        return list(executor.map(_locate, rows))
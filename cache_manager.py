@@ -0,0 +1,239 @@
+"""名前つきの共有キャッシュとメモリの上限
+
+住所の候補・ハザード判定・LLMの抽出結果・地図のHTMLなど、処理段階ごとのメモ化を
+名前つきのキャッシュで管理する。値は pickle したバイト列（大きいものは zlib で圧縮）で持ち、
+キャッシュごとのバイト数の上限を超えたら最も古く使われたものから捨てるので、
+利用者が増えてもプロセスのメモリは上限の合計で頭打ちになる。
+キャッシュはプロセス内のすべてのセッション・APIリクエストで共有する。
+
+1点ごとの判定で毎回引くタイルのクラス配列や画素ごとの値は、復元の時間が問題になるので
+serialize=False のキャッシュにそのまま持つ（配列は nbytes で計上する）。
+
+上限は CACHE_BUDGETS="map_html=128MB,hazard=8MB" のように名前ごとに変えられる。
+"""
+import functools
+import os
+import pickle
+import re
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from http_client import coalesce
+
+# 名前ごとの上限の指定がないキャッシュの上限（バイト）
+DEFAULT_CACHE_BYTES = 16 * 1024 ** 2
+CACHE_BUDGETS = os.getenv("CACHE_BUDGETS", "")
+# これより大きい値は圧縮して持つ
+COMPRESS_THRESHOLD = int(os.getenv("CACHE_COMPRESS_THRESHOLD", "1024"))
+# キー・管理用の情報などバイト列以外にかかる1件あたりの目安
+ENTRY_OVERHEAD = 256
+# シリアライズしないキャッシュの1件あたりの目安（辞書の要素と管理用のタプル。キーと値は別に数える）
+RAW_ENTRY_OVERHEAD = 120
+
+DEFAULT_BUDGETS = {
+    "geocode": 8 * 1024 ** 2,
+    "hazard": 8 * 1024 ** 2,
+    "hazard_tiles": 64 * 1024 ** 2,
+    "llm": 16 * 1024 ** 2,
+    "documents": 32 * 1024 ** 2,
+    "map_html": 64 * 1024 ** 2,
+    "risk_surface": 32 * 1024 ** 2,
+}
+
+_SIZE_RE = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([KMG]?)B?\s*$", re.IGNORECASE)
+_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+_MISSING = object()
+
+
+def parse_size(text):
+    """ "64MB" や "512KB"、"1048576" をバイト数にする"""
+    match = _SIZE_RE.match(text)
+    if match is None:
+        raise ValueError(f"サイズの指定が不正です: {text}")
+    return int(float(match[1]) * _UNITS[match[2].upper()])
+
+
+def parse_budgets(spec):
+    """ "map_html=128MB,hazard=8MB" を 名前 → バイト数 の辞書にする"""
+    budgets = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, size = item.partition("=")
+        budgets[name.strip()] = parse_size(size)
+    return budgets
+
+
+_budgets = {**DEFAULT_BUDGETS, **parse_budgets(CACHE_BUDGETS)}
+
+
+class ManagedCache:
+    """バイト数の上限とTTLを持つスレッドセーフなLRUキャッシュ
+
+    serialize が真なら値をシリアライズして保持し、偽なら値をそのまま保持する
+    （取り出した値は共有されるので、呼び出し元で書き換えないこと）。
+    """
+
+    def __init__(self, name, max_bytes=DEFAULT_CACHE_BYTES, ttl=None, serialize=True):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.serialize = serialize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        # キー → (バイト列または値, 圧縮済みか（そのまま持つ値はNone）, 計上したバイト数, 保存時刻)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _encode(self, key, value):
+        """保持する形と計上するバイト数"""
+        if not self.serialize:
+            size = value.nbytes if hasattr(value, "nbytes") else sys.getsizeof(value)
+            return value, None, size + sys.getsizeof(key) + RAW_ENTRY_OVERHEAD
+        blob, compressed = self._pack(value)
+        return blob, compressed, len(blob) + ENTRY_OVERHEAD
+
+    @staticmethod
+    def _pack(value):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(blob) > COMPRESS_THRESHOLD:
+            compressed = zlib.compress(blob, 1)
+            if len(compressed) < len(blob):
+                return compressed, True
+        return blob, False
+
+    @staticmethod
+    def _decode(blob, compressed):
+        if compressed is None:
+            return blob
+        return pickle.loads(zlib.decompress(blob) if compressed else blob)
+
+    def _remove(self, key):
+        _, _, size, _ = self._data.pop(key)
+        self.bytes -= size
+
+    def get(self, key, default=None):
+        """値を取得（参照したエントリは最新扱いにする）"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            blob, compressed, _, stored_at = item
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+        # 復元はロックの外で行う（呼び出し元ごとに別のオブジェクトになる）
+        return self._decode(blob, compressed)
+
+    def put(self, key, value):
+        """値を保存し、上限を超えたら最も古いエントリから捨てる（上限より大きい値は保存しない）"""
+        blob, compressed, size = self._encode(key, value)
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            if size > self.max_bytes:
+                return False
+            self._data[key] = (blob, compressed, size, time.monotonic())
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+        return True
+
+    def get_or_compute(self, key, compute, cacheable=None):
+        """値があれば返し、なければ compute() で求めて保存する
+
+        同じキーの計算が実行中なら（別のセッションからでも）その結果を待って共有する。
+        cacheable(value) が偽になる値は保存しない。
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        def compute_and_store():
+            value = compute()
+            if cacheable is None or cacheable(value):
+                self.put(key, value)
+            return value
+
+        return coalesce(("cache", self.name, key), compute_and_store)
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """件数・バイト数・ヒット率などを返す"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._data),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+            "ttl": self.ttl,
+            "serialize": self.serialize,
+        }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(name, ttl=None, serialize=True):
+    """名前つきのキャッシュを取得（初回は CACHE_BUDGETS の上限で作る）"""
+    with _caches_lock:
+        cache = _caches.get(name)
+        if cache is None:
+            cache = _caches[name] = ManagedCache(name, _budgets.get(name, DEFAULT_CACHE_BYTES), ttl, serialize)
+        return cache
+
+
+def memoize(name, ttl=None, cacheable=None):
+    """関数の結果を名前つきのキャッシュに保存するデコレーター（引数はハッシュ可能であること）"""
+    def decorator(func):
+        cache = get_cache(name, ttl)
+        prefix = f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (prefix, args, tuple(sorted(kwargs.items())))
+            return cache.get_or_compute(key, lambda: func(*args, **kwargs), cacheable)
+
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+
+def cache_stats():
+    """すべての名前つきキャッシュの統計"""
+    with _caches_lock:
+        caches = dict(_caches)
+    return {name: cache.stats() for name, cache in sorted(caches.items())}
+
+
+def clear_caches(name=None):
+    """指定した（省略時はすべての）キャッシュを空にする"""
+    with _caches_lock:
+        caches = list(_caches.values()) if name is None else [_caches[name]] if name in _caches else []
+    for cache in caches:
+        cache.clear()
@@ -0,0 +1,106 @@
+"""住所 → 緯度経度 → ハザード情報のパイプライン
+
+Streamlitの画面とHTTP API（api_server.py）の両方から呼び出す。
+キャッシュはプロセス内で共有されるので、画面の再実行やAPIの同時リクエストで
+同じ処理を繰り返さない。
+"""
+import os
+
+from address_index import record_geocode
+from address_normalizer import normalize_address
+from cache_manager import get_cache
+from geocoding import LOW_CONFIDENCE_THRESHOLD, geocode, rank_candidates
+import hazard
+import metrics
+
+HAZARD_CACHE_TTL = int(os.getenv("HAZARD_CACHE_TTL", "3600"))
+
+# 容量の上限は cache_manager の CACHE_BUDGETS で決まる
+_hazard_cache = get_cache("hazard", ttl=HAZARD_CACHE_TTL)
+_candidate_cache = get_cache("geocode")
+
+
+def geocode_candidates(address):
+    """住所の検索結果を一致度の高い順に並べた候補のリスト（正規化した住所ごとにキャッシュ）"""
+    key = normalize_address(address)
+    candidates = _candidate_cache.get(key)
+    if candidates is None:
+        candidates = rank_candidates(address, geocode(address))
+        _candidate_cache.put(key, candidates)
+    return candidates
+
+
+def geocode_address(address, candidate_index=0):
+    """住所の緯度経度を取得（見つからなければNone）
+
+    一致度の最も高い候補を使う（candidate_index で別の候補を選べる）。
+    一致度が低いときは "low_confidence" が True になる。
+    """
+    candidates = geocode_candidates(address)
+    if not candidates:
+        return None
+    candidate = candidates[min(candidate_index, len(candidates) - 1)]
+    location = {
+        "address": address,
+        "normalized": normalize_address(address),
+        "title": candidate["title"],
+        "lat": candidate["lat"],
+        "lon": candidate["lon"],
+        "confidence": candidate["score"],
+        "low_confidence": candidate["score"] < LOW_CONFIDENCE_THRESHOLD,
+        "candidates": candidates,
+    }
+    # 次からは入力候補にも出す（確認が必要な結果は出さない）
+    if not location["low_confidence"]:
+        record_geocode(address, location["lat"], location["lon"])
+    return location
+
+
+def location_from_suggestion(suggestion):
+    """入力候補を geocode_address と同じ形にする（座標は候補のものを使い、APIは呼ばない）"""
+    candidate = {"title": suggestion["label"], "lat": suggestion["lat"], "lon": suggestion["lon"], "score": 1.0}
+    return {
+        "address": suggestion["label"],
+        "normalized": normalize_address(suggestion["label"]),
+        "title": suggestion["label"],
+        "lat": suggestion["lat"],
+        "lon": suggestion["lon"],
+        "confidence": 1.0,
+        "low_confidence": False,
+        "candidates": [candidate],
+    }
+
+
+def get_hazard_info(lat, lon):
+    """指定座標のハザード情報を取得（全項目そろった結果のみキャッシュ）
+
+    元データの同じ画素に入る座標は同じ結果になるので、画素単位でキャッシュを共有する。
+    """
+    key = hazard.cell_key(lat, lon)
+    with metrics.span("hazard") as span:
+        hazard_info = _hazard_cache.get(key)
+        if hazard_info is not None:
+            span.tag(cache="hit")
+            return hazard_info
+
+        span.tag(cache="miss")
+        hazard_info = hazard.assess_hazard(lat, lon)
+        if not hazard_info["degraded"]:
+            _hazard_cache.put(key, hazard_info)
+        return hazard_info
+
+
+def cache_stats():
+    """ハザード判定のキャッシュ統計（判定結果全体と項目ごと）"""
+    return {"hazard": _hazard_cache.stats(), "candidates": _candidate_cache.stats(), **hazard.cache_stats()}
+
+
+def assess_address(address):
+    """住所からハザード情報までをまとめて取得（住所が見つからなければNone）"""
+    location = geocode_address(address)
+    if location is None:
+        return None
+    return {
+        "location": location,
+        "hazard": get_hazard_info(location["lat"], location["lon"]),
+    }
@@ -0,0 +1,224 @@
+"""国土地理院 標高タイルによるローカル標高ストア
+
+標高タイル（PNG形式・テキスト形式）を取り込んで .npy として保存し、
+memory-map で開いた配列から多数の地点の標高を一括で引く。
+ローカルにタイルがない地点だけ getelevation.php に問い合わせる。
+
+    python elevation.py ingest <タイルのディレクトリ>
+    python elevation.py download <南端緯度> <西端経度> <北端緯度> <東端経度>
+"""
+import argparse
+import io
+import os
+import re
+import threading
+
+import numpy as np
+import requests
+from PIL import Image
+
+import metrics
+from cache_utils import LRUCache
+from http_client import coalesce, get_session
+from hazard_tiles import TILE_SIZE, latlon_to_tile_pixel, latlon_to_tile_pixels
+
+DEM_STORE_DIR = os.getenv("DEM_STORE_DIR", os.path.join(".cache", "dem"))
+DEM_ZOOM = int(os.getenv("DEM_ZOOM", "14"))
+DEM_TILE_URL = os.getenv("DEM_TILE_URL", "https://cyberjapandata.gsi.go.jp/xyz/dem_png/{z}/{x}/{y}.png")
+GSI_ELEVATION_URL = os.getenv(
+    "GSI_ELEVATION_URL", "https://cyberjapandata2.gsi.go.jp/general/dem/scripts/getelevation.php"
+)
+ELEVATION_TIMEOUT = float(os.getenv("ELEVATION_TIMEOUT", "5"))
+# 1回の呼び出しでリモートAPIに問い合わせる地点数の上限
+REMOTE_FALLBACK_LIMIT = int(os.getenv("ELEVATION_REMOTE_FALLBACK_LIMIT", "20"))
+
+_TILE_PATH_RE = re.compile(r"(\d+)[\\/](\d+)[\\/](\d+)\.(png|txt)$")
+
+# 開いたmemmapを保持（ファイルがないタイルはFalseを入れておく）
+_open_tiles = LRUCache(max_entries=512)
+
+
+def decode_png_tile(png_bytes):
+    """PNG標高タイルをfloat32配列に変換（無効値はNaN）
+
+    x = R*2^16 + G*2^8 + B として、x < 2^23 なら x*0.01m、
+    x = 2^23 は無効値、x > 2^23 なら (x - 2^24)*0.01m。
+    """
+    rgb = np.asarray(Image.open(io.BytesIO(png_bytes)).convert("RGB"), dtype=np.int64)
+    x = (rgb[:, :, 0] << 16) + (rgb[:, :, 1] << 8) + rgb[:, :, 2]
+    heights = np.where(x < 2 ** 23, x, x - 2 ** 24).astype(np.float32) * 0.01
+    heights[x == 2 ** 23] = np.nan
+    return heights
+
+
+def decode_text_tile(text):
+    """テキスト標高タイル（カンマ区切り256x256、無効値は"e"）をfloat32配列に変換"""
+    rows = [line.split(",") for line in text.strip().splitlines()]
+    return np.array(
+        [[np.nan if value == "e" else float(value) for value in row] for row in rows],
+        dtype=np.float32,
+    )
+
+
+def _store_path(z, x, y):
+    return os.path.join(DEM_STORE_DIR, str(z), str(x), f"{y}.npy")
+
+
+def ingest_tile(z, x, y, heights):
+    """標高配列をストアに保存（判定は DEM_ZOOM のタイルしか引かないので、それ以外のzは ValueError）"""
+    if z != DEM_ZOOM:
+        raise ValueError(f"ズームレベル {z} の標高タイルは使われません（DEM_ZOOM={DEM_ZOOM}）")
+    if heights.shape != (TILE_SIZE, TILE_SIZE):
+        raise ValueError(f"標高タイルの大きさが不正です: {heights.shape}")
+    path = _store_path(z, x, y)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, heights.astype(np.float32))
+    os.replace(tmp_path, path)
+    _open_tiles.put((z, x, y), None)
+
+
+def ingest_directory(src_dir):
+    """{z}/{x}/{y}.png または .txt の並びのディレクトリを取り込み、(取り込んだ件数, 読み飛ばした件数) を返す
+
+    DEM_ZOOM 以外のズームレベルのタイルは判定に使われないので読み飛ばす。
+    """
+    count = 0
+    skipped = 0
+    for root, _, files in os.walk(src_dir):
+        for name in files:
+            match = _TILE_PATH_RE.search(os.path.join(root, name))
+            if not match:
+                continue
+            z, x, y, ext = int(match[1]), int(match[2]), int(match[3]), match[4]
+            if z != DEM_ZOOM:
+                skipped += 1
+                continue
+            path = os.path.join(root, name)
+            if ext == "png":
+                with open(path, "rb") as f:
+                    heights = decode_png_tile(f.read())
+            else:
+                with open(path, encoding="utf-8") as f:
+                    heights = decode_text_tile(f.read())
+            ingest_tile(z, x, y, heights)
+            count += 1
+    return count, skipped
+
+
+def download_bbox(south, west, north, east, zoom=DEM_ZOOM):
+    """範囲内の標高タイルをダウンロードして取り込み、件数を返す"""
+    x0, y0, _, _ = latlon_to_tile_pixel(north, west, zoom)
+    x1, y1, _, _ = latlon_to_tile_pixel(south, east, zoom)
+    count = 0
+    for x in range(x0, x1 + 1):
+        for y in range(y0, y1 + 1):
+            response = get_session().get(DEM_TILE_URL.format(z=zoom, x=x, y=y), timeout=ELEVATION_TIMEOUT)
+            if response.status_code == 404:
+                # 海域などタイルが存在しない範囲
+                continue
+            response.raise_for_status()
+            ingest_tile(zoom, x, y, decode_png_tile(response.content))
+            count += 1
+    return count
+
+
+def _open_tile(z, x, y):
+    """ストアのタイルをmemmapで開く（なければNone）"""
+    tile = _open_tiles.get((z, x, y))
+    if tile is None:
+        path = _store_path(z, x, y)
+        tile = np.load(path, mmap_mode="r") if os.path.exists(path) else False
+        _open_tiles.put((z, x, y), tile)
+    return tile if tile is not False else None
+
+
+def _fetch_remote_elevation(lat, lon):
+    try:
+        with metrics.span("elevation_upstream") as span:
+            response = get_session().get(
+                GSI_ELEVATION_URL,
+                params={"lon": lon, "lat": lat, "outtype": "JSON"},
+                timeout=ELEVATION_TIMEOUT,
+            )
+            span.add_bytes(len(response.content))
+        response.raise_for_status()
+        return float(response.json()["elevation"])
+    except (requests.RequestException, KeyError, TypeError, ValueError):
+        # 海域などでは "-----" が返る
+        return float("nan")
+
+
+def fetch_remote_elevation(lat, lon):
+    """getelevation.php で1地点の標高を取得（取得できなければNaN）"""
+    return coalesce(("elevation", lat, lon), lambda: _fetch_remote_elevation(lat, lon))
+
+
+def elevations(lats, lons, allow_remote=True):
+    """複数地点の標高(m)を配列で返す
+
+    ローカルのタイル内でデータのない地点（海域など）はNaN。
+    タイル自体がない地点は allow_remote のときだけリモートAPIで補う。
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    lats, lons = np.broadcast_arrays(lats, lons)
+    tx, ty, px, py = latlon_to_tile_pixels(lats, lons, DEM_ZOOM)
+
+    result = np.full(lats.shape, np.nan, dtype=np.float32)
+    covered = np.zeros(lats.shape, dtype=bool)
+
+    # タイルごとにまとめて配列の添字で引く
+    tile_keys = tx * (2 ** DEM_ZOOM) + ty
+    unique_keys, inverse = np.unique(tile_keys, return_inverse=True)
+    inverse = inverse.reshape(lats.shape)
+    for i, key in enumerate(unique_keys):
+        tile = _open_tile(DEM_ZOOM, int(key // (2 ** DEM_ZOOM)), int(key % (2 ** DEM_ZOOM)))
+        if tile is None:
+            continue
+        mask = inverse == i
+        result[mask] = tile[py[mask], px[mask]]
+        covered[mask] = True
+
+    if allow_remote:
+        missing = np.argwhere(~covered)[:REMOTE_FALLBACK_LIMIT]
+        for index in map(tuple, missing):
+            result[index] = fetch_remote_elevation(float(lats[index]), float(lons[index]))
+
+    return result
+
+
+def elevation(lat, lon):
+    """1地点の標高(m)（取得できなければNaN）"""
+    return float(elevations([lat], [lon])[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="標高タイルをローカルストアに取り込む")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = subparsers.add_parser("ingest", help="ディレクトリ内のタイルを取り込む")
+    ingest_parser.add_argument("src_dir")
+
+    download_parser = subparsers.add_parser("download", help="範囲内のタイルをダウンロードする")
+    download_parser.add_argument("south", type=float)
+    download_parser.add_argument("west", type=float)
+    download_parser.add_argument("north", type=float)
+    download_parser.add_argument("east", type=float)
+    download_parser.add_argument("--zoom", type=int, default=DEM_ZOOM)
+
+    args = parser.parse_args()
+    if args.command == "ingest":
+        count, skipped = ingest_directory(args.src_dir)
+        if skipped:
+            print(f"警告: ズームレベルが {DEM_ZOOM} でない {skipped} タイルは使われないので読み飛ばしました")
+    else:
+        if args.zoom != DEM_ZOOM:
+            parser.error(f"--zoom は DEM_ZOOM（{DEM_ZOOM}）と同じにしてください。他のズームレベルのタイルは判定に使われません")
+        count = download_bbox(args.south, args.west, args.north, args.east, args.zoom)
+    print(f"{count} タイルを取り込みました")
+
+
+if __name__ == "__main__":
+    main()
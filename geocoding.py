@@ -0,0 +1,239 @@
+"""国土地理院ジオコーディングAPIの呼び出しと永続キャッシュ、検索結果の順位付け"""
+import difflib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import requests
+
+from address_normalizer import normalize_address, split_address
+import metrics
+from http_client import coalesce, get_session
+
+GSI_ADDRESS_SEARCH_URL = os.getenv(
+    "GSI_ADDRESS_SEARCH_URL", "https://msearch.gsi.go.jp/address-search/AddressSearch"
+)
+GEOCODE_TIMEOUT = float(os.getenv("GEOCODE_TIMEOUT", "5"))
+GEOCODE_CACHE_PATH = os.getenv("GEOCODE_CACHE_PATH", os.path.join(".cache", "geocode.sqlite3"))
+GEOCODE_CACHE_TTL = int(os.getenv("GEOCODE_CACHE_TTL", str(30 * 24 * 3600)))
+GEOCODE_CACHE_MAX_ENTRIES = int(os.getenv("GEOCODE_CACHE_MAX_ENTRIES", "20000"))
+# 最上位の候補の一致度がこれ未満なら確認を促す
+LOW_CONFIDENCE_THRESHOLD = float(os.getenv("GEOCODE_LOW_CONFIDENCE", "0.6"))
+
+# 一致度の内訳の重み（都道府県・市区町村・丁目番地の深さ・文字列の類似度）
+_SCORE_WEIGHTS = {"prefecture": 0.2, "municipality": 0.25, "depth": 0.25, "similarity": 0.3}
+_NUMBER_RE = re.compile(r"\d+")
+
+
+def normalize_address_key(address):
+    """キャッシュキー用に住所を正規化（数字・丁目番地・空白などの表記揺れを吸収）"""
+    return normalize_address(address)
+
+
+class GeocodeCache:
+    """SQLiteによるジオコーディング結果のキャッシュ（TTL + LRU）
+
+    プロセスを再起動しても結果が残るようディスク上に保存する。
+    hits / misses はこのインスタンスでの参照回数。
+    """
+
+    def __init__(self, path=GEOCODE_CACHE_PATH, ttl=GEOCODE_CACHE_TTL, max_entries=GEOCODE_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS geocode_cache (
+                key TEXT PRIMARY KEY,
+                address TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_geocode_cache_accessed ON geocode_cache (accessed_at)"
+        )
+        self._conn.commit()
+
+    def get(self, address, allow_stale=False):
+        """キャッシュ済みの検索結果を返す（なければNone）
+
+        期限切れのエントリはミス扱いだが、allow_stale のときは返す
+        （APIが使えないときの代わり。期限切れのエントリも件数上限で古い順に消える）。
+        """
+        key = normalize_address_key(address)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM geocode_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (now - row[1] > self.ttl and not allow_stale):
+                self.misses += 1
+                return None
+
+            self._conn.execute("UPDATE geocode_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, address, data):
+        """検索結果を保存し、上限を超えた分を古い順に削除"""
+        key = normalize_address_key(address)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO geocode_cache (key, address, response, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, address, json.dumps(data, ensure_ascii=False), now, now),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def entries(self):
+        """期限内のエントリを (住所, 検索結果) で順に返す"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT address, response FROM geocode_cache WHERE created_at >= ?", (time.time() - self.ttl,)
+            ).fetchall()
+        for address, response in rows:
+            yield address, json.loads(response)
+
+    def _evict(self):
+        """最終参照が古いエントリから削除してmax_entries以下に抑える"""
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM geocode_cache").fetchone()
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM geocode_cache WHERE key IN "
+                "(SELECT key FROM geocode_cache ORDER BY accessed_at ASC LIMIT ?)",
+                (overflow,),
+            )
+
+    def stats(self):
+        """ヒット数・ミス数・件数を返す"""
+        with self._lock:
+            (entries,) = self._conn.execute("SELECT COUNT(*) FROM geocode_cache").fetchone()
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": entries,
+        }
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_geocode_cache():
+    """プロセス内で共有するキャッシュを取得"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = GeocodeCache()
+    return _default_cache
+
+
+def _fetch(address):
+    with metrics.span("geocode_upstream") as span:
+        response = get_session().get(
+            GSI_ADDRESS_SEARCH_URL,
+            params={"q": address},
+            timeout=GEOCODE_TIMEOUT,
+        )
+        span.add_bytes(len(response.content))
+        response.raise_for_status()
+    data = response.json()
+    get_geocode_cache().put(address, data)
+    return data
+
+
+def geocode(address):
+    """住所から検索結果（GeoJSON Featureのリスト）を取得
+
+    キャッシュにあればAPIを呼ばずに返す。同じ住所の問い合わせが実行中なら結果を共有し、
+    APIが失敗したときは期限切れのキャッシュがあればそれを返す。
+    """
+    cache = get_geocode_cache()
+    with metrics.span("geocode") as span:
+        data = cache.get(address)
+        if data is not None:
+            span.tag(cache="hit")
+            return data
+
+        span.tag(cache="miss")
+        try:
+            return coalesce(("geocode", normalize_address_key(address)), lambda: _fetch(address))
+        except requests.RequestException:
+            stale = cache.get(address, allow_stale=True)
+            if stale is None:
+                raise
+            span.tag(cache="stale")
+            return stale
+
+
+def _part_score(query_part, candidate_part):
+    """住所の一部の一致（入力で省略されていれば中間の0.5）"""
+    if not query_part:
+        return 0.5
+    return 1.0 if query_part == candidate_part else 0.0
+
+
+def score_candidate(normalized, title):
+    """正規化した入力住所に対する候補の一致度（0〜1）"""
+    candidate = normalize_address(title)
+    query_prefecture, query_municipality, query_rest = split_address(normalized)
+    prefecture, municipality, rest = split_address(candidate)
+
+    # 丁目・番地・号の数字が先頭から何段目まで一致するか
+    query_numbers = _NUMBER_RE.findall(query_rest)
+    numbers = _NUMBER_RE.findall(rest)
+    matched = 0
+    for query_number, number in zip(query_numbers, numbers):
+        if query_number != number:
+            break
+        matched += 1
+    depth = matched / len(query_numbers) if query_numbers else 1.0
+
+    parts = {
+        "prefecture": _part_score(query_prefecture, prefecture),
+        "municipality": _part_score(query_municipality, municipality),
+        "depth": depth,
+        # 都道府県を省略した入力でも比べられるよう、入力と同じ範囲どうしで比べる
+        "similarity": difflib.SequenceMatcher(
+            None, normalized, candidate if query_prefecture else candidate[len(prefecture):]
+        ).ratio(),
+    }
+    return sum(_SCORE_WEIGHTS[name] * value for name, value in parts.items())
+
+
+def rank_candidates(address, data):
+    """検索結果を入力住所との一致度が高い順に並べた候補のリストにする"""
+    normalized = normalize_address(address)
+    candidates = [
+        {
+            "title": feature["properties"]["title"],
+            "lat": feature["geometry"]["coordinates"][1],
+            "lon": feature["geometry"]["coordinates"][0],
+            "score": round(score_candidate(normalized, feature["properties"]["title"]), 3),
+        }
+        for feature in data
+    ]
+    # 同点なら検索結果の順を保つ
+    candidates.sort(key=lambda candidate: candidate["score"], reverse=True)
+    return candidates
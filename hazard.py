@@ -0,0 +1,143 @@
+"""指定座標のハザード情報の判定
+
+洪水・土砂災害・津波の各項目を独立した取得関数として並行に実行する。
+取得関数ごとに期限を設け、期限内に終わらなかった項目は「不明」のまま
+degraded として返すので、遅い外部APIが1つあっても全体は待たされない。
+"""
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import requests
+
+import elevation as dem
+import hazard_tiles
+import metrics
+from spatial_cache import GridCache, cell_of
+
+HAZARD_FETCH_WORKERS = int(os.getenv("HAZARD_FETCH_WORKERS", "16"))
+# 各項目の期限は実行が始まってから数える。混雑で実行を待つのはこの秒数まで
+HAZARD_QUEUE_TIMEOUT = float(os.getenv("HAZARD_QUEUE_TIMEOUT", "10"))
+# 津波浸水想定区域外での標高による簡易判定の境界（m）
+TSUNAMI_HIGH_ELEVATION = 5
+TSUNAMI_MEDIUM_ELEVATION = 10
+
+_executor = ThreadPoolExecutor(max_workers=HAZARD_FETCH_WORKERS, thread_name_prefix="hazard")
+
+# 元データの値が変わる単位（各レイヤー・標高タイルの画素）ごとに途中結果をキャッシュする
+_class_caches = {layer: GridCache(layer, info["zoom"]) for layer, info in hazard_tiles.LAYERS.items()}
+_elevation_cache = GridCache("elevation", dem.DEM_ZOOM)
+
+
+def _unknown():
+    return {"level": "不明", "detail": "データなし"}
+
+
+def _sample_class(layer, lat, lon):
+    return _class_caches[layer].get_or_compute(
+        lat, lon, lambda lat, lon: hazard_tiles.sample_class(layer, lat, lon)
+    )
+
+
+def _elevation(lat, lon):
+    # 取得に失敗した（NaN）ときは次回また取得し直す
+    return _elevation_cache.get_or_compute(lat, lon, dem.elevation, cacheable=lambda value: not math.isnan(value))
+
+
+def _fetch_tile_layer(layer, lat, lon):
+    level, detail = hazard_tiles.classify(layer, _sample_class(layer, lat, lon))
+    return {"level": level, "detail": detail}
+
+
+def fetch_flood(lat, lon):
+    """洪水浸水想定区域のタイルから判定"""
+    return _fetch_tile_layer("flood", lat, lon)
+
+
+def fetch_landslide(lat, lon):
+    """土砂災害警戒区域のタイルから判定"""
+    return _fetch_tile_layer("landslide", lat, lon)
+
+
+def fetch_tsunami(lat, lon):
+    """津波浸水想定のタイルから判定し、区域外かタイルを取得できなければ標高で簡易判定"""
+    try:
+        class_id = _sample_class("tsunami", lat, lon)
+    except (requests.RequestException, OSError, ValueError):
+        class_id = 0
+    if class_id != 0:
+        level, detail = hazard_tiles.classify("tsunami", class_id)
+        return {"level": level, "detail": detail}
+
+    elevation = _elevation(lat, lon)
+    if math.isnan(elevation):
+        return _unknown()
+    # 簡易的な津波リスク判定
+    if elevation < TSUNAMI_HIGH_ELEVATION:
+        return {"level": "高い", "detail": f"標高 {elevation:.1f}m（沿岸低地）"}
+    elif elevation < TSUNAMI_MEDIUM_ELEVATION:
+        return {"level": "中程度", "detail": f"標高 {elevation:.1f}m"}
+    return {"level": "低い", "detail": f"標高 {elevation:.1f}m"}
+
+
+# 項目名 → (取得関数, 期限[秒])。項目を増やすときはここに追加する
+FETCHERS = {
+    "flood": (fetch_flood, float(os.getenv("HAZARD_FLOOD_TIMEOUT", "4"))),
+    "landslide": (fetch_landslide, float(os.getenv("HAZARD_LANDSLIDE_TIMEOUT", "4"))),
+    "tsunami": (fetch_tsunami, float(os.getenv("HAZARD_TSUNAMI_TIMEOUT", "6"))),
+}
+
+
+def cell_key(lat, lon):
+    """判定結果が同じになる範囲を表すキー（使っている元データの各解像度での画素）"""
+    zooms = sorted({cache.zoom for cache in (*_class_caches.values(), _elevation_cache)})
+    return tuple(cell_of(lat, lon, zoom) for zoom in zooms)
+
+
+def cache_stats():
+    """項目ごとの空間キャッシュの統計"""
+    stats = {f"{layer}_class": cache.stats() for layer, cache in _class_caches.items()}
+    stats["elevation"] = _elevation_cache.stats()
+    return stats
+
+
+def _timed(name, fetcher, lat, lon, started):
+    started["at"] = time.monotonic()
+    started["event"].set()
+    with metrics.span("hazard_fetch", item=name):
+        return fetcher(lat, lon)
+
+
+def assess_hazard(lat, lon):
+    """全項目を並行に判定してハザード情報を返す
+
+    期限は各項目の実行が始まってから数える（混雑で HAZARD_QUEUE_TIMEOUT 秒以上
+    実行を待った項目も期限切れとする）。期限切れ・エラーになった項目は "status" が
+    "timeout" / "error" になり、結果全体の "degraded" が True になる。
+    """
+    submitted = time.monotonic()
+    futures = {}
+    for name, (fetcher, timeout) in FETCHERS.items():
+        started = {"event": threading.Event(), "at": None}
+        futures[name] = (_executor.submit(_timed, name, fetcher, lat, lon, started), timeout, started)
+
+    hazard_info = {"degraded": False}
+    for name, (future, timeout, started) in futures.items():
+        try:
+            if not started["event"].wait(max(0.0, submitted + HAZARD_QUEUE_TIMEOUT - time.monotonic())):
+                future.cancel()
+                raise TimeoutError
+            remaining = max(0.0, started["at"] + timeout - time.monotonic())
+            result = future.result(timeout=remaining)
+            result["status"] = "ok"
+        except TimeoutError:
+            # 取得は裏で続き、結果はタイル等のキャッシュに残る
+            result = {"level": "不明", "detail": "応答待ちタイムアウト", "status": "timeout"}
+        except Exception:
+            result = {**_unknown(), "status": "error"}
+        if result["status"] != "ok":
+            hazard_info["degraded"] = True
+        hazard_info[name] = result
+    return hazard_info
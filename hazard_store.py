@@ -0,0 +1,392 @@
+"""都道府県単位でオフラインに持つハザード区分ラスタ
+
+洪水・津波・土砂災害のタイルを固定のズームレベルで取り込み、凡例クラス番号の
+ラスタとしてディスクに保存する。判定時はmemmapで開き、ネットワークを使わずに
+1地点をO(1)で引く。
+
+ファイル構成（{HAZARD_STORE_DIR}/{版}/）:
+    manifest.json       ズームレベル・取り込んだ範囲
+    {layer}.tiles.npy   タイル範囲の密な索引（int32。0以上はブロック表の行、
+                        EMPTY_TILE は全て区域外、NOT_COVERED は取り込んでいない範囲）
+    {layer}.blocks.npy  タイルごとに16x16画素のブロック256個の表（int32。負の値 -(c+1) は
+                        全画素がクラスcのブロック、0以上はブロックデータの番号）
+    {layer}.data.npy    一様でないブロックの画素（uint8、ブロック数 x 16 x 16）
+
+新しい版は別のディレクトリに作り終えてから CURRENT ファイルの版名を置き換えるので、
+判定中のプロセスが作りかけのデータを見ることはない。
+
+    python hazard_store.py ingest --prefecture 東京都 --prefecture 神奈川県
+    python hazard_store.py ingest --bbox 35.5 139.5 35.8 139.9 --source path/to/raster
+"""
+import argparse
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import hazard_tiles
+import tile_proxy
+
+HAZARD_STORE_DIR = os.getenv("HAZARD_STORE_DIR", os.path.join(".cache", "hazard_store"))
+# CURRENT の変更を確認する間隔（秒）
+HAZARD_STORE_RELOAD_INTERVAL = float(os.getenv("HAZARD_STORE_RELOAD_INTERVAL", "60"))
+HAZARD_STORE_WORKERS = int(os.getenv("HAZARD_STORE_WORKERS", "8"))
+# 一度にスレッドプールへ渡すタイル数（ワーカー1つあたり）。都道府県全体のタイルを一度に積まない
+INGEST_CHUNK_PER_WORKER = 16
+
+BLOCK_SIZE = 16
+_BLOCKS_PER_SIDE = hazard_tiles.TILE_SIZE // BLOCK_SIZE
+EMPTY_TILE = -1
+NOT_COVERED = -2
+
+# 都道府県の概略の範囲（南端緯度, 西端経度, 北端緯度, 東端経度）。
+# 本土・主要な島の範囲で、遠く離れた離島は含まない（必要なら --bbox で追加する）
+PREFECTURE_BBOXES = {
+    "北海道": (41.35, 139.33, 45.56, 145.82),
+    "青森県": (40.22, 139.49, 41.56, 141.69),
+    "岩手県": (38.74, 140.65, 40.45, 142.08),
+    "宮城県": (37.77, 140.27, 39.00, 141.68),
+    "秋田県": (38.87, 139.69, 40.52, 140.99),
+    "山形県": (37.73, 139.52, 39.21, 140.65),
+    "福島県": (36.79, 139.16, 37.98, 141.05),
+    "茨城県": (35.74, 139.69, 36.95, 140.85),
+    "栃木県": (36.20, 139.33, 37.16, 140.30),
+    "群馬県": (35.98, 138.40, 37.06, 139.67),
+    "埼玉県": (35.75, 138.71, 36.29, 139.91),
+    "千葉県": (34.90, 139.74, 36.11, 140.88),
+    "東京都": (35.50, 138.94, 35.90, 139.92),
+    "神奈川県": (35.13, 138.91, 35.67, 139.80),
+    "新潟県": (36.74, 137.62, 38.56, 139.91),
+    "富山県": (36.27, 136.77, 36.99, 137.76),
+    "石川県": (36.07, 136.24, 37.86, 137.37),
+    "福井県": (35.34, 135.45, 36.30, 136.83),
+    "山梨県": (35.17, 138.18, 35.97, 139.13),
+    "長野県": (35.20, 137.32, 37.03, 138.74),
+    "岐阜県": (35.13, 136.28, 36.47, 137.65),
+    "静岡県": (34.57, 137.47, 35.65, 139.18),
+    "愛知県": (34.57, 136.67, 35.42, 137.84),
+    "三重県": (33.72, 135.85, 35.26, 136.99),
+    "滋賀県": (34.79, 135.76, 35.70, 136.46),
+    "京都府": (34.71, 134.85, 35.78, 136.06),
+    "大阪府": (34.27, 135.09, 35.05, 135.75),
+    "兵庫県": (34.15, 134.25, 35.68, 135.47),
+    "奈良県": (33.86, 135.54, 34.78, 136.23),
+    "和歌山県": (33.43, 135.06, 34.39, 136.01),
+    "鳥取県": (35.05, 133.13, 35.62, 134.52),
+    "島根県": (34.30, 131.67, 35.60, 133.39),
+    "岡山県": (34.30, 133.27, 35.35, 134.41),
+    "広島県": (34.03, 132.04, 35.11, 133.48),
+    "山口県": (33.71, 130.77, 34.80, 132.49),
+    "徳島県": (33.54, 133.66, 34.25, 134.82),
+    "香川県": (34.01, 133.45, 34.56, 134.45),
+    "愛媛県": (32.88, 132.01, 34.30, 133.69),
+    "高知県": (32.70, 132.48, 33.88, 134.31),
+    "福岡県": (33.00, 129.99, 33.96, 131.19),
+    "佐賀県": (32.95, 129.73, 33.62, 130.55),
+    "長崎県": (32.57, 128.59, 34.73, 130.39),
+    "熊本県": (32.09, 129.94, 33.20, 131.33),
+    "大分県": (32.71, 130.81, 33.74, 132.10),
+    "宮崎県": (31.35, 130.70, 32.84, 131.89),
+    "鹿児島県": (30.95, 129.95, 32.22, 131.21),
+    "沖縄県": (26.07, 127.63, 26.88, 128.33),
+}
+
+_store = None
+_store_version = None
+_checked_at = 0.0
+_store_lock = threading.Lock()
+
+
+def tile_range(south, west, north, east, zoom):
+    """範囲を覆うタイル座標の範囲 (x0, y0, x1, y1)（両端を含む）"""
+    x0, y0, _, _ = hazard_tiles.latlon_to_tile_pixel(north, west, zoom)
+    x1, y1, _, _ = hazard_tiles.latlon_to_tile_pixel(south, east, zoom)
+    return x0, y0, x1, y1
+
+
+def encode_tile(classes):
+    """クラス配列を (ブロック表, 一様でないブロックの配列) にする
+
+    ブロック表の0以上の値は、一様でないブロックの配列の中での番号。
+    """
+    blocks = classes.reshape(_BLOCKS_PER_SIDE, BLOCK_SIZE, _BLOCKS_PER_SIDE, BLOCK_SIZE).swapaxes(1, 2)
+    blocks = blocks.reshape(-1, BLOCK_SIZE, BLOCK_SIZE)
+    first = blocks[:, 0, 0]
+    uniform = (blocks == first[:, None, None]).all(axis=(1, 2))
+    table = np.where(uniform, -(first.astype(np.int32) + 1), 0).astype(np.int32)
+    table[~uniform] = np.arange(np.count_nonzero(~uniform), dtype=np.int32)
+    return table, blocks[~uniform]
+
+
+class HazardStore:
+    """取り込み済みの版をmemmapで開いたもの"""
+
+    def __init__(self, path):
+        with open(os.path.join(path, "manifest.json"), encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        self.zoom = self.manifest["zoom"]
+        self._layers = {}
+        for layer, info in self.manifest["layers"].items():
+            self._layers[layer] = (
+                info["x0"],
+                info["y0"],
+                np.load(os.path.join(path, f"{layer}.tiles.npy"), mmap_mode="r"),
+                np.load(os.path.join(path, f"{layer}.blocks.npy"), mmap_mode="r"),
+                np.load(os.path.join(path, f"{layer}.data.npy"), mmap_mode="r"),
+            )
+
+    def _tile_entry(self, layer, x, y):
+        if layer not in self._layers:
+            return None, NOT_COVERED
+        x0, y0, tiles, blocks, data = self._layers[layer]
+        col, row = x - x0, y - y0
+        if not (0 <= row < tiles.shape[0] and 0 <= col < tiles.shape[1]):
+            return None, NOT_COVERED
+        return self._layers[layer], int(tiles[row, col])
+
+    def lookup(self, layer, x, y, px, py):
+        """1画素のクラス番号（取り込んでいない範囲はNone）"""
+        arrays, entry = self._tile_entry(layer, x, y)
+        if entry == NOT_COVERED:
+            return None
+        if entry == EMPTY_TILE:
+            return 0
+        _, _, _, blocks, data = arrays
+        block = int(blocks[entry, (py // BLOCK_SIZE) * _BLOCKS_PER_SIDE + px // BLOCK_SIZE])
+        if block < 0:
+            return -block - 1
+        return int(data[block, py % BLOCK_SIZE, px % BLOCK_SIZE])
+
+    def class_tile(self, layer, x, y):
+        """タイル全体のクラス配列（取り込んでいない範囲はNone）"""
+        arrays, entry = self._tile_entry(layer, x, y)
+        if entry == NOT_COVERED:
+            return None
+        size = hazard_tiles.TILE_SIZE
+        if entry == EMPTY_TILE:
+            return np.zeros((size, size), dtype=np.uint8)
+        _, _, _, blocks, data = arrays
+        table = np.asarray(blocks[entry])
+        uniform = table < 0
+        out = np.empty((len(table), BLOCK_SIZE, BLOCK_SIZE), dtype=np.uint8)
+        out[uniform] = (-table[uniform] - 1).astype(np.uint8)[:, None, None]
+        out[~uniform] = data[table[~uniform]]
+        out = out.reshape(_BLOCKS_PER_SIDE, _BLOCKS_PER_SIDE, BLOCK_SIZE, BLOCK_SIZE).swapaxes(1, 2)
+        return out.reshape(size, size)
+
+
+def _current_path():
+    return os.path.join(HAZARD_STORE_DIR, "CURRENT")
+
+
+def current_version():
+    """使用中の版の名前（なければNone）"""
+    try:
+        with open(_current_path(), encoding="utf-8") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def get_store():
+    """使用中の版を開いたストアを取得（取り込んでいなければNone）
+
+    CURRENT は一定間隔で確認し、版が切り替わっていれば開き直す。
+    """
+    global _store, _store_version, _checked_at
+    with _store_lock:
+        now = time.monotonic()
+        if now - _checked_at >= HAZARD_STORE_RELOAD_INTERVAL or _checked_at == 0.0:
+            _checked_at = now
+            version = current_version()
+            if version != _store_version:
+                try:
+                    _store = HazardStore(os.path.join(HAZARD_STORE_DIR, version)) if version else None
+                except (OSError, ValueError, KeyError):
+                    _store = None
+                _store_version = version
+    return _store
+
+
+def lookup(layer, lat, lon):
+    """ストアから指定座標のクラス番号を引く（ストアの範囲外ならNone）"""
+    store = get_store()
+    if store is None or store.zoom != hazard_tiles.LAYERS[layer]["zoom"]:
+        return None
+    return store.lookup(layer, *hazard_tiles.latlon_to_tile_pixel(lat, lon, store.zoom))
+
+
+def class_tile(layer, z, x, y):
+    """ストアからタイル全体のクラス配列を取り出す（ストアの範囲外ならNone）"""
+    store = get_store()
+    if store is None or store.zoom != z:
+        return None
+    return store.class_tile(layer, x, y)
+
+
+def _load_tile(layer, z, x, y, source_dir):
+    """取り込むタイルのクラス配列（データのないタイルはNone）"""
+    if source_dir:
+        path = os.path.join(source_dir, hazard_tiles.LAYERS[layer]["path"], str(z), str(x), f"{y}.png")
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return hazard_tiles.decode_tile(layer, f.read())
+    status, body = tile_proxy.get_tile(layer, z, x, y)
+    if status == 404:
+        return None
+    return hazard_tiles.decode_tile(layer, body)
+
+
+def _build_layer(layer, zoom, ranges, out_dir, source_dir, workers):
+    x0 = min(r[0] for r in ranges)
+    y0 = min(r[1] for r in ranges)
+    x1 = max(r[2] for r in ranges)
+    y1 = max(r[3] for r in ranges)
+    tiles = np.full((y1 - y0 + 1, x1 - x0 + 1), NOT_COVERED, dtype=np.int32)
+    keys = sorted({
+        (x, y)
+        for rx0, ry0, rx1, ry1 in ranges
+        for x in range(rx0, rx1 + 1)
+        for y in range(ry0, ry1 + 1)
+    })
+
+    tables = []
+    data = []
+    block_count = 0
+    chunk_size = max(1, workers * INGEST_CHUNK_PER_WORKER)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hazard-store") as executor:
+        for start in range(0, len(keys), chunk_size):
+            chunk = keys[start:start + chunk_size]
+            loaded = executor.map(lambda key: _load_tile(layer, zoom, key[0], key[1], source_dir), chunk)
+            for (x, y), classes in zip(chunk, loaded):
+                if classes is None or not classes.any():
+                    tiles[y - y0, x - x0] = EMPTY_TILE
+                    continue
+                table, blocks = encode_tile(classes)
+                table[table >= 0] += block_count
+                block_count += len(blocks)
+                tiles[y - y0, x - x0] = len(tables)
+                tables.append(table)
+                data.append(blocks)
+
+    block_table = np.stack(tables) if tables else np.zeros((0, _BLOCKS_PER_SIDE ** 2), dtype=np.int32)
+    block_data = np.concatenate(data) if data else np.zeros((0, BLOCK_SIZE, BLOCK_SIZE), dtype=np.uint8)
+    np.save(os.path.join(out_dir, f"{layer}.tiles.npy"), tiles)
+    np.save(os.path.join(out_dir, f"{layer}.blocks.npy"), block_table)
+    np.save(os.path.join(out_dir, f"{layer}.data.npy"), block_data)
+    return {"x0": x0, "y0": y0, "tiles": len(keys), "stored_tiles": len(tables), "blocks": block_count}
+
+
+def activate(version):
+    """使用する版を切り替える（CURRENT を一時ファイル経由で置き換える）"""
+    if not os.path.isdir(os.path.join(HAZARD_STORE_DIR, version)):
+        raise ValueError(f"版が見つかりません: {version}")
+    tmp_path = f"{_current_path()}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(tmp_path, _current_path())
+
+
+def ingest(bboxes, layers=None, zoom=None, source_dir=None, workers=HAZARD_STORE_WORKERS, names=()):
+    """範囲のタイルを取り込んで新しい版を作り、使用中の版を切り替えて版の名前を返す
+
+    source_dir を指定すると {source_dir}/{レイヤーのパス}/{z}/{x}/{y}.png から読み込み、
+    指定しなければタイルキャッシュ経由でダウンロードする。
+    判定はレイヤーごとのズームレベルのタイルしか引かないので、zoom がそれと違えば ValueError。
+    """
+    layers = layers or list(hazard_tiles.LAYERS)
+    zoom = zoom or hazard_tiles.LAYERS[layers[0]]["zoom"]
+    mismatched = [layer for layer in layers if hazard_tiles.LAYERS[layer]["zoom"] != zoom]
+    if mismatched:
+        raise ValueError(
+            f"ズームレベル {zoom} のタイルは判定に使われません: "
+            + "、".join(f"{layer}は{hazard_tiles.LAYERS[layer]['zoom']}" for layer in mismatched)
+        )
+    ranges = [tile_range(*bbox, zoom) for bbox in bboxes]
+
+    # 同じ秒に複数の取り込みを始めても版の名前が重ならないよう、時刻の後ろに乱数をつける
+    version = f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    out_dir = os.path.join(HAZARD_STORE_DIR, version)
+    tmp_dir = os.path.join(HAZARD_STORE_DIR, f".{version}.tmp")
+    os.makedirs(tmp_dir)
+    try:
+        manifest = {
+            "version": version,
+            "zoom": zoom,
+            "regions": list(names),
+            "bboxes": [list(bbox) for bbox in bboxes],
+            "created_at": time.time(),
+            "layers": {
+                layer: _build_layer(layer, zoom, ranges, tmp_dir, source_dir, workers)
+                for layer in layers
+            },
+        }
+        with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_dir, out_dir)
+    except BaseException:
+        # ダウンロードの失敗や中断で作りかけの版を残さない
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    activate(version)
+    return version
+
+
+def list_versions():
+    """取り込み済みの版の名前（古い順）"""
+    if not os.path.isdir(HAZARD_STORE_DIR):
+        return []
+    return sorted(
+        name for name in os.listdir(HAZARD_STORE_DIR)
+        if os.path.isfile(os.path.join(HAZARD_STORE_DIR, name, "manifest.json"))
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ハザードタイルをオフラインのストアに取り込む")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = subparsers.add_parser("ingest", help="都道府県・範囲のタイルを取り込んで新しい版を作る")
+    ingest_parser.add_argument("--prefecture", action="append", default=[], choices=list(PREFECTURE_BBOXES))
+    ingest_parser.add_argument(
+        "--bbox", action="append", default=[], nargs=4, type=float,
+        metavar=("SOUTH", "WEST", "NORTH", "EAST"),
+    )
+    ingest_parser.add_argument("--layer", action="append", choices=list(hazard_tiles.LAYERS))
+    ingest_parser.add_argument("--zoom", type=int)
+    ingest_parser.add_argument("--source", help="ダウンロードせずに読み込むタイルのディレクトリ")
+    ingest_parser.add_argument("--workers", type=int, default=HAZARD_STORE_WORKERS)
+
+    activate_parser = subparsers.add_parser("activate", help="使用する版を切り替える")
+    activate_parser.add_argument("version")
+
+    subparsers.add_parser("list", help="取り込み済みの版を一覧する")
+
+    args = parser.parse_args()
+    if args.command == "ingest":
+        bboxes = [PREFECTURE_BBOXES[name] for name in args.prefecture] + [tuple(bbox) for bbox in args.bbox]
+        if not bboxes:
+            parser.error("--prefecture か --bbox を指定してください")
+        names = args.prefecture + [",".join(map(str, bbox)) for bbox in args.bbox]
+        try:
+            version = ingest(bboxes, args.layer, args.zoom, args.source, args.workers, names)
+        except ValueError as e:
+            parser.error(str(e))
+        print(f"版 {version} を作成し、使用する版に切り替えました")
+    elif args.command == "activate":
+        activate(args.version)
+        print(f"版 {args.version} に切り替えました")
+    else:
+        current = current_version()
+        for version in list_versions():
+            print(f"{'*' if version == current else ' '} {version}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""ハザードマップタイルの画素値から災害リスクを判定する
+
+緯度経度をタイル座標・画素位置に変換し、タイル画像の色を凡例のクラスに対応付ける。
+デコード済みのクラス配列はメモリ（cache_manager の共有キャッシュ）とディスクの2段でキャッシュする。
+"""
+import io
+import math
+import os
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+from cache_manager import get_cache
+
+HAZARD_TILE_BASE_URL = os.getenv("HAZARD_TILE_BASE_URL", "https://disaportaldata.gsi.go.jp/raster")
+HAZARD_TILE_TIMEOUT = float(os.getenv("HAZARD_TILE_TIMEOUT", "5"))
+HAZARD_TILE_CACHE_DIR = os.getenv("HAZARD_TILE_CACHE_DIR", os.path.join(".cache", "hazard_tiles"))
+HAZARD_TILE_DISK_TTL = int(os.getenv("HAZARD_TILE_DISK_TTL", str(30 * 24 * 3600)))
+
+TILE_SIZE = 256
+# 凡例色との距離（RGBユークリッド）がこれを超える画素は境界のアンチエイリアス等とみなして無視
+COLOR_TOLERANCE = 40
+
+# 各レイヤーの定義（凡例はハザードマップポータルサイトの配色）
+LAYERS = {
+    "flood": {
+        "name": "洪水浸水想定区域",
+        "path": "01_flood_l2_shinsuishin_data",
+        "zoom": 16,
+        "legend": [
+            ((247, 245, 169), "浸水深 0.5m未満"),
+            ((255, 216, 192), "浸水深 0.5〜3m"),
+            ((255, 183, 183), "浸水深 3〜5m"),
+            ((255, 145, 145), "浸水深 5〜10m"),
+            ((242, 133, 201), "浸水深 10〜20m"),
+            ((220, 122, 220), "浸水深 20m以上"),
+        ],
+    },
+    "tsunami": {
+        "name": "津波浸水想定",
+        "path": "04_tsunami_newlegend_data",
+        "zoom": 16,
+        "legend": [
+            ((255, 255, 179), "浸水深 0.3m未満"),
+            ((247, 245, 169), "浸水深 0.3〜0.5m"),
+            ((248, 225, 166), "浸水深 0.5〜1m"),
+            ((255, 216, 192), "浸水深 1〜3m"),
+            ((255, 183, 183), "浸水深 3〜5m"),
+            ((255, 145, 145), "浸水深 5〜10m"),
+            ((242, 133, 201), "浸水深 10〜20m"),
+            ((220, 122, 220), "浸水深 20m以上"),
+        ],
+    },
+    "landslide": {
+        "name": "土砂災害警戒区域",
+        "path": "05_dosekiryukeikaikuiki",
+        "zoom": 16,
+        "legend": [
+            ((255, 235, 0), "土石流警戒区域"),
+            ((165, 0, 33), "土石流特別警戒区域"),
+        ],
+    },
+}
+
+# クラス番号 → リスクレベル（0は区域外）
+_LEVELS = {
+    "flood": {0: "低い", 1: "低い", 2: "中程度", 3: "高い", 4: "高い", 5: "高い", 6: "高い"},
+    "tsunami": {0: "低い", 1: "低い", 2: "低い", 3: "中程度", 4: "中程度", 5: "高い", 6: "高い", 7: "高い", 8: "高い"},
+    "landslide": {0: "低い", 1: "中程度", 2: "高い"},
+}
+
+_OUTSIDE_DETAIL = {
+    "flood": "浸水想定区域外",
+    "tsunami": "津波浸水想定区域外",
+    "landslide": "警戒区域外",
+}
+
+# 1点の判定ごとに引くので、デコード済みのクラス配列は復元なしでそのまま持つ
+_memory_cache = get_cache("hazard_tiles", serialize=False)
+
+
+def latlon_to_tile_pixel(lat, lon, zoom):
+    """緯度経度をWebメルカトルのタイル座標と画素位置に変換"""
+    n = 2 ** zoom
+    lat_rad = math.radians(lat)
+    world_x = (lon + 180.0) / 360.0 * n * TILE_SIZE
+    world_y = (1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n * TILE_SIZE
+    x, px = divmod(int(world_x), TILE_SIZE)
+    y, py = divmod(int(world_y), TILE_SIZE)
+    return x, y, px, py
+
+
+def latlon_to_tile_pixels(lats, lons, zoom):
+    """latlon_to_tile_pixel の配列版（タイル座標・画素位置をint64配列で返す）"""
+    n = 2 ** zoom
+    lat_rad = np.radians(np.asarray(lats, dtype=np.float64))
+    world_x = (np.asarray(lons, dtype=np.float64) + 180.0) / 360.0 * n * TILE_SIZE
+    world_y = (1.0 - np.arcsinh(np.tan(lat_rad)) / np.pi) / 2.0 * n * TILE_SIZE
+    world_x = world_x.astype(np.int64)
+    world_y = world_y.astype(np.int64)
+    return world_x // TILE_SIZE, world_y // TILE_SIZE, world_x % TILE_SIZE, world_y % TILE_SIZE
+
+
+def tile_url(layer, z, x, y):
+    return f"{HAZARD_TILE_BASE_URL}/{LAYERS[layer]['path']}/{z}/{x}/{y}.png"
+
+
+def decode_tile(layer, png_bytes):
+    """タイル画像を凡例クラス番号の配列（uint8, 256x256）に変換"""
+    rgba = np.asarray(Image.open(io.BytesIO(png_bytes)).convert("RGBA"), dtype=np.int16)
+    palette = np.array([color for color, _ in LAYERS[layer]["legend"]], dtype=np.int16)
+
+    # 各画素と凡例色の距離の二乗を計算し、最も近い色のクラスを割り当てる
+    diff = rgba[:, :, None, :3] - palette[None, None, :, :]
+    dist2 = (diff.astype(np.int32) ** 2).sum(axis=3)
+    nearest = dist2.argmin(axis=2)
+    matched = (rgba[:, :, 3] > 0) & (dist2.min(axis=2) <= COLOR_TOLERANCE ** 2)
+    return np.where(matched, nearest + 1, 0).astype(np.uint8)
+
+
+def _disk_path(layer, z, x, y):
+    return os.path.join(HAZARD_TILE_CACHE_DIR, layer, str(z), str(x), f"{y}.npy")
+
+
+def _load_from_disk(path):
+    try:
+        if time.time() - os.path.getmtime(path) > HAZARD_TILE_DISK_TTL:
+            return None
+        return np.load(path)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_to_disk(path, classes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # 書き込み途中のファイルを読まれないよう一時ファイル経由で置き換える（同じタイルを同時に保存するスレッドどうしで一時ファイルを分ける）
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, classes)
+    os.replace(tmp_path, path)
+
+
+def fetch_tile(layer, z, x, y):
+    """タイル画像を取得してクラス配列を返す（データのないタイルは全て0）"""
+    # tile_proxy はこのモジュールのレイヤー定義を使うので、循環しないよう呼び出し時に読み込む
+    import tile_proxy
+
+    # 地図表示と同じタイルキャッシュを経由して取得する
+    status, body = tile_proxy.get_tile(layer, z, x, y)
+    if status == 404:
+        # ハザード区域を含まないタイルは配信されない
+        return np.zeros((TILE_SIZE, TILE_SIZE), dtype=np.uint8)
+    return decode_tile(layer, body)
+
+
+def get_class_tile(layer, z, x, y):
+    """クラス配列をメモリ → オフラインのストア → ディスク → リモートの順に探して返す"""
+    # hazard_store もこのモジュールのレイヤー定義を使うので、循環しないよう呼び出し時に読み込む
+    import hazard_store
+
+    key = (layer, z, x, y)
+    classes = _memory_cache.get(key)
+    if classes is not None:
+        return classes
+
+    classes = hazard_store.class_tile(layer, z, x, y)
+    if classes is None:
+        path = _disk_path(layer, z, x, y)
+        classes = _load_from_disk(path)
+        if classes is None:
+            classes = fetch_tile(layer, z, x, y)
+            _save_to_disk(path, classes)
+
+    _memory_cache.put(key, classes)
+    return classes
+
+
+def sample_class(layer, lat, lon):
+    """指定座標の凡例クラス番号を返す（0は区域外）"""
+    import hazard_store
+
+    # オフラインのストアに取り込んだ範囲ならタイルを組み立てずに1画素だけ引く
+    class_id = hazard_store.lookup(layer, lat, lon)
+    if class_id is not None:
+        return class_id
+
+    z = LAYERS[layer]["zoom"]
+    x, y, px, py = latlon_to_tile_pixel(lat, lon, z)
+    return int(get_class_tile(layer, z, x, y)[py, px])
+
+
+def sample_classes(layer, lats, lons):
+    """sample_class の配列版（タイルごとにまとめて配列の添字で引く）"""
+    z = LAYERS[layer]["zoom"]
+    tx, ty, px, py = latlon_to_tile_pixels(lats, lons, z)
+    classes = np.zeros(tx.shape, dtype=np.uint8)
+
+    tile_keys = tx * (2 ** z) + ty
+    unique_keys, inverse = np.unique(tile_keys, return_inverse=True)
+    inverse = inverse.reshape(tx.shape)
+    for i, key in enumerate(unique_keys):
+        tile = get_class_tile(layer, z, int(key // (2 ** z)), int(key % (2 ** z)))
+        mask = inverse == i
+        classes[mask] = tile[py[mask], px[mask]]
+    return classes
+
+
+def level_table(layer):
+    """クラス番号を添字とするリスクレベルの一覧"""
+    return [_LEVELS[layer][class_id] for class_id in range(len(LAYERS[layer]["legend"]) + 1)]
+
+
+def classify(layer, class_id):
+    """クラス番号をリスクレベルと説明に変換"""
+    level = _LEVELS[layer][class_id]
+    if class_id == 0:
+        return level, _OUTSIDE_DETAIL[layer]
+    return level, LAYERS[layer]["legend"][class_id - 1][1]
+
+
+def cache_stats():
+    """メモリキャッシュの統計"""
+    return _memory_cache.stats()
@@ -0,0 +1,295 @@
+"""外部APIの呼び出しで共有するHTTPセッション
+
+全ての外部呼び出しはここを通し、次の仕組みを共有する。
+
+- ホストごとのkeep-alive接続プールと流量制限
+- 失敗時のジッター付き指数バックオフによる再試行
+- ホストごとのサーキットブレーカー（失敗が続いたホストへは一定時間すぐに失敗を返す）
+- 同じ内容の実行中の呼び出しの相乗り（coalesce）
+"""
+import os
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "16"))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "32"))
+# ホストごとの毎秒リクエスト数の上限（例: "msearch.gsi.go.jp=10,cyberjapandata2.gsi.go.jp=20"）
+HTTP_RATE_LIMITS = os.getenv("HTTP_RATE_LIMITS", "")
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "0.2"))
+HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "5"))
+# 連続してこの回数失敗したホストは CIRCUIT_RESET_TIMEOUT 秒間呼び出さない
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+
+# 再試行するステータス（混雑・一時的な障害）と、再送しても安全なメソッド
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class RateLimiter:
+    """トークンバケットによる流量制限（rate: 毎秒の上限、burst: 連続で許す回数）"""
+
+    def __init__(self, rate, burst=None):
+        if not rate > 0:
+            raise ValueError(f"流量制限は0より大きい値で指定してください: {rate}")
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """トークンがtokens個取れるまで待つ（burstを超える分はburstに切り詰める）"""
+        tokens = min(tokens, self.burst)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+_rate_limiters = {}
+
+
+def set_rate_limit(host, rate, burst=None):
+    """ホストごとの流量制限を設定（rateがNoneなら解除）"""
+    if rate is None:
+        _rate_limiters.pop(host, None)
+    else:
+        _rate_limiters[host] = RateLimiter(rate, burst)
+
+
+def parse_rate_limit(item):
+    """ "msearch.gsi.go.jp=10" を (ホスト, 毎秒の上限) にする（上限は0より大きいこと）"""
+    host, _, rate = item.partition("=")
+    try:
+        value = float(rate)
+    except ValueError:
+        value = None
+    if not host.strip() or value is None or not value > 0:
+        raise ValueError(f"流量制限の指定が不正です（ホスト=0より大きい毎秒の回数）: {item}")
+    return host.strip(), value
+
+
+def _load_rate_limits(spec):
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        set_rate_limit(*parse_rate_limit(item))
+
+
+_load_rate_limits(HTTP_RATE_LIMITS)
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """サーキットブレーカーが開いているホストへの呼び出し"""
+
+
+class CircuitBreaker:
+    """連続した失敗でホストへの呼び出しを止め、一定時間後に1件だけ試して再開する"""
+
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self._opened_at >= self.reset_timeout else "open"
+
+    def allow(self):
+        """呼び出してよいか（開いている間は、期限後の試しの1件だけを通す）"""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial or time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial = False
+
+    def release_trial(self):
+        """成否を判断できない終わり方（再試行の対象外の例外）をした試しの1件の枠を返す"""
+        with self._lock:
+            self._trial = False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(host):
+    """ホストごとのサーキットブレーカーを取得"""
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker()
+    return breaker
+
+
+def breaker_states():
+    """ホストごとのサーキットブレーカーの状態"""
+    with _breakers_lock:
+        return {host: breaker.state for host, breaker in _breakers.items()}
+
+
+def backoff_delay(attempt):
+    """attempt回目の再試行までの待ち時間（上限つき指数バックオフにフルジッターをかける）"""
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt))
+
+
+def call_with_retry(fn, host, retry_on, retries=HTTP_RETRIES):
+    """requests を使わない外部呼び出し（OpenAIなど）に再試行とサーキットブレーカーを適用する
+
+    ブレーカーには再試行を使い切った呼び出しを1回の失敗として数える。
+    """
+    breaker = get_breaker(host)
+    if not breaker.allow():
+        raise CircuitOpenError(f"{host} への呼び出しを一時停止しています")
+    settled = False
+    try:
+        for attempt in range(retries + 1):
+            try:
+                result = fn()
+            except retry_on:
+                if attempt == retries:
+                    breaker.record_failure()
+                    settled = True
+                    raise
+                time.sleep(backoff_delay(attempt))
+                continue
+            breaker.record_success()
+            settled = True
+            return result
+    finally:
+        # 再試行の対象外の例外で抜けたときも、試しの1件の枠を残したままにしない
+        if not settled:
+            breaker.release_trial()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """同じキーの処理が実行中なら新たに実行せず、その結果を待って共有する"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+_flights = SingleFlight()
+
+
+def coalesce(key, fn):
+    """同じキーで実行中の呼び出しがあれば相乗りする（別のセッション・スレッドからの同時呼び出しを1回にまとめる）"""
+    return _flights.do(key, fn)
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """宛先ホストの流量制限・サーキットブレーカー・再試行を適用するアダプタ"""
+
+    def send(self, request, **kwargs):
+        host = urlparse(request.url).hostname
+        breaker = get_breaker(host)
+        if not breaker.allow():
+            raise CircuitOpenError(f"{host} への呼び出しを一時停止しています", request=request)
+        retries = HTTP_RETRIES if request.method in IDEMPOTENT_METHODS else 0
+        settled = False
+        try:
+            for attempt in range(retries + 1):
+                limiter = _rate_limiters.get(host)
+                if limiter is not None:
+                    limiter.acquire()
+                try:
+                    response = super().send(request, **kwargs)
+                except (requests.ConnectionError, requests.Timeout):
+                    if attempt == retries:
+                        breaker.record_failure()
+                        settled = True
+                        raise
+                else:
+                    if response.status_code not in RETRY_STATUSES:
+                        breaker.record_success()
+                        settled = True
+                        return response
+                    if attempt == retries:
+                        breaker.record_failure()
+                        settled = True
+                        return response
+                    response.close()
+                time.sleep(backoff_delay(attempt))
+        finally:
+            # InvalidURL など再試行の対象外の例外で抜けたときも試しの1件の枠を返す
+            if not settled:
+                breaker.release_trial()
+
+
+def get_session():
+    """ホストごとにkeep-alive接続をプールするセッションを取得"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = RateLimitedAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+    return _session
@@ -0,0 +1,110 @@
+"""LLMに送る前の画像の前処理
+
+スマートフォンで撮影した登記簿の写真などは数MBになるため、
+余白の切り取り・縮小・グレースケール化・JPEG再圧縮でデータ量と
+画像トークン数を減らしてから送信する。縦に長いスキャン画像は分割する。
+"""
+import io
+import math
+import os
+
+from PIL import Image, ImageOps
+
+PREPROCESS_LONG_EDGE = int(os.getenv("IMAGE_PREPROCESS_LONG_EDGE", "2000"))
+PREPROCESS_JPEG_QUALITY = int(os.getenv("IMAGE_PREPROCESS_JPEG_QUALITY", "80"))
+PREPROCESS_GRAYSCALE = os.getenv("IMAGE_PREPROCESS_GRAYSCALE", "1") == "1"
+# 縦横比（高さ/幅）がこれを超える画像は分割して送る
+PREPROCESS_TILE_ASPECT = float(os.getenv("IMAGE_PREPROCESS_TILE_ASPECT", "2.0"))
+
+# これより明るい画素は余白とみなす
+MARGIN_THRESHOLD = 235
+MARGIN_PADDING = 16
+# 分割時の1枚あたりの縦横比と、つなぎ目の重なり
+TILE_SEGMENT_ASPECT = 1.4
+TILE_OVERLAP = 0.05
+
+# 前処理の設定が変わったらLLMのキャッシュも無効にするための識別子
+PREPROCESS_SIGNATURE = (
+    f"preprocess:v2:{PREPROCESS_LONG_EDGE}:{PREPROCESS_JPEG_QUALITY}:"
+    f"{int(PREPROCESS_GRAYSCALE)}:{PREPROCESS_TILE_ASPECT}"
+)
+
+
+def estimate_image_tokens(width, height):
+    """OpenAIのvision入力(detail=high)の画像トークン数を概算
+
+    2048px四方に収めた後、短辺768pxに縮小し、512pxタイル1枚あたり170トークン + 85。
+    """
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def crop_margins(image):
+    """白い余白を切り取る（内容が見つからなければそのまま返す）"""
+    gray = image.convert("L")
+    mask = gray.point(lambda v: 255 if v < MARGIN_THRESHOLD else 0)
+    bbox = mask.getbbox()
+    if bbox is None:
+        return image
+    left, top, right, bottom = bbox
+    return image.crop((
+        max(0, left - MARGIN_PADDING),
+        max(0, top - MARGIN_PADDING),
+        min(image.width, right + MARGIN_PADDING),
+        min(image.height, bottom + MARGIN_PADDING),
+    ))
+
+
+def split_tall_image(image):
+    """縦長の画像を少し重ねながら上から順に分割"""
+    if image.height / image.width <= PREPROCESS_TILE_ASPECT:
+        return [image]
+    # 幅が数画素の画像でも必ず下へ進むよう、1画素以上にする
+    segment_height = max(1, int(image.width * TILE_SEGMENT_ASPECT))
+    step = max(1, int(segment_height * (1 - TILE_OVERLAP)))
+    segments = []
+    top = 0
+    while True:
+        bottom = min(image.height, top + segment_height)
+        segments.append(image.crop((0, top, image.width, bottom)))
+        if bottom >= image.height:
+            break
+        top += step
+    return segments
+
+
+def _encode_jpeg(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=PREPROCESS_JPEG_QUALITY, optimize=True)
+    return buffer.getvalue()
+
+
+def preprocess_image(image_bytes):
+    """画像を前処理して送信用のJPEGのリストと削減量を返す"""
+    original = Image.open(io.BytesIO(image_bytes))
+    original_tokens = estimate_image_tokens(*original.size)
+
+    # 撮影時の向き情報を反映してから処理する
+    image = ImageOps.exif_transpose(original)
+    image = image.convert("L") if PREPROCESS_GRAYSCALE else image.convert("RGB")
+    image = crop_margins(image)
+
+    # 縦長のスキャンを先に縮小すると文字が潰れるので、分割してから1枚ずつ長辺を制限する
+    segments = split_tall_image(image)
+    for segment in segments:
+        if max(segment.size) > PREPROCESS_LONG_EDGE:
+            segment.thumbnail((PREPROCESS_LONG_EDGE, PREPROCESS_LONG_EDGE), Image.LANCZOS)
+    images = [("image/jpeg", _encode_jpeg(segment)) for segment in segments]
+    processed_bytes = sum(len(data) for _, data in images)
+    processed_tokens = sum(estimate_image_tokens(*segment.size) for segment in segments)
+
+    return {
+        "images": images,
+        "original_bytes": len(image_bytes),
+        "processed_bytes": processed_bytes,
+        "original_tokens": original_tokens,
+        "processed_tokens": processed_tokens,
+    }
@@ -0,0 +1,131 @@
+"""画像の内容ハッシュをキーにしたLLM抽出結果のディスクキャッシュ
+
+同じ登記簿画像が再アップロードされた場合や、別のユーザーが同じ書類を
+アップロードした場合に、LLM APIを呼ばずに前回の結果を返す。
+キーにはモデル名とプロンプトも含めるので、プロンプトを変えると自動的に無効になる。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", os.path.join(".cache", "llm"))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+LLM_CACHE_MAX_AGE = int(os.getenv("LLM_CACHE_MAX_AGE", str(90 * 24 * 3600)))
+
+
+def make_key(image_bytes, model, prompt):
+    """画像・モデル・プロンプトからキャッシュキーを作成"""
+    image_hash = hashlib.sha256(image_bytes).hexdigest()
+    prompt_hash = hashlib.sha256(f"{model}\n{prompt}".encode("utf-8")).hexdigest()
+    return hashlib.sha256(f"{image_hash}:{prompt_hash}".encode("ascii")).hexdigest()
+
+
+class ExtractionCache:
+    """抽出結果を1件1ファイルで保存するキャッシュ（容量上限と保存期間で削除）"""
+
+    def __init__(self, directory=LLM_CACHE_DIR, max_bytes=LLM_CACHE_MAX_BYTES, max_age=LLM_CACHE_MAX_AGE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        """キャッシュ済みのレスポンスを返す（なければNone）"""
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        if time.time() - entry["created_at"] > self.max_age:
+            self._remove(path)
+            self.misses += 1
+            return None
+
+        # 参照時刻を更新して容量超過時の削除順に反映させる
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return entry["response"]
+
+    def put(self, key, response, model=None):
+        """レスポンスを保存し、期限切れ・容量超過分を削除"""
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"created_at": time.time(), "model": model, "response": response}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        """保存期間を過ぎたものと、容量上限を超えた分を参照の古い順に削除"""
+        with self._lock:
+            now = time.time()
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                # 最終参照から保存期間を過ぎたものは作成からも過ぎているので削除してよい
+                if now - stat.st_mtime > self.max_age:
+                    self._remove(path)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                self._remove(path)
+                total -= size
+
+    def stats(self):
+        """ヒット数・ミス数・件数・使用量を返す"""
+        sizes = [
+            os.path.getsize(os.path.join(self.directory, name))
+            for name in os.listdir(self.directory)
+            if name.endswith(".json")
+        ]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(sizes),
+            "bytes": sum(sizes),
+        }
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_extraction_cache():
+    """プロセス内で共有するキャッシュを取得"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ExtractionCache()
+    return _default_cache
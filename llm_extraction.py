@@ -0,0 +1,497 @@
+"""登記簿画像からのLLMによる情報抽出
+
+gpt-4o にJSONスキーマで出力形式を固定した上でストリーミングで問い合わせ、
+届いた分から逐次JSONを解析して、所在や所有者住所などの住所項目を
+レスポンス全体を待たずに呼び出し元へ通知する。
+"""
+import base64
+import json
+import os
+import re
+from urllib.parse import urlparse
+
+import openai
+
+from address_normalizer import extract_addresses, unique_addresses
+from cache_manager import get_cache
+import metrics
+from http_client import RateLimiter, call_with_retry, coalesce
+from image_preprocess import PREPROCESS_SIGNATURE, preprocess_image
+from llm_cache import get_extraction_cache, make_key
+
+LLM_MODEL = "gpt-4o"
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+# 権利部の行が多い登記簿でもスキーマどおりのJSONを最後まで出せる長さにする
+LLM_MAX_TOKENS = int(os.getenv("LLM_MAX_TOKENS", "4096"))
+# 1分あたりのトークン数・リクエスト数の上限（複数の書類をまとめて送るときもこの中に収める）
+LLM_TPM = int(os.getenv("LLM_TPM", "30000"))
+LLM_RPM = int(os.getenv("LLM_RPM", "500"))
+# 再試行する例外（接続エラー・タイムアウト・混雑・サーバーエラー）
+LLM_RETRY_ERRORS = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+# 再試行は http_client.call_with_retry で行うので、SDK側では再試行しない
+openai.max_retries = 0
+
+_token_budget = RateLimiter(LLM_TPM / 60, burst=LLM_TPM)
+_request_budget = RateLimiter(LLM_RPM / 60, burst=LLM_RPM)
+LLM_SYSTEM_PROMPT = "あなたは日本の住所情報の抽出と分析を得意とするAIアシスタントです。画像ファイルの内容を読み取り、分析することができます。"
+LLM_EXTRACTION_PROMPT = """
+{
+ 'request': 'Extract the following information from the provided PDF document into a JSON format:',
+ 'fields': {
+  'document_type': 'The type of the document',
+  'sample_document': "Boolean indicating if it's a sample document ()",
+  'date_of_issue': 'The issue date of the document',
+  'issuing_office': 'The office that issued the document',
+  'registrar': 'The name of the registrar',
+  'management_number': 'The management number',
+  'disclaimer_underline': 'The disclaimer regarding underlined items',
+  'land_information': {
+   'real_estate_number': '不動産番号',
+   'location': '所在',
+   'lot_number': '地番',
+   'land_category': '地目',
+   'land_area_sqm': '地積 (m²)',
+   'cause_and_date': {
+    'cause': '原因',
+    'registration_date': '登記の日付'
+   },
+   'owner': {
+    'address': '所有者住所',
+    'name': '所有者名'
+   }
+  },
+  'rights_section_A_ownership': [
+   {
+    'sequence_number': '順位番号',
+    'purpose_of_registration': '登記の目的',
+    'reception_date_and_number': '受付年月日・受付番号',
+    'rights_holder_and_other_matters': {
+     'owner_address': '所有者住所',
+     'owner_name': '所有者名',
+     'cause': '原因',
+     'is_erased': '抹消事項であるか (boolean, 下線があればtrue)'
+    }
+   }
+  ],
+  'rights_section_B_other_rights': [
+   {
+    'sequence_number': '順位番号',
+    'purpose_of_registration': '登記の目的',
+    'reception_date_and_number': '受付年月日・受付番号',
+    'rights_holder_and_other_matters': {
+     'cause': '原因',
+     'debt_amount_yen': '債権額 (円)',
+     'interest_rate_annual_percent': '利息 (年率%)',
+     'damages_rate_annual_percent': '損害金 (年率%)',
+     'debtor': {
+      'address': '債務者住所',
+      'name': '債務者名'
+     },
+     'mortgage_holder': {
+      'address': '抵当権者住所',
+      'name': '抵当権者名',
+      'branch_name': '取扱店'
+     },
+     'joint_collateral_catalog_number': '共同担保目録番号',
+     'is_erased': '抹消事項であるか (boolean, 下線があればtrue)'
+    }
+   }
+  ],
+  'joint_collateral_catalog': {
+   'catalog_number': '共同担保目録の番号',
+   'prepared_date': '調製日',
+   'items': [
+    {
+     'number': '番号',
+     'description_of_right': '担保の目的である権利の表示',
+     'sequence_number': '順位番号',
+     'is_erased': '抹消事項であるか (boolean, 下線があればtrue)'
+    }
+   ]
+  }
+ }
+}
+"""
+
+
+def _nullable(type_name):
+    return {"type": [type_name, "null"]}
+
+
+def _object(properties):
+    # strictモードでは全項目をrequiredにし、余分な項目を禁止する必要がある
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+def _array(item):
+    return {"type": "array", "items": item}
+
+
+_STRING = _nullable("string")
+_BOOLEAN = _nullable("boolean")
+
+# LLM_EXTRACTION_PROMPT の項目構成と同じ形のスキーマ
+EXTRACTION_SCHEMA = _object({
+    "document_type": _STRING,
+    "sample_document": _BOOLEAN,
+    "date_of_issue": _STRING,
+    "issuing_office": _STRING,
+    "registrar": _STRING,
+    "management_number": _STRING,
+    "disclaimer_underline": _STRING,
+    "land_information": _object({
+        "real_estate_number": _STRING,
+        "location": _STRING,
+        "lot_number": _STRING,
+        "land_category": _STRING,
+        "land_area_sqm": _STRING,
+        "cause_and_date": _object({
+            "cause": _STRING,
+            "registration_date": _STRING,
+        }),
+        "owner": _object({
+            "address": _STRING,
+            "name": _STRING,
+        }),
+    }),
+    "rights_section_A_ownership": _array(_object({
+        "sequence_number": _STRING,
+        "purpose_of_registration": _STRING,
+        "reception_date_and_number": _STRING,
+        "rights_holder_and_other_matters": _object({
+            "owner_address": _STRING,
+            "owner_name": _STRING,
+            "cause": _STRING,
+            "is_erased": _BOOLEAN,
+        }),
+    })),
+    "rights_section_B_other_rights": _array(_object({
+        "sequence_number": _STRING,
+        "purpose_of_registration": _STRING,
+        "reception_date_and_number": _STRING,
+        "rights_holder_and_other_matters": _object({
+            "cause": _STRING,
+            "debt_amount_yen": _STRING,
+            "interest_rate_annual_percent": _STRING,
+            "damages_rate_annual_percent": _STRING,
+            "debtor": _object({
+                "address": _STRING,
+                "name": _STRING,
+            }),
+            "mortgage_holder": _object({
+                "address": _STRING,
+                "name": _STRING,
+                "branch_name": _STRING,
+            }),
+            "joint_collateral_catalog_number": _STRING,
+            "is_erased": _BOOLEAN,
+        }),
+    })),
+    "joint_collateral_catalog": _object({
+        "catalog_number": _STRING,
+        "prepared_date": _STRING,
+        "items": _array(_object({
+            "number": _STRING,
+            "description_of_right": _STRING,
+            "sequence_number": _STRING,
+            "is_erased": _BOOLEAN,
+        })),
+    }),
+})
+
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "registry_extraction", "strict": True, "schema": EXTRACTION_SCHEMA},
+}
+
+# 住所として扱う項目のパス（"*" は配列の添字）
+ADDRESS_PATHS = [
+    ("land_information", "location"),
+    ("land_information", "owner", "address"),
+    ("rights_section_A_ownership", "*", "rights_holder_and_other_matters", "owner_address"),
+    ("rights_section_B_other_rights", "*", "rights_holder_and_other_matters", "debtor", "address"),
+    ("rights_section_B_other_rights", "*", "rights_holder_and_other_matters", "mortgage_holder", "address"),
+]
+
+
+def is_address_path(path):
+    """JSON上のパスが住所項目かどうか"""
+    for pattern in ADDRESS_PATHS:
+        if len(pattern) == len(path) and all(
+            p == "*" and isinstance(k, int) or p == k for p, k in zip(pattern, path)
+        ):
+            return True
+    return False
+
+
+class IncrementalJSONParser:
+    """少しずつ届くJSON文字列を解析し、値が確定した項目を (パス, 値) で返す
+
+    パスはキー名と配列の添字のタプル。ルートの "{" より前の文字と、
+    ルートが閉じた後の文字は無視する。
+    """
+
+    _WHITESPACE = " \t\r\n"
+
+    def __init__(self):
+        # 各要素は [種類("object"/"array"), 現在のキーまたは添字]
+        self._stack = []
+        self._started = False
+        self._finished = False
+        self._in_string = False
+        self._escape = False
+        self._expect_key = False
+        self._raw = []
+        self._literal = []
+
+    @property
+    def finished(self):
+        """ルートのオブジェクトが閉じたか"""
+        return self._finished
+
+    def _path(self):
+        return tuple(entry[1] for entry in self._stack)
+
+    def _end_literal(self, events):
+        if not self._literal:
+            return
+        token = "".join(self._literal)
+        self._literal = []
+        events.append((self._path(), json.loads(token)))
+
+    def _end_string(self, events):
+        value = json.loads('"' + "".join(self._raw) + '"')
+        self._raw = []
+        if self._expect_key:
+            self._stack[-1][1] = value
+            self._expect_key = False
+        else:
+            events.append((self._path(), value))
+
+    def feed(self, chunk):
+        """文字列の断片を読み込み、確定した (パス, 値) のリストを返す"""
+        events = []
+        for ch in chunk:
+            if self._finished:
+                break
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                    self._raw.append(ch)
+                elif ch == "\\":
+                    self._escape = True
+                    self._raw.append(ch)
+                elif ch == '"':
+                    self._in_string = False
+                    self._end_string(events)
+                else:
+                    self._raw.append(ch)
+                continue
+
+            if not self._started:
+                if ch != "{":
+                    continue
+                self._started = True
+
+            if ch in self._WHITESPACE:
+                self._end_literal(events)
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                self._stack.append(["object", None])
+                self._expect_key = True
+            elif ch == "[":
+                self._stack.append(["array", 0])
+            elif ch == ":":
+                pass
+            elif ch == ",":
+                self._end_literal(events)
+                if self._stack[-1][0] == "object":
+                    self._expect_key = True
+                else:
+                    self._stack[-1][1] += 1
+            elif ch in "}]":
+                self._end_literal(events)
+                self._stack.pop()
+                self._expect_key = False
+                if not self._stack:
+                    self._finished = True
+            else:
+                self._literal.append(ch)
+        return events
+
+
+# ディスクのキャッシュの前段に置くメモリのキャッシュ（全セッションで共有）
+_response_cache = get_cache("llm")
+
+
+def _cache_key(image_bytes):
+    return make_key(image_bytes, LLM_MODEL, LLM_SYSTEM_PROMPT + LLM_EXTRACTION_PROMPT + PREPROCESS_SIGNATURE)
+
+
+def extract_registry(image_bytes, on_address=None):
+    """登記簿画像から情報を抽出する
+
+    on_address(address) はストリーミング中に住所項目が確定するたびに呼ばれる。
+    戻り値は {"response": JSON文字列, "cached": bool, "complete": bool, "preprocess": 前処理の統計またはNone}。
+    応答が上限の長さで打ち切られたなど、JSONが最後まで届かなかったときは complete が False になり、
+    結果はキャッシュしない（同じ画像を次にアップロードしたときにやり直せるように）。
+    """
+    # 同じ画像・プロンプトの結果があればAPIを呼ばずに返す（メモリ → ディスクの順に探す）
+    cache_key = _cache_key(image_bytes)
+    with metrics.span("llm_extraction") as span:
+        span.add_bytes(len(image_bytes))
+        cached_response = _response_cache.get(cache_key)
+        if cached_response is not None:
+            span.tag(cache="hit")
+            return {"response": cached_response, "cached": True, "complete": True, "preprocess": None}
+        cached_response = get_extraction_cache().get(cache_key)
+        if cached_response is not None:
+            span.tag(cache="disk")
+            _response_cache.put(cache_key, cached_response)
+            return {"response": cached_response, "cached": True, "complete": True, "preprocess": None}
+
+        span.tag(cache="miss")
+        # 同じ画像の抽出が実行中ならその結果を待って共有する（住所の途中経過は最初の呼び出し元だけに届く）
+        return coalesce(("llm", cache_key), lambda: _extract(image_bytes, cache_key, on_address))
+
+
+def _extract(image_bytes, cache_key, on_address):
+    # 縮小・余白除去・再圧縮で送信データ量を減らす
+    preprocessed = preprocess_image(image_bytes)
+
+    # 画像ファイルをBase64エンコード（縦長の画像は分割済み）
+    image_contents = [
+        {
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:{mime_type};base64,{base64.b64encode(data).decode('utf-8')}"
+            }
+        }
+        for mime_type, data in preprocessed["images"]
+    ]
+
+    def create_stream():
+        return openai.chat.completions.create(
+            model=LLM_MODEL,
+            messages=[
+                {"role": "system", "content": LLM_SYSTEM_PROMPT},
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": LLM_EXTRACTION_PROMPT},
+                        *image_contents
+                    ]
+                }
+            ],
+            max_tokens=LLM_MAX_TOKENS,
+            temperature=0.3,
+            response_format=RESPONSE_FORMAT,
+            stream=True,
+            timeout=LLM_TIMEOUT
+        )
+
+    # 送信前に1分あたりの上限の枠を確保する（プロンプトは1文字1トークンとして多めに見積もる）
+    _request_budget.acquire()
+    _token_budget.acquire(
+        preprocessed["processed_tokens"] + len(LLM_SYSTEM_PROMPT) + len(LLM_EXTRACTION_PROMPT) + LLM_MAX_TOKENS
+    )
+
+    # 再試行とサーキットブレーカーは他の外部呼び出しと同じく http_client で行う
+    host = urlparse(str(openai.base_url or "https://api.openai.com/v1")).hostname
+    # 応答の最後のチャンクが届くまでを外部APIの所要時間として計測する
+    with metrics.span("llm_upstream") as span:
+        span.add_bytes(preprocessed["processed_bytes"])
+        stream = call_with_retry(create_stream, host, LLM_RETRY_ERRORS)
+
+        parser = IncrementalJSONParser()
+        parts = []
+        finish_reason = None
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            finish_reason = chunk.choices[0].finish_reason or finish_reason
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            parts.append(delta)
+            for path, value in parser.feed(delta):
+                if on_address and value and is_address_path(path):
+                    on_address(value)
+
+        span.tag(finish_reason=finish_reason or "none")
+
+    content = "".join(parts)
+    # 最後まで出力されたJSONだけをキャッシュする（"length" で打ち切られた応答を残さない）
+    complete = finish_reason == "stop" and parser.finished
+    if complete:
+        get_extraction_cache().put(cache_key, content, model=LLM_MODEL)
+        _response_cache.put(cache_key, content)
+    return {"response": content, "cached": False, "complete": complete, "preprocess": preprocessed}
+
+
+_CODE_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*(.*?)\s*```\s*$", re.DOTALL)
+
+
+def extract_data_from_response(response_text):
+    """LLMレスポンスから住所と土地情報を抽出"""
+    addresses = []
+    land_info = None
+    
+    try:
+        # JSONとして解析を試みる（コードブロックで囲まれていれば中身を使う）
+        fence = _CODE_FENCE_RE.match(response_text)
+        data = json.loads(fence.group(1) if fence else response_text)
+        
+        # land_information全体を保存
+        if 'land_information' in data:
+            land_info = data['land_information']
+            
+            # 土地の所在地を抽出
+            if 'location' in land_info:
+                location = land_info['location']
+                if location:
+                    addresses.append(location)
+            
+            # 所有者住所を抽出
+            if 'owner' in land_info and 'address' in land_info['owner']:
+                owner_address = land_info['owner']['address']
+                if owner_address:
+                    addresses.append(owner_address)
+        
+        # 権利部A（所有権）から住所を抽出
+        if 'rights_section_A_ownership' in data:
+            for item in data['rights_section_A_ownership']:
+                if 'rights_holder_and_other_matters' in item and 'owner_address' in item['rights_holder_and_other_matters']:
+                    addr = item['rights_holder_and_other_matters']['owner_address']
+                    if addr:
+                        addresses.append(addr)
+        
+        # 権利部B（その他の権利）から住所を抽出
+        if 'rights_section_B_other_rights' in data:
+            for item in data['rights_section_B_other_rights']:
+                if 'rights_holder_and_other_matters' in item:
+                    matters = item['rights_holder_and_other_matters']
+                    # 債務者住所
+                    if 'debtor' in matters and 'address' in matters['debtor']:
+                        addr = matters['debtor']['address']
+                        if addr:
+                            addresses.append(addr)
+                    # 抵当権者住所
+                    if 'mortgage_holder' in matters and 'address' in matters['mortgage_holder']:
+                        addr = matters['mortgage_holder']['address']
+                        if addr:
+                            addresses.append(addr)
+    
+    except json.JSONDecodeError:
+        # JSON解析に失敗した場合は、都道府県名から始まる部分を住所として抽出する
+        addresses = extract_addresses(response_text)
+    
+    # 表記が違うだけの住所は1つにまとめる
+    return unique_addresses(addresses), land_info
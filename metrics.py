@@ -0,0 +1,220 @@
+"""処理段階ごとの所要時間の計測
+
+    with metrics.span("geocode") as s:
+        ...
+        s.tag(cache="hit")
+        s.add_bytes(len(body))
+
+のように囲んだ区間の時間を段階・タグごとのヒストグラムに集計し、Prometheusの
+テキスト形式で出力する。集計はプロセスごとなので、api_server は自身の /metrics で、
+Streamlitのアプリは METRICS_PORT を設定したときに start_metrics_server() で開く /metrics で出す。しきい値を超えた区間は
+1行1件のJSONで遅延ログに出す。計測は時刻を2回読んで辞書を1つ更新するだけなので、
+有効にしたままでも処理時間への影響は無視できる。
+"""
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+# 遅延ログに出すしきい値（秒）。段階ごとに "geocode=1,llm_extraction=30" のように上書きできる
+SLOW_THRESHOLD = float(os.getenv("METRICS_SLOW_THRESHOLD", "1.0"))
+SLOW_THRESHOLDS = os.getenv("METRICS_SLOW_THRESHOLDS", "llm_extraction=30,bundle_extraction=120")
+SLOW_LOG_PATH = os.getenv("METRICS_SLOW_LOG_PATH", "")
+# api_server 以外のプロセス（Streamlit）で /metrics を開くポート（0なら開かない）
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# ヒストグラムの区切り（秒）
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+slow_logger = logging.getLogger("hazard_app.slow")
+if SLOW_LOG_PATH:
+    _handler = logging.FileHandler(SLOW_LOG_PATH, encoding="utf-8")
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    slow_logger.addHandler(_handler)
+    slow_logger.propagate = False
+
+
+def _parse_thresholds(spec):
+    thresholds = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        stage, _, seconds = item.partition("=")
+        thresholds[stage.strip()] = float(seconds)
+    return thresholds
+
+
+_thresholds = _parse_thresholds(SLOW_THRESHOLDS)
+
+
+class Histogram:
+    """区切りごとの件数と、所要時間の合計・件数・データ量を持つヒストグラム"""
+
+    def __init__(self):
+        self.bucket_counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.payload_bytes = 0
+
+    def observe(self, seconds, payload_bytes):
+        self.bucket_counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+        self.payload_bytes += payload_bytes
+
+
+_histograms = {}
+_lock = threading.Lock()
+
+
+class Span:
+    """計測中の区間（途中でタグやデータ量を加えられる）"""
+
+    __slots__ = ("stage", "tags", "payload_bytes")
+
+    def __init__(self, stage, tags):
+        self.stage = stage
+        self.tags = tags
+        self.payload_bytes = 0
+
+    def tag(self, **tags):
+        self.tags.update(tags)
+
+    def add_bytes(self, size):
+        self.payload_bytes += size
+
+
+class _NullSpan:
+    def tag(self, **tags):
+        pass
+
+    def add_bytes(self, size):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def observe(stage, seconds, tags=None, payload_bytes=0):
+    """1区間の所要時間を記録し、しきい値を超えていれば遅延ログに出す"""
+    tags = tags or {}
+    key = (stage, tuple(sorted((name, str(value)) for name, value in tags.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(seconds, payload_bytes)
+
+    if seconds >= _thresholds.get(stage, SLOW_THRESHOLD):
+        slow_logger.warning(json.dumps({
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "stage": stage,
+            "seconds": round(seconds, 4),
+            "payload_bytes": payload_bytes,
+            **tags,
+        }, ensure_ascii=False))
+
+
+@contextmanager
+def span(stage, **tags):
+    """with で囲んだ区間の時間を計測する（例外で抜けたときは error タグをつける）"""
+    if not METRICS_ENABLED:
+        yield _NULL_SPAN
+        return
+    current = Span(stage, tags)
+    started = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current.tags["error"] = type(e).__name__
+        raise
+    finally:
+        observe(stage, time.perf_counter() - started, current.tags, current.payload_bytes)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(stage, tags, **extra):
+    pairs = [("stage", stage), *tags, *extra.items()]
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def render_prometheus():
+    """集計結果をPrometheusのテキスト形式で返す"""
+    with _lock:
+        snapshot = [
+            (stage, tags, list(h.bucket_counts), h.total, h.count, h.payload_bytes)
+            for (stage, tags), h in sorted(_histograms.items())
+        ]
+
+    lines = [
+        "# HELP stage_duration_seconds Time spent in each pipeline stage.",
+        "# TYPE stage_duration_seconds histogram",
+    ]
+    for stage, tags, bucket_counts, total, count, _ in snapshot:
+        cumulative = 0
+        for bound, bucket_count in zip((*BUCKETS, "+Inf"), bucket_counts):
+            cumulative += bucket_count
+            lines.append(f"stage_duration_seconds_bucket{_labels(stage, tags, le=bound)} {cumulative}")
+        lines.append(f"stage_duration_seconds_sum{_labels(stage, tags)} {total}")
+        lines.append(f"stage_duration_seconds_count{_labels(stage, tags)} {count}")
+
+    lines += [
+        "# HELP stage_payload_bytes_total Bytes transferred or produced in each pipeline stage.",
+        "# TYPE stage_payload_bytes_total counter",
+    ]
+    for stage, tags, _, _, _, payload_bytes in snapshot:
+        lines.append(f"stage_payload_bytes_total{_labels(stage, tags)} {payload_bytes}")
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    """/metrics だけを返すHTTPサーバーを別スレッドで起動（port が0なら何もしない）
+
+    何度呼んでも起動は1回だけなので、Streamlitの再実行のたびに呼んでよい。
+    ポートが使用中なら警告を出して計測だけを続ける。
+    """
+    global _server
+    if not port:
+        return None
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+            except OSError as e:
+                logging.getLogger("hazard_app.metrics").warning("/metrics を %s:%s で開けませんでした: %s", host, port, e)
+                return None
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+        return _server
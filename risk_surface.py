@@ -0,0 +1,111 @@
+"""検索地点の周辺の危険度分布
+
+検索地点を中心とした格子（既定は半径500m・10m間隔）の全点について、洪水・土砂災害・津波の
+危険度を求める。1点ずつ判定せず、デコード済みのクラスタイルと標高タイルを配列の添字で
+まとめて引くので、数万点でも1秒かからない。
+"""
+import os
+
+import numpy as np
+
+import elevation as dem
+import hazard
+import hazard_tiles
+
+RISK_SURFACE_RADIUS = float(os.getenv("RISK_SURFACE_RADIUS", "500"))
+RISK_SURFACE_SPACING = float(os.getenv("RISK_SURFACE_SPACING", "10"))
+
+# 格子の値はLEVELSの添字。UNKNOWNは判定できなかった点、OUTSIDEは円の外
+LEVELS = ("低い", "中程度", "高い")
+UNKNOWN = -1
+OUTSIDE = -2
+
+# 分布として表示できる項目（overall は各項目のうち最も高いレベル）
+DIMENSIONS = {
+    "overall": "総合",
+    "flood": "洪水",
+    "landslide": "土砂災害",
+    "tsunami": "津波",
+}
+
+# レベルごとの表示色（RGBA）
+LEVEL_COLORS = {
+    0: (0, 160, 80, 60),
+    1: (255, 200, 0, 140),
+    2: (220, 30, 30, 160),
+    UNKNOWN: (128, 128, 128, 80),
+}
+
+_METERS_PER_DEGREE = 111320.0
+
+
+def make_grid(lat, lon, radius=RISK_SURFACE_RADIUS, spacing=RISK_SURFACE_SPACING):
+    """中心の周りの格子点の緯度・経度（北が上の2次元配列）と円の内側かどうかを返す"""
+    offsets = np.arange(-radius, radius + spacing / 2, spacing)
+    east, north = np.meshgrid(offsets, offsets[::-1])
+    lats = lat + north / _METERS_PER_DEGREE
+    lons = lon + east / (_METERS_PER_DEGREE * np.cos(np.radians(lat)))
+    inside = east ** 2 + north ** 2 <= radius ** 2
+    return lats, lons, inside
+
+
+def _tile_levels(layer, lats, lons):
+    table = np.array([LEVELS.index(level) for level in hazard_tiles.level_table(layer)], dtype=np.int8)
+    classes = hazard_tiles.sample_classes(layer, lats, lons)
+    return classes, table[classes]
+
+
+def _tsunami_levels(lats, lons):
+    classes, levels = _tile_levels("tsunami", lats, lons)
+    # 区域外の点は標高で簡易判定する（リモートAPIは使わず、ローカルにない点は不明）
+    heights = dem.elevations(lats, lons, allow_remote=False)
+    by_height = np.select(
+        [np.isnan(heights), heights < hazard.TSUNAMI_HIGH_ELEVATION, heights < hazard.TSUNAMI_MEDIUM_ELEVATION],
+        [UNKNOWN, 2, 1],
+        default=0,
+    ).astype(np.int8)
+    return np.where(classes == 0, by_height, levels)
+
+
+def level_shares(levels, inside):
+    """円の内側でレベルごとの面積の割合を返す"""
+    values = levels[inside]
+    shares = {label: float(np.count_nonzero(values == i)) / values.size for i, label in enumerate(LEVELS)}
+    shares["不明"] = float(np.count_nonzero(values == UNKNOWN)) / values.size
+    return shares
+
+
+def compute_risk_surface(lat, lon, radius=RISK_SURFACE_RADIUS, spacing=RISK_SURFACE_SPACING):
+    """周辺の危険度分布を計算
+
+    "levels" は項目ごとのレベルの2次元配列、"shares" はその割合、
+    "bounds" は地図に重ねるときの範囲 [[南, 西], [北, 東]]。
+    """
+    lats, lons, inside = make_grid(lat, lon, radius, spacing)
+    levels = {
+        "flood": _tile_levels("flood", lats, lons)[1],
+        "landslide": _tile_levels("landslide", lats, lons)[1],
+        "tsunami": _tsunami_levels(lats, lons),
+    }
+    # 不明(-1)はどのレベルより小さいので、判定できた項目があればそちらが優先される
+    levels["overall"] = np.maximum.reduce([levels[name] for name in ("flood", "landslide", "tsunami")])
+    for grid in levels.values():
+        grid[~inside] = OUTSIDE
+
+    half = spacing / 2
+    lat_margin = (radius + half) / _METERS_PER_DEGREE
+    lon_margin = (radius + half) / (_METERS_PER_DEGREE * np.cos(np.radians(lat)))
+    return {
+        "levels": levels,
+        "shares": {name: level_shares(grid, inside) for name, grid in levels.items()},
+        "bounds": [[lat - lat_margin, lon - lon_margin], [lat + lat_margin, lon + lon_margin]],
+        "cells": int(np.count_nonzero(inside)),
+    }
+
+
+def to_rgba(levels):
+    """レベルの配列を地図に重ねるRGBA画像にする（円の外は透明）"""
+    image = np.zeros(levels.shape + (4,), dtype=np.uint8)
+    for level_id, color in LEVEL_COLORS.items():
+        image[levels == level_id] = color
+    return image
@@ -0,0 +1,207 @@
+"""指定緊急避難場所の最寄り検索
+
+国土地理院の「指定緊急避難場所データ」のCSVを読み込み、災害の種類ごとに
+KD木の索引を作って近い順に避難場所を返す。緯度経度は単位球面上の3次元座標に
+変換して索引を作るので、直線距離の順序がそのまま地表の距離の順序になる。
+
+データは https://www.gsi.go.jp/bousaichiri/hinanbasho.html から全国版をダウンロードし、
+SHELTER_DATA_PATH（既定は data/shelters.csv）に置く。
+"""
+import csv
+import heapq
+import math
+import os
+import threading
+
+import numpy as np
+
+SHELTER_DATA_PATH = os.getenv("SHELTER_DATA_PATH", os.path.join("data", "shelters.csv"))
+SHELTER_COUNT = int(os.getenv("SHELTER_COUNT", "3"))
+LEAF_SIZE = 16
+EARTH_RADIUS = 6371008.8
+
+# ハザード項目 → 対応している災害種別の列名
+HAZARD_COLUMNS = {
+    "flood": "洪水",
+    "landslide": "崖崩れ、土石流及び地滑り",
+    "tsunami": "津波",
+}
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def to_unit_vectors(lats, lons):
+    """緯度経度を単位球面上の3次元座標（n x 3）に変換"""
+    lat_rad = np.radians(np.asarray(lats, dtype=np.float64))
+    lon_rad = np.radians(np.asarray(lons, dtype=np.float64))
+    cos_lat = np.cos(lat_rad)
+    return np.stack([cos_lat * np.cos(lon_rad), cos_lat * np.sin(lon_rad), np.sin(lat_rad)], axis=-1)
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """2地点間の距離(m)"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+class KDTree:
+    """点を並べ替えた配列と節点の表だけで表すKD木
+
+    各節点は並べ替え後の配列の区間 [start, end) を持ち、葉は LEAF_SIZE 点以下の区間。
+    """
+
+    def __init__(self, points, leaf_size=LEAF_SIZE):
+        order = np.arange(len(points))
+        points = np.array(points, dtype=np.float64)
+        self._start, self._end, self._dim, self._split, self._left, self._right = [], [], [], [], [], []
+
+        stack = [(0, len(points), None, None)]
+        while stack:
+            start, end, parent, is_left = stack.pop()
+            node = len(self._start)
+            if parent is not None:
+                (self._left if is_left else self._right)[parent] = node
+            self._start.append(start)
+            self._end.append(end)
+            self._left.append(-1)
+            self._right.append(-1)
+            if end - start <= leaf_size:
+                self._dim.append(-1)
+                self._split.append(0.0)
+                continue
+
+            # 広がりが最も大きい軸の中央値で分割する
+            segment = points[start:end]
+            dim = int(np.argmax(segment.max(axis=0) - segment.min(axis=0)))
+            mid = (end - start) // 2
+            part = np.argpartition(segment[:, dim], mid)
+            points[start:end] = segment[part]
+            order[start:end] = order[start:end][part]
+            self._dim.append(dim)
+            self._split.append(float(points[start + mid, dim]))
+            stack.append((start + mid, end, node, False))
+            stack.append((start, start + mid, node, True))
+
+        self.points = points
+        # 並べ替え後の位置 → 元の行番号
+        self.order = order
+
+    def __len__(self):
+        return len(self.points)
+
+    def query(self, point, k):
+        """近い順に (元の行番号, 直線距離の二乗) を最大k件返す"""
+        point = np.asarray(point, dtype=np.float64)
+        best = []  # (-距離の二乗, 位置) の最大ヒープ
+        stack = [(0, 0.0)]
+        while stack:
+            node, bound = stack.pop()
+            if len(best) == k and bound >= -best[0][0]:
+                continue
+            dim = self._dim[node]
+            if dim < 0:
+                start, end = self._start[node], self._end[node]
+                dist2 = ((self.points[start:end] - point) ** 2).sum(axis=1)
+                for offset in np.argsort(dist2)[:k]:
+                    d = float(dist2[offset])
+                    if len(best) < k:
+                        heapq.heappush(best, (-d, start + int(offset)))
+                    elif d < -best[0][0]:
+                        heapq.heapreplace(best, (-d, start + int(offset)))
+                    else:
+                        break
+                continue
+            diff = point[dim] - self._split[node]
+            near, far = (self._left[node], self._right[node]) if diff < 0 else (self._right[node], self._left[node])
+            # 遠い側は分割面までの距離が下限になる（後に積むほうを先に調べる）
+            stack.append((far, max(bound, diff * diff)))
+            stack.append((near, bound))
+        return [(int(self.order[position]), -neg) for neg, position in sorted(best, reverse=True)]
+
+
+def load_shelters(path=SHELTER_DATA_PATH):
+    """避難場所のCSVを読み込み、属性のリストと緯度経度・対応種別の配列を返す"""
+    for encoding in ("utf-8-sig", "cp932"):
+        try:
+            with open(path, encoding=encoding, newline="") as f:
+                rows = list(csv.DictReader(f))
+            break
+        except UnicodeDecodeError:
+            continue
+    else:
+        raise ValueError(f"文字コードを判別できません: {path}")
+
+    records, lats, lons, suitable = [], [], [], []
+    for row in rows:
+        try:
+            lat, lon = float(row["緯度"]), float(row["経度"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        records.append({"name": row.get("施設・場所名", ""), "address": row.get("住所", "")})
+        lats.append(lat)
+        lons.append(lon)
+        suitable.append([(row.get(column) or "").strip() in ("1", "◎", "○") for column in HAZARD_COLUMNS.values()])
+    return (
+        records,
+        np.array(lats, dtype=np.float64),
+        np.array(lons, dtype=np.float64),
+        np.array(suitable, dtype=bool).reshape(len(records), len(HAZARD_COLUMNS)),
+    )
+
+
+class ShelterIndex:
+    """災害の種類ごとのKD木（None はすべての避難場所）"""
+
+    def __init__(self, records, lats, lons, suitable):
+        self.records = records
+        self.lats = lats
+        self.lons = lons
+        self.suitable = suitable
+        vectors = to_unit_vectors(lats, lons)
+        self._trees = {None: (np.arange(len(records)), KDTree(vectors))}
+        for column, hazard in enumerate(HAZARD_COLUMNS):
+            rows = np.flatnonzero(suitable[:, column])
+            self._trees[hazard] = (rows, KDTree(vectors[rows]))
+
+    def __len__(self):
+        return len(self.records)
+
+    def nearest(self, lat, lon, hazard=None, k=SHELTER_COUNT):
+        """指定した災害に対応する避難場所を近い順にk件返す"""
+        rows, tree = self._trees[hazard]
+        if len(tree) == 0:
+            return []
+        point = to_unit_vectors([lat], [lon])[0]
+        results = []
+        for position, _ in tree.query(point, k):
+            row = int(rows[position])
+            shelter_lat, shelter_lon = float(self.lats[row]), float(self.lons[row])
+            results.append({
+                **self.records[row],
+                "lat": shelter_lat,
+                "lon": shelter_lon,
+                "distance": haversine(lat, lon, shelter_lat, shelter_lon),
+                "hazards": [name for column, name in enumerate(HAZARD_COLUMNS) if self.suitable[row, column]],
+            })
+        return results
+
+
+def get_shelter_index():
+    """避難場所の索引を取得（データファイルがなければNone）"""
+    global _index
+    with _index_lock:
+        if _index is None and os.path.exists(SHELTER_DATA_PATH):
+            _index = ShelterIndex(*load_shelters(SHELTER_DATA_PATH))
+    return _index
+
+
+def nearest_shelters(lat, lon, hazard=None, k=SHELTER_COUNT):
+    """最寄りの避難場所を返す（データがなければ空のリスト）"""
+    index = get_shelter_index()
+    if index is None:
+        return []
+    return index.nearest(lat, lon, hazard, k)
@@ -0,0 +1,51 @@
+"""タイル画素を単位とする空間キャッシュ
+
+ハザードタイルや標高タイルの値は画素の中では変わらないので、同じ画素に入る
+座標どうしは判定結果を共有できる。元データの解像度（ズームレベル）ごとに
+キャッシュを分け、数メートルしか離れていない隣の地番でもキャッシュが効くようにする。
+容量の上限は cache_manager の名前つきキャッシュ（spatial_{名前}）ごとに決まる。
+"""
+import os
+
+from cache_manager import get_cache
+from hazard_tiles import TILE_SIZE, latlon_to_tile_pixel
+
+SPATIAL_CACHE_TTL = int(os.getenv("SPATIAL_CACHE_TTL", str(24 * 3600)))
+
+_MISSING = object()
+
+
+def cell_of(lat, lon, zoom):
+    """指定ズームレベルで座標が入る画素（世界座標）"""
+    x, y, px, py = latlon_to_tile_pixel(lat, lon, zoom)
+    return x * TILE_SIZE + px, y * TILE_SIZE + py
+
+
+class GridCache:
+    """指定ズームレベルの画素ごとに値を保持するキャッシュ"""
+
+    def __init__(self, name, zoom, ttl=SPATIAL_CACHE_TTL):
+        self.zoom = zoom
+        self._cache = get_cache(f"spatial_{name}", ttl=ttl, serialize=False)
+
+    def cell(self, lat, lon):
+        return cell_of(lat, lon, self.zoom)
+
+    def get_or_compute(self, lat, lon, compute, cacheable=None):
+        """同じ画素の値があれば返し、なければ compute(lat, lon) で求めて保存する
+
+        cacheable(value) が偽になる値（取得失敗など）は保存しない。
+        """
+        key = self.cell(lat, lon)
+        value = self._cache.get(key, _MISSING)
+        if value is _MISSING:
+            value = compute(lat, lon)
+            if cacheable is None or cacheable(value):
+                self._cache.put(key, value)
+        return value
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return {**self._cache.stats(), "zoom": self.zoom}
@@ -0,0 +1,13 @@
+from address_normalizer import join_location_lot, normalize_address
+
+
+def test_keeps_aza_inside_place_names():
+    assert normalize_address("秋田県横手市十文字町梨木1") == "秋田県横手市十文字町梨木1"
+    assert normalize_address("山形県天童市大字十文字1") == "山形県天童市十文字1"
+    assert join_location_lot("秋田県横手市十文字町", "1番") == "秋田県横手市十文字町1"
+
+
+def test_strips_oaza_and_aza_prefixes():
+    assert normalize_address("茨城県つくば市大字上郷字前田123") == "茨城県つくば市上郷前田123"
+    assert normalize_address("茨城県つくば市大字十文字字北1") == "茨城県つくば市十文字北1"
+    assert normalize_address("福島県双葉郡浪江町字川添1") == "福島県双葉郡浪江町川添1"
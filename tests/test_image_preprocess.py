@@ -0,0 +1,18 @@
+from PIL import Image
+
+from image_preprocess import TILE_SEGMENT_ASPECT, split_tall_image
+
+
+def test_split_tall_image_covers_whole_height():
+    image = Image.new("L", (1000, 6000), 255)
+    segments = split_tall_image(image)
+    assert len(segments) > 1
+    assert all(segment.size == (1000, int(1000 * TILE_SEGMENT_ASPECT)) for segment in segments[:-1])
+    assert segments[-1].size[1] <= int(1000 * TILE_SEGMENT_ASPECT)
+
+
+def test_split_tall_image_with_degenerate_width():
+    image = Image.new("L", (1, 50), 255)
+    segments = split_tall_image(image)
+    assert 0 < len(segments) <= 50
+    assert all(segment.size[0] == 1 and segment.size[1] >= 1 for segment in segments)
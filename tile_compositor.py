@@ -0,0 +1,89 @@
+"""表示中のハザードレイヤーをサーバー側で1枚のタイルに合成する
+
+ブラウザで3枚のタイルを重ねる代わりに、有効なレイヤーだけを透過度をつけて
+合成したPNG / WebPを1枚返す。合成結果はレイヤーの組み合わせごとにディスクへ保存する。
+"""
+import hashlib
+import io
+import os
+import threading
+import time
+
+from PIL import Image, features
+
+import hazard_tiles
+import tile_proxy
+
+COMPOSITE_CACHE_DIR = os.getenv("COMPOSITE_CACHE_DIR", os.path.join(".cache", "composites"))
+# ブラウザで重ねていたときと同じ透過度
+LAYER_OPACITY = 0.6
+# 下から順に重ねる
+LAYER_ORDER = ("flood", "tsunami", "landslide")
+FORMATS = {"png": ("PNG", "image/png"), "webp": ("WEBP", "image/webp")}
+# WebPに対応していればそちらを使う（同じ見た目でPNGより小さい）
+DEFAULT_FORMAT = "webp" if features.check("webp") else "png"
+
+
+def parse_layers(spec):
+    """"flood+landslide" のような指定を重ねる順のタプルにする（不明なレイヤーはValueError）"""
+    layers = set(filter(None, spec.split("+")))
+    unknown = layers - set(hazard_tiles.LAYERS)
+    if unknown or not layers:
+        raise ValueError(f"不明なレイヤーです: {spec}")
+    return tuple(layer for layer in LAYER_ORDER if layer in layers)
+
+
+def _cache_path(layers, z, x, y, fmt):
+    name = f"{z}_{x}_{y}"
+    shard = hashlib.md5(name.encode("ascii")).hexdigest()[:2]
+    return os.path.join(COMPOSITE_CACHE_DIR, "+".join(layers), shard, f"{name}.{fmt}")
+
+
+def _composite(layers, z, x, y, fmt):
+    base = Image.new("RGBA", (hazard_tiles.TILE_SIZE, hazard_tiles.TILE_SIZE))
+    found = False
+    for layer in layers:
+        status, body = tile_proxy.get_tile(layer, z, x, y)
+        if status != 200:
+            continue
+        found = True
+        tile = Image.open(io.BytesIO(body)).convert("RGBA")
+        alpha = tile.getchannel("A").point(lambda a: int(a * LAYER_OPACITY))
+        tile.putalpha(alpha)
+        base = Image.alpha_composite(base, tile)
+    if not found:
+        return None
+    buffer = io.BytesIO()
+    base.save(buffer, format=FORMATS[fmt][0], optimize=True)
+    return buffer.getvalue()
+
+
+def get_composite_tile(layers, z, x, y, fmt=DEFAULT_FORMAT):
+    """合成タイルを (ステータス, バイト列) で返す（どのレイヤーにもデータがなければ (404, b"")）"""
+    path = _cache_path(layers, z, x, y, fmt)
+    empty_path = f"{path}.empty"
+    for candidate in (path, empty_path):
+        try:
+            if time.time() - os.path.getmtime(candidate) < tile_proxy.TILE_CACHE_MAX_AGE:
+                if candidate == empty_path:
+                    return 404, b""
+                with open(candidate, "rb") as f:
+                    return 200, f.read()
+        except OSError:
+            continue
+
+    body = _composite(layers, z, x, y, fmt)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    target = path if body is not None else empty_path
+    tmp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(body or b"")
+    os.replace(tmp_path, target)
+    return (200, body) if body is not None else (404, b"")
+
+
+def composite_url_template(layers, fmt=DEFAULT_FORMAT):
+    """合成タイルのURL（タイルプロキシが設定されているときのみ使える）"""
+    # 選択順が違っても同じ組み合わせなら同じURL（同じキャッシュ）になるよう並べ替える
+    spec = "+".join(layer for layer in LAYER_ORDER if layer in layers)
+    return f"{tile_proxy.TILE_PROXY_URL.rstrip('/')}/composite/{spec}/{{z}}/{{x}}/{{y}}.{fmt}"
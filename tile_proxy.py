@@ -0,0 +1,160 @@
+"""ハザードマップタイルのローカルキャッシュ（タイルプロキシ）
+
+ブラウザの地図レイヤーと hazard_tiles の判定の両方が、このキャッシュ経由で
+disaportaldata のタイルを取得する。キャッシュはハッシュで分散させたディレクトリに
+保存し、期限を過ぎたタイルは ETag / Last-Modified で条件付き再検証する。
+プロキシを使うときは、住所を検索したときに周辺のタイルを裏で先読みしておく。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import hazard_tiles
+import metrics
+from http_client import coalesce, get_session
+
+TILE_PROXY_URL = os.getenv("TILE_PROXY_URL", "")
+TILE_CACHE_DIR = os.getenv("TILE_CACHE_DIR", os.path.join(".cache", "tiles"))
+TILE_CACHE_MAX_AGE = int(os.getenv("TILE_CACHE_MAX_AGE", str(24 * 3600)))
+TILE_PREFETCH_RADIUS = int(os.getenv("TILE_PREFETCH_RADIUS", "1"))
+TILE_PREFETCH_WORKERS = int(os.getenv("TILE_PREFETCH_WORKERS", "4"))
+# 先読みの待ち行列に積むタイル数の上限（超えた分は先読みしない）
+TILE_PREFETCH_MAX_PENDING = int(os.getenv("TILE_PREFETCH_MAX_PENDING", "256"))
+
+_prefetch_executor = ThreadPoolExecutor(max_workers=TILE_PREFETCH_WORKERS, thread_name_prefix="tile-prefetch")
+_prefetching = set()
+_prefetching_lock = threading.Lock()
+
+
+def _cache_paths(layer, z, x, y):
+    """タイルの保存先（画像とメタ情報）。1ディレクトリのファイル数が偏らないようハッシュで分散"""
+    name = f"{z}_{x}_{y}"
+    shard = hashlib.md5(name.encode("ascii")).hexdigest()[:2]
+    base = os.path.join(TILE_CACHE_DIR, layer, shard, name)
+    return f"{base}.png", f"{base}.json"
+
+
+def _read_cache(layer, z, x, y):
+    png_path, meta_path = _cache_paths(layer, z, x, y)
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        body = b""
+        if meta["status"] == 200:
+            with open(png_path, "rb") as f:
+                body = f.read()
+        return meta, body
+    except (OSError, ValueError, KeyError):
+        return None, None
+
+
+def _write_cache(layer, z, x, y, meta, body):
+    png_path, meta_path = _cache_paths(layer, z, x, y)
+    os.makedirs(os.path.dirname(png_path), exist_ok=True)
+    suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+    if meta["status"] == 200:
+        with open(png_path + suffix, "wb") as f:
+            f.write(body)
+        os.replace(png_path + suffix, png_path)
+    # メタ情報は画像の後に書き換えるので、読み出し側が不整合な組み合わせを見ることはない
+    with open(meta_path + suffix, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(meta_path + suffix, meta_path)
+
+
+def get_tile(layer, z, x, y):
+    """タイルを (ステータス, PNGバイト列) で返す（配信されていないタイルは (404, b"")）"""
+    with metrics.span("tile", layer=layer) as span:
+        meta, body = _read_cache(layer, z, x, y)
+        if meta is not None and time.time() - meta["fetched_at"] < TILE_CACHE_MAX_AGE:
+            span.tag(cache="hit")
+            return meta["status"], body
+        span.tag(cache="miss" if meta is None else "revalidate")
+        # 地図表示・先読み・判定から同じタイルを同時に要求されても配信元へは1回だけ問い合わせる
+        return coalesce(("tile", layer, z, x, y), lambda: _refresh_tile(layer, z, x, y, meta, body))
+
+
+def _refresh_tile(layer, z, x, y, meta, body):
+    headers = {}
+    if meta is not None:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    try:
+        with metrics.span("tile_upstream", layer=layer) as span:
+            response = get_session().get(
+                hazard_tiles.tile_url(layer, z, x, y),
+                headers=headers,
+                timeout=hazard_tiles.HAZARD_TILE_TIMEOUT,
+            )
+            span.tag(status=response.status_code)
+            span.add_bytes(len(response.content))
+        if response.status_code == 304 and meta is not None:
+            # 変更なし。取得時刻だけ更新する
+            meta["fetched_at"] = time.time()
+            _write_cache(layer, z, x, y, meta, body)
+            return meta["status"], body
+        if response.status_code != 404:
+            response.raise_for_status()
+    except requests.RequestException:
+        if meta is not None:
+            # 取得に失敗したときは期限切れでも手元のタイルを返す
+            return meta["status"], body
+        raise
+
+    meta = {
+        "status": response.status_code,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "fetched_at": time.time(),
+    }
+    body = response.content if response.status_code == 200 else b""
+    _write_cache(layer, z, x, y, meta, body)
+    return meta["status"], body
+
+
+def tile_url_template(layer):
+    """地図のタイルレイヤーに指定するURL（プロキシが設定されていなければ配信元を直接参照）"""
+    if TILE_PROXY_URL:
+        return f"{TILE_PROXY_URL.rstrip('/')}/tiles/{layer}/{{z}}/{{x}}/{{y}}.png"
+    return f"{hazard_tiles.HAZARD_TILE_BASE_URL}/{hazard_tiles.LAYERS[layer]['path']}/{{z}}/{{x}}/{{y}}.png"
+
+
+def _prefetch_one(key):
+    try:
+        get_tile(*key)
+    except requests.RequestException:
+        pass
+    finally:
+        with _prefetching_lock:
+            _prefetching.discard(key)
+
+
+def prefetch_around(lat, lon, zoom, layers=None, radius=TILE_PREFETCH_RADIUS):
+    """指定座標の周辺タイルを、前後のズームレベルも含めて裏で取得しておく
+
+    ブラウザがタイルを配信元から直接読むとき（TILE_PROXY_URL 未設定）は誰も使わないので何もしない。
+    """
+    if not TILE_PROXY_URL:
+        return
+    layers = layers or list(hazard_tiles.LAYERS)
+    for z in (zoom - 1, zoom, zoom + 1):
+        cx, cy, _, _ = hazard_tiles.latlon_to_tile_pixel(lat, lon, z)
+        for layer in layers:
+            for x in range(cx - radius, cx + radius + 1):
+                for y in range(cy - radius, cy + radius + 1):
+                    key = (layer, z, x, y)
+                    with _prefetching_lock:
+                        if len(_prefetching) >= TILE_PREFETCH_MAX_PENDING:
+                            return
+                        if key in _prefetching:
+                            continue
+                        _prefetching.add(key)
+                    _prefetch_executor.submit(_prefetch_one, key)